@@ -21,5 +21,8 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 from .edge import Edge, EdgeSet
+from .edge_indices import add_edge_indices
 from .file import File
 from .node import Node, NodeSet
+from .node_sets import NodeSets
+from .query import col
@@ -0,0 +1,214 @@
+# Copyright 2019. Allen Institute. All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+# disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following
+# disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+from collections import OrderedDict
+import h5py
+import numpy as np
+
+from .utils import read_indicies
+
+
+DEFAULT_CACHE_SIZE = 64*2**20  # Max bytes kept in the cache (per File)
+DEFAULT_BLOCK_SIZE = 2**20  # Approx. number of bytes loaded from a dataset at one time
+
+
+class ColumnCache(object):
+    """An LRU cache of the population and group datasets, limited to a total number of bytes.
+
+    Datasets are split into fixed sized blocks of rows (aligned to the hdf5 chunks if the dataset is chunked). The
+    first time a row is accessed its entire block is loaded into memory, and subsequent reads of any row in the block
+    don't have to go back to the hdf5 file. When the cache grows larger than max_bytes the least recently used blocks
+    are dropped. Reads that are larger than half of max_bytes (eg. iterating through an entire column) bypass the
+    cache so they don't evict everything else.
+
+    Setting max_bytes to 0 disables the cache, every read goes directly to the dataset. Datasets that are already numpy
+    arrays (eg. memory mapped, see utils.memmap_dataset) are never cached, they are just indexed directly.
+    """
+    def __init__(self, max_bytes=DEFAULT_CACHE_SIZE, block_size=DEFAULT_BLOCK_SIZE):
+        self._max_bytes = max_bytes
+        self._block_size = block_size
+        self._blocks = OrderedDict()  # (dataset key, block number) --> numpy array
+        self._block_rows = {}  # dataset key --> number of rows in each block
+        self._nbytes = 0
+
+        self._hits = 0
+        self._misses = 0
+        self._bytes_loaded = 0
+        self._evictions = 0
+
+    @property
+    def enabled(self):
+        return self._max_bytes > 0
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._evict()
+
+    @property
+    def nbytes(self):
+        """Number of bytes currently stored in the cache"""
+        return self._nbytes
+
+    @property
+    def stats(self):
+        """dictionary of cache statistics (hits, misses, bytes_loaded, evictions, nbytes, max_bytes)"""
+        return {
+            'hits': self._hits,
+            'misses': self._misses,
+            'bytes_loaded': self._bytes_loaded,
+            'evictions': self._evictions,
+            'nbytes': self._nbytes,
+            'max_bytes': self._max_bytes
+        }
+
+    def reset_stats(self):
+        self._hits = 0
+        self._misses = 0
+        self._bytes_loaded = 0
+        self._evictions = 0
+
+    def clear(self):
+        """Removes all blocks from the cache"""
+        self._blocks.clear()
+        self._nbytes = 0
+
+    def read_row(self, dataset, row_indx):
+        """Returns the value of a single row of a dataset"""
+        ds_key = self._dataset_key(dataset)
+        if ds_key is None:
+            return dataset[row_indx]
+
+        block_rows = self._get_block_rows(ds_key, dataset)
+        block_num = row_indx // block_rows
+        return self._get_block(ds_key, dataset, block_num, block_rows)[row_indx - block_num*block_rows]
+
+    def read_range(self, dataset, row_beg, row_end):
+        """Returns values of a contiguous range of rows of a dataset, dataset[row_beg:row_end]"""
+        row_end = min(row_end, dataset.shape[0])
+        if isinstance(dataset, np.ndarray):
+            # no copy if memory mapped
+            return np.asarray(dataset[row_beg:row_end])
+
+        ds_key = self._dataset_key(dataset)
+        if ds_key is None or row_end <= row_beg or self._is_large_read(dataset, row_end - row_beg):
+            return self._load(dataset, row_beg, row_end)
+
+        block_rows = self._get_block_rows(ds_key, dataset)
+        block_beg = row_beg // block_rows
+        block_end = (row_end - 1) // block_rows + 1
+        offset = block_beg*block_rows
+        if block_end - block_beg == 1:
+            values = self._get_block(ds_key, dataset, block_beg, block_rows)
+        else:
+            values = np.concatenate([self._get_block(ds_key, dataset, b, block_rows)
+                                     for b in range(block_beg, block_end)])
+        return values[(row_beg - offset):(row_end - offset)]
+
+    def read(self, dataset, indicies):
+        """Returns values of a dataset for a list of rows, which can be unordered and contain duplicates"""
+        indicies = np.asarray(indicies, dtype=np.int64).reshape(-1)
+        if isinstance(dataset, np.ndarray):
+            return np.asarray(dataset[indicies])
+
+        ds_key = self._dataset_key(dataset)
+        if ds_key is None or len(indicies) == 0 or self._is_large_read(dataset, len(indicies)):
+            return self._load_indicies(dataset, indicies)
+
+        block_rows = self._get_block_rows(ds_key, dataset)
+        block_nums = indicies // block_rows
+        values = np.empty((len(indicies),) + tuple(dataset.shape[1:]), dtype=dataset.dtype)
+
+        # group the indicies by block so each block is only fetched once
+        order = np.argsort(block_nums, kind='stable')
+        block_splits = np.flatnonzero(np.diff(block_nums[order])) + 1
+        for block_indicies in np.split(order, block_splits):
+            block_num = block_nums[block_indicies[0]]
+            block = self._get_block(ds_key, dataset, block_num, block_rows)
+            values[block_indicies] = block[indicies[block_indicies] - block_num*block_rows]
+
+        return values
+
+    def _dataset_key(self, dataset):
+        """Unique key for a dataset, or None if it shouldn't be cached (disabled, or dataset is already in memory)"""
+        if self._max_bytes <= 0 or not isinstance(dataset, h5py.Dataset):
+            return None
+        # The h5py object id is hashed on (file number, object number), which is unique across open files and much
+        # cheaper than looking up the filename and path of the dataset on every read.
+        return dataset.id
+
+    def _row_bytes(self, dataset):
+        return max(1, int(np.prod(dataset.shape[1:], dtype=np.int64)) * dataset.dtype.itemsize)
+
+    def _is_large_read(self, dataset, n_rows):
+        return n_rows*self._row_bytes(dataset) > self._max_bytes // 2
+
+    def _get_block_rows(self, ds_key, dataset):
+        if ds_key not in self._block_rows:
+            block_rows = max(1, self._block_size // self._row_bytes(dataset))
+            if dataset.chunks is not None:
+                # align blocks to the hdf5 chunks so each chunk is only decompressed once
+                chunk_rows = dataset.chunks[0]
+                block_rows = max(1, block_rows // chunk_rows) * chunk_rows
+            self._block_rows[ds_key] = block_rows
+        return self._block_rows[ds_key]
+
+    def _get_block(self, ds_key, dataset, block_num, block_rows):
+        block_key = (ds_key, block_num)
+        block = self._blocks.get(block_key, None)
+        if block is not None:
+            self._hits += 1
+            self._blocks[block_key] = self._blocks.pop(block_key)  # move to the end of the LRU queue
+            return block
+
+        self._misses += 1
+        block_beg = block_num*block_rows
+        block = self._load(dataset, block_beg, min(block_beg + block_rows, dataset.shape[0]))
+        block.flags.writeable = False  # rows/slices of a block are returned as views, don't let them be modified
+        self._blocks[block_key] = block
+        self._nbytes += block.nbytes
+        self._evict()
+        return block
+
+    def _load(self, dataset, row_beg, row_end):
+        values = dataset[row_beg:row_end]
+        self._bytes_loaded += values.nbytes
+        return values
+
+    def _load_indicies(self, dataset, indicies):
+        values = read_indicies(dataset, indicies)
+        self._bytes_loaded += values.nbytes
+        return values
+
+    def _evict(self):
+        # Always keep the most recent block, even if it's bigger than max_bytes
+        while self._nbytes > self._max_bytes and len(self._blocks) > 1:
+            _, block = self._blocks.popitem(last=False)
+            self._nbytes -= block.nbytes
+            self._evictions += 1
+
+        if self._max_bytes <= 0:
+            self.clear()
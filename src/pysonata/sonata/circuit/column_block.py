@@ -0,0 +1,134 @@
+# Copyright 2019. Allen Institute. All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+# disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following
+# disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+import numpy as np
+
+
+class ColumnBlock(object):
+    """The values of a block of population rows, shared by all the Node/Edge records created for those rows.
+
+    Columns are only read when a record first asks for them, and then the values for the entire block are read at
+    once, so iterating through N rows in blocks of B only goes back to the hdf5 file N/B times for each column used.
+    The records themselves just store a reference to the block and their offset within it.
+    """
+    def __init__(self, population, row_indicies=None, row_range=None):
+        """
+        :param population: the NodePopulation or EdgePopulation
+        :param row_indicies: array of population rows in the block, or
+        :param row_range: a contiguous (row_beg, row_end) range of population rows
+        """
+        self._population = population
+        self._group_id_column = population.group_id_column
+        self._types_table = population.types_table
+        if row_range is not None:
+            self._row_range = (int(row_range[0]), int(row_range[1]))
+            self._row_indicies = None
+            self._nrows = self._row_range[1] - self._row_range[0]
+        else:
+            self._row_range = None
+            self._row_indicies = np.asarray(row_indicies, dtype=np.int64).reshape(-1)
+            self._nrows = len(self._row_indicies)
+
+        self._columns = {}  # population column name --> values for every row in the block
+        self._group_values = {}  # (group_id, column name) --> values for the rows of the block in the group
+        self._group_rows = None  # group_id --> rows of the block that belong to the group
+        self._group_positions = None  # position of each row within the rows of its group
+
+    @property
+    def population(self):
+        return self._population
+
+    def row_index(self, offset):
+        """Population row of a record in the block"""
+        if self._row_range is not None:
+            return self._row_range[0] + offset
+        return int(self._row_indicies[offset])
+
+    def column(self, column_name):
+        """Values of a population column (eg. node_id, edge_type_id) for every row in the block"""
+        values = self._columns.get(column_name, None)
+        if values is None:
+            values = self._population._read_columns([column_name], row_indicies=self._row_indicies,
+                                                    row_range=self._row_range)[column_name]
+            self._columns[column_name] = values
+        return values
+
+    def value(self, column_name, offset):
+        """Returns the value of a population column for a single record"""
+        return self.column(column_name)[offset]
+
+    def group(self, offset):
+        return self._population.get_group(self.column(self._group_id_column)[offset])
+
+    def group_value(self, group, column_name, offset):
+        """Returns the value of a group column for a single record, the record must belong to the group"""
+        key = (group.group_id, column_name)
+        values = self._group_values.get(key, None)
+        if values is None:
+            if self._group_rows is None:
+                self._find_group_rows()
+            grp_rows = self._group_rows[group.group_id]
+            grp_indicies = self.column(self._population.group_index_column)[grp_rows]
+            values = self._population.cache.read(group.get_dataset(column_name), grp_indicies)
+            self._group_values[key] = values
+        return values[self._group_positions[offset]]
+
+    def group_props(self, offset):
+        """dictionary of all the group columns for a single record"""
+        grp = self.group(offset)
+        return {c.name: self.group_value(grp, c.name, offset) for c in grp.group_columns}
+
+    def types_props(self, offset):
+        """dictionary of the types-table columns for a single record"""
+        return self._types_table[self.column(self._population.type_ids_column)[offset]]
+
+    def get(self, property_name, offset):
+        """Finds the value of a property for a single record, checking the record's group first, then the types
+        table and finally the population columns. Raises a KeyError if the property can't be found.
+        """
+        grp = self.group(offset)
+        if property_name in grp:
+            return self.group_value(grp, property_name, offset)
+
+        types_props = self.types_props(offset)
+        if property_name in types_props:
+            return types_props[property_name]
+
+        if self._population.is_population_column(property_name):
+            return self.value(property_name, offset)
+
+        raise KeyError('Unknown property {}'.format(property_name))
+
+    def contains(self, property_name, offset):
+        return property_name in self.group(offset) or property_name in self.types_props(offset)
+
+    def _find_group_rows(self):
+        group_ids = self.column(self._group_id_column)
+        self._group_rows = {}
+        self._group_positions = np.empty(self._nrows, dtype=np.int64)
+        for grp_id in np.unique(group_ids):
+            grp_rows = np.flatnonzero(group_ids == grp_id)
+            self._group_rows[grp_id] = grp_rows
+            self._group_positions[grp_rows] = np.arange(len(grp_rows))
+
+    def __len__(self):
+        return self._nrows
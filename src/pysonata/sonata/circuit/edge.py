@@ -20,79 +20,144 @@
 # WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
+import numpy as np
+import pandas as pd
+
+
 class EdgeSet(object):
-    def __init__(self, edge_ids, population):
-        self._edge_ids = edge_ids
+    """A selection of edges within a population, stored as an array of population row indicies (see NodeSet)."""
+    def __init__(self, edge_indicies, population):
+        self._indicies = np.asarray(edge_indicies, dtype=np.int64).reshape(-1)
+        self._n_edges = len(self._indicies)
         self._population = population
-        self._n_edges = len(self._edge_ids)
-        self.__itr = 0
+        self.__itr = None
+
+    @property
+    def population(self):
+        return self._population
+
+    @property
+    def row_indicies(self):
+        return self._indicies
+
+    @property
+    def source_node_ids(self):
+        return self._population.iproperties('source_node_id', self._indicies)
+
+    @property
+    def target_node_ids(self):
+        return self._population.iproperties('target_node_id', self._indicies)
+
+    @property
+    def edge_type_ids(self):
+        return self._population.itype_ids(self._indicies)
+
+    @property
+    def group_ids(self):
+        return self._population.igroup_ids(self._indicies)
+
+    def get_properties(self, property_name):
+        """Returns an array of values of a property for every edge in the set.
+
+        :param property_name: name of a group, edge-types or population (source_node_id, edge_type_id, etc) column
+        :return: A numpy array, in the same order as the EdgeSet
+        """
+        return self._population.iproperties(property_name, self._indicies)
+
+    def to_dataframe(self, columns=None):
+        """Returns a pandas DataFrame of the selected edges, one row for every edge. If an edge's group doesn't contain
+        one of the columns its value will be NaN.
+
+        :param columns: list of columns to include, by default all population, group and edge-types columns
+        :return: A pandas DataFrame, in the same order as the EdgeSet
+        """
+        columns = self._population.default_columns() if columns is None else list(columns)
+        chunks = list(self.iter_chunks(columns=columns, as_dataframe=True))
+        if len(chunks) == 0:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(chunks, ignore_index=True) if len(chunks) > 1 else chunks[0]
+
+    def iter_chunks(self, batch_size=None, columns=None, as_dataframe=False):
+        """Iterates through the selected edges in blocks, see EdgePopulation.iter_chunks()"""
+        return self._population.iter_chunks(batch_size=batch_size, columns=columns, as_dataframe=as_dataframe,
+                                            row_indicies=self._indicies)
+
+    def sample(self, n=None, frac=None, stratify_by=None, seed=None):
+        """Returns a random sample of the edges in the set as a new EdgeSet, see EdgePopulation.sample()"""
+        return EdgeSet(self._population._sample_rows(n, frac, stratify_by, seed, row_indicies=self._indicies),
+                       self._population)
+
+    def __len__(self):
+        return self._n_edges
 
     def __iter__(self):
-        self.__itr = 0
+        self.__itr = self._population._iter_rows(self._indicies)
         return self
 
     def next(self):
-        if self.__itr >= self._n_edges:
-            raise StopIteration
+        return self.__next__()
 
-        next_edge = self._population.iloc(self._edge_ids[self.__itr])
-        self.__itr += 1
-        return next_edge
+    def __next__(self):
+        return next(self.__itr)
 
 
 class Edge(object):
-    def __init__(self, src_node_id, trg_node_id, source_pop, target_pop, group_id, group_props, edge_types_props):
-        self._src_node_id = src_node_id
-        self._trg_node_id = trg_node_id
-        self._source_population = source_pop
-        self._target_population = target_pop
-        self._group_props = group_props
-        self._group_id = group_id
-        self._edge_type_props = edge_types_props
+    """A single edge, a lightweight view of one row of a ColumnBlock (see Node)"""
+    __slots__ = ('_block', '_offset')
+
+    def __init__(self, block, offset):
+        self._block = block
+        self._offset = offset
 
     @property
     def source_node_id(self):
-        return self._src_node_id
+        return self._block.value('source_node_id', self._offset)
 
     @property
     def target_node_id(self):
-        return self._trg_node_id
+        return self._block.value('target_node_id', self._offset)
 
     @property
     def source_population(self):
-        return self._source_population
+        return self._block.population.source_population
 
     @property
     def target_population(self):
-        return self._target_population
+        return self._block.population.target_population
 
     @property
     def group_id(self):
-        return self._group_id
+        return self._block.value('edge_group_id', self._offset)
 
     @property
     def edge_type_id(self):
-        return self._edge_type_props['edge_type_id']
+        return self._block.value('edge_type_id', self._offset)
+
+    @property
+    def group_props(self):
+        return self._block.group_props(self._offset)
+
+    @property
+    def edge_type_properties(self):
+        return self._block.types_props(self._offset)
 
     @property
     def dynamics_params(self):
         raise NotImplementedError
 
     def __getitem__(self, prop_key):
-        if prop_key in self._group_props:
-            return self._group_props[prop_key]
-        elif prop_key in self._edge_type_props:
-            return self._edge_type_props[prop_key]
-        else:
+        try:
+            return self._block.get(prop_key, self._offset)
+        except KeyError:
             raise KeyError('Property {} not found in edge.'.format(prop_key))
 
     def __repr__(self):
         return self.__str__()
 
     def __str__(self):
-        ret_dict = self._edge_type_props.copy()
-        ret_dict.update(self._group_props)
+        ret_dict = self.edge_type_properties.copy()
+        ret_dict.update(self.group_props)
         return str(ret_dict)
 
     def __contains__(self, prop_key):
-        return prop_key in self._group_props or prop_key in self._edge_type_props
+        return self._block.contains(prop_key, self._offset)
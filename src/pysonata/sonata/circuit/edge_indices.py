@@ -0,0 +1,270 @@
+# Copyright 2019. Allen Institute. All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+# disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following
+# disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+"""Tools for adding the source_to_target and target_to_source indices to a SONATA edges file.
+
+    from sonata.circuit.edge_indices import add_edge_indices
+    stats = add_edge_indices('edges.h5', population='v1_to_v1')
+
+Both indices are built with an external-memory sort, so only a bounded number of edges (and one count per node) are
+kept in memory at any time and files larger than RAM can be indexed.
+"""
+import os
+import time
+import shutil
+import tempfile
+import h5py
+import numpy as np
+import six
+
+from .utils import range_itr
+
+
+# Max number of edges (when sorting) or ranges (when merging) held in memory at one time
+SORT_CHUNK_SIZE = 2**22
+
+# Number of rows in each hdf5 chunk of the index datasets. Every lookup reads one node_id_to_range row followed by
+# a few range_to_edge_id rows, so keep the chunks small (64 KB) so a lookup only decompresses a couple of them.
+INDEX_CHUNK_ROWS = 4096
+
+# index name --> the population dataset it is built from
+INDEX_DIRECTIONS = {
+    'source_to_target': 'source_node_id',
+    'target_to_source': 'target_node_id'
+}
+
+
+def add_edge_indices(edges_h5, population=None, directions=('source_to_target', 'target_to_source'),
+                     overwrite=False, chunk_size=None, tmp_dir=None, chunk_rows=INDEX_CHUNK_ROWS, compression='gzip',
+                     compression_opts=None, verbose=False):
+    """Builds the indices of an edge population and writes them into the edges file under
+    /edges/<population>/indices/<direction>/{node_id_to_range,range_to_edge_id}, the layout read by EdgePopulation.
+
+    The node_id column is read one chunk at a time, and each run of consecutive edges with the same node_id becomes
+    one range of edge rows. The ranges of every chunk are sorted by node_id and saved to a temporary file, then the
+    files are merged (memory mapped) one block of node_ids at a time and written out in order. The ranges of each node
+    are stored in row order.
+
+    :param edges_h5: path of the edges hdf5 file, or a h5py.File opened in a writable mode
+    :param population: name of the edge population, may be None if the file only has one population
+    :param directions: one or both of 'source_to_target' and 'target_to_source'
+    :param overwrite: replace an index if it already exists, otherwise a ValueError is raised
+    :param chunk_size: max number of edges sorted in memory at one time (default SORT_CHUNK_SIZE)
+    :param tmp_dir: directory for the temporary sort files, by default the system's temp directory
+    :param chunk_rows: number of rows in each hdf5 chunk of the index datasets, if None and compression is None the
+        datasets are stored contiguously (which allows them to be memory mapped when the file is opened)
+    :param compression: hdf5 compression filter for the index datasets ('gzip', 'lzf' or None)
+    :param compression_opts: options for the compression filter, eg. the gzip level
+    :param verbose: print the throughput of building each index
+    :return: dictionary of direction --> dictionary of statistics (number of edges, nodes and ranges, the time spent
+        sorting and merging, and the throughput in edges per second)
+    """
+    directions = [directions] if isinstance(directions, six.string_types) else list(directions)
+    for direction in directions:
+        if direction not in INDEX_DIRECTIONS:
+            raise ValueError('Unknown index {}, must be one of {}.'.format(direction, sorted(INDEX_DIRECTIONS)))
+
+    chunk_size = chunk_size or SORT_CHUNK_SIZE
+    h5 = edges_h5 if isinstance(edges_h5, h5py.File) else h5py.File(edges_h5, 'r+')
+    try:
+        pop_grp = _get_population(h5, population)
+        if 'indicies' in pop_grp and 'indices' not in pop_grp:
+            # older files use the misspelled group name, add to it so the existing indices are still found
+            indices_grp = pop_grp['indicies']
+        else:
+            indices_grp = pop_grp.require_group('indices')
+
+        for direction in directions:
+            if direction in indices_grp and not overwrite:
+                raise ValueError('Index {} already exists in {}, use overwrite=True to replace it.'.format(
+                    direction, pop_grp.name))
+
+        dataset_opts = _dataset_options(chunk_rows, compression, compression_opts)
+        index_stats = {}
+        for direction in directions:
+            if direction in indices_grp:
+                del indices_grp[direction]
+            index_grp = indices_grp.create_group(direction)
+            stats = _build_index(pop_grp[INDEX_DIRECTIONS[direction]], index_grp, chunk_size, tmp_dir, dataset_opts)
+            index_stats[direction] = stats
+            if verbose:
+                print('Built {} index of {}: {} edges, {} nodes, {} ranges in {:.2f} s ({:.3g} edges/s)'.format(
+                    direction, pop_grp.name, stats['n_edges'], stats['n_nodes'], stats['n_ranges'],
+                    stats['total_time'], stats['edges_per_sec']))
+
+    finally:
+        if not isinstance(edges_h5, h5py.File):
+            h5.close()
+
+    return index_stats
+
+
+def _get_population(h5, population):
+    pops = list(h5['/edges'].keys()) if '/edges' in h5 else []
+    if population is None:
+        if len(pops) != 1:
+            raise ValueError('File {} contains edge populations {}, please specify one.'.format(h5.filename, pops))
+        population = pops[0]
+    elif population not in pops:
+        raise ValueError('Could not find edge population {} in {}.'.format(population, h5.filename))
+
+    return h5['/edges'][population]
+
+
+def _dataset_options(chunk_rows, compression, compression_opts):
+    if chunk_rows is None and compression is None:
+        return {}
+
+    opts = {'chunks': (chunk_rows or INDEX_CHUNK_ROWS, 2)}
+    if compression is not None:
+        # the ranges are increasing integers, shuffling the bytes makes them compress much better
+        opts.update(compression=compression, compression_opts=compression_opts, shuffle=True)
+    return opts
+
+
+def _create_dataset(grp, name, n_rows, dataset_opts):
+    opts = dict(dataset_opts)
+    if 'chunks' in opts:
+        if n_rows == 0:
+            # chunked datasets can't be empty unless they are resizable
+            opts['maxshape'] = (None, 2)
+        else:
+            opts['chunks'] = (min(opts['chunks'][0], n_rows), 2)
+    return grp.create_dataset(name, shape=(n_rows, 2), dtype=np.uint64, **opts)
+
+
+def _build_index(node_ids_ds, index_grp, chunk_size, tmp_dir, dataset_opts):
+    """Sorts the edge ranges of a source/target_node_id dataset and writes the index into index_grp"""
+    time_beg = time.time()
+    sort_dir = tempfile.mkdtemp(prefix='sonata_edge_index.', dir=tmp_dir)
+    try:
+        run_files, node_counts = _sort_runs(node_ids_ds, sort_dir, chunk_size)
+        time_sorted = time.time()
+
+        n_nodes = len(node_counts)
+        node_offsets = np.concatenate(([0], np.cumsum(node_counts))).astype(np.int64)
+        node_id_to_range = _create_dataset(index_grp, 'node_id_to_range', n_nodes, dataset_opts)
+        for node_beg in range_itr(0, n_nodes, chunk_size):
+            node_end = min(node_beg + chunk_size, n_nodes)
+            node_id_to_range[node_beg:node_end] = np.column_stack((node_offsets[node_beg:node_end],
+                                                                   node_offsets[(node_beg + 1):(node_end + 1)]))
+
+        range_to_edge_id = _create_dataset(index_grp, 'range_to_edge_id', int(node_offsets[-1]), dataset_opts)
+        _merge_runs(run_files, node_offsets, range_to_edge_id, chunk_size)
+
+    finally:
+        shutil.rmtree(sort_dir, ignore_errors=True)
+
+    time_end = time.time()
+    n_edges = node_ids_ds.shape[0]
+    total_time = time_end - time_beg
+    return {
+        'n_edges': n_edges,
+        'n_nodes': n_nodes,
+        'n_ranges': int(node_offsets[-1]),
+        'sort_time': time_sorted - time_beg,
+        'merge_time': time_end - time_sorted,
+        'total_time': total_time,
+        'edges_per_sec': n_edges/total_time if total_time > 0 else float('inf')
+    }
+
+
+def _sort_runs(node_ids_ds, sort_dir, chunk_size):
+    """Finds the runs of consecutive edges with the same node_id, one chunk of the dataset at a time. The runs of each
+    chunk are sorted by node_id and saved to sort_dir.
+
+    :return: list of (node_ids file, ranges file) for each chunk, and an array of the number of runs of each node
+    """
+    n_edges = node_ids_ds.shape[0]
+    run_files = []
+    node_counts = np.zeros(0, dtype=np.int64)
+    carry = None  # (beg, node_id) of the last run of the previous chunk, which may continue into the next chunk
+    for chunk_beg in range_itr(0, n_edges, chunk_size):
+        chunk_end = min(chunk_beg + chunk_size, n_edges)
+        node_ids = np.asarray(node_ids_ds[chunk_beg:chunk_end], dtype=np.int64)
+        if np.any(node_ids < 0):
+            raise ValueError('Invalid (negative) node_id in {}.'.format(node_ids_ds.name))
+
+        run_starts = np.concatenate(([0], np.flatnonzero(np.diff(node_ids)) + 1))
+        run_begs = run_starts + chunk_beg
+        run_ends = np.concatenate((run_begs[1:], [chunk_end]))
+        run_ids = node_ids[run_starts]
+        if carry is not None:
+            if run_ids[0] == carry[1]:
+                run_begs[0] = carry[0]
+            else:
+                run_begs = np.concatenate(([carry[0]], run_begs))
+                run_ends = np.concatenate(([chunk_beg], run_ends))
+                run_ids = np.concatenate(([carry[1]], run_ids))
+
+        carry = (run_begs[-1], run_ids[-1])
+        node_counts = _save_runs(sort_dir, run_files, run_ids[:-1], run_begs[:-1], run_ends[:-1], node_counts)
+
+    if carry is not None:
+        node_counts = _save_runs(sort_dir, run_files, np.array([carry[1]]), np.array([carry[0]]), np.array([n_edges]),
+                                 node_counts)
+
+    return run_files, node_counts
+
+
+def _save_runs(sort_dir, run_files, run_ids, run_begs, run_ends, node_counts):
+    if len(run_ids) == 0:
+        return node_counts
+
+    # runs are already ordered by row, a stable sort keeps the ranges of each node in row order
+    order = np.argsort(run_ids, kind='stable')
+    ids_path = os.path.join(sort_dir, 'runs_{}.ids.npy'.format(len(run_files)))
+    ranges_path = os.path.join(sort_dir, 'runs_{}.ranges.npy'.format(len(run_files)))
+    np.save(ids_path, run_ids[order])
+    np.save(ranges_path, np.column_stack((run_begs[order], run_ends[order])).astype(np.uint64))
+    run_files.append((ids_path, ranges_path))
+
+    chunk_counts = np.bincount(run_ids)
+    if len(chunk_counts) > len(node_counts):
+        node_counts = np.concatenate((node_counts, np.zeros(len(chunk_counts) - len(node_counts), dtype=np.int64)))
+    node_counts[:len(chunk_counts)] += chunk_counts
+    return node_counts
+
+
+def _merge_runs(run_files, node_offsets, range_to_edge_id, block_size):
+    """Merges the sorted runs of every chunk, writing the ranges of up to block_size nodes at a time"""
+    runs = [(np.load(ids_path, mmap_mode='r'), np.load(ranges_path, mmap_mode='r'))
+            for ids_path, ranges_path in run_files]
+    n_nodes = len(node_offsets) - 1
+    node_beg = 0
+    while node_beg < n_nodes:
+        # as many nodes as have block_size ranges between them, but always at least one
+        node_end = int(np.searchsorted(node_offsets, node_offsets[node_beg] + block_size, side='right')) - 1
+        node_end = min(max(node_end, node_beg + 1), n_nodes)
+
+        block_ranges = []
+        for run_ids, run_ranges in runs:
+            run_beg, run_end = np.searchsorted(run_ids, [node_beg, node_end])
+            block_ranges.append((run_ids[run_beg:run_end], run_ranges[run_beg:run_end]))
+
+        block_ids = np.concatenate([ids for ids, _ in block_ranges])
+        if len(block_ids) > 0:
+            # the chunk files are in row order so a stable sort keeps the ranges of each node in row order
+            order = np.argsort(block_ids, kind='stable')
+            range_to_edge_id[node_offsets[node_beg]:node_offsets[node_end]] = \
+                np.concatenate([ranges for _, ranges in block_ranges])[order]
+        node_beg = node_end
@@ -22,10 +22,13 @@
 #
 from . import utils
 from .file_root import NodesRoot, EdgesRoot
+from .cache import ColumnCache, DEFAULT_CACHE_SIZE
+from .index_cache import as_index_cache
 
 
 class File(object):
-    def __init__(self, data_files, data_type_files, mode='r', gid_table=None, require_magic=True):
+    def __init__(self, data_files, data_type_files, mode='r', gid_table=None, require_magic=True,
+                 cache_size=DEFAULT_CACHE_SIZE, index_cache=None, use_memmap=True):
         if mode != 'r':
             raise Exception('Currently only read mode is supported.')
 
@@ -51,6 +54,16 @@ class File(object):
 
         self._csv_file_handles = [(f, utils.load_csv(f)) for f in self._data_type_files]
 
+        # Cache of population/group dataset blocks, shared by all the node and edge populations. 0 to disable.
+        self._cache = ColumnCache(max_bytes=cache_size)
+
+        # Optional on-disk store of derived indices (node_id lookups, group indicies). Either True (stored next to the
+        # hdf5 files), 'shm' (shared between all the processes on a host), a directory or an IndexCache object.
+        self._index_cache = as_index_cache(index_cache)
+
+        # Read contiguous, uncompressed datasets through a memory map rather than h5py (see utils.memmap_dataset)
+        self._use_memmap = use_memmap
+
         self._has_nodes = False
         self._nodes = None  # /nodes object
         self._nodes_groups = []  # list of all hdf5 /nodes group
@@ -69,10 +82,12 @@ class File(object):
             raise Exception('Could not find neither nodes nor edges for the given file(s).')
 
         if self._has_nodes:
-            self._nodes = NodesRoot(nodes=self._nodes_groups, node_types=self._node_types_dataframes, gid_table=gid_table)
+            self._nodes = NodesRoot(nodes=self._nodes_groups, node_types=self._node_types_dataframes, gid_table=gid_table,
+                                    cache=self._cache, index_cache=self._index_cache, use_memmap=self._use_memmap)
 
         if self._has_edges:
-            self._edges = EdgesRoot(edges=self._edges_groups, edge_types=self._edge_types_dataframes)
+            self._edges = EdgesRoot(edges=self._edges_groups, edge_types=self._edge_types_dataframes, cache=self._cache,
+                                    index_cache=self._index_cache, use_memmap=self._use_memmap)
 
     @property
     def nodes(self):
@@ -94,6 +109,15 @@ class File(object):
     def version(self):
         return self._version
 
+    @property
+    def cache(self):
+        """The ColumnCache used when reading the node and edge datasets, see cache.stats for hits/misses"""
+        return self._cache
+
+    @property
+    def index_cache(self):
+        return self._index_cache
+
     def _sort_types_file(self):
         # TODO: node/edge type_id columnn names should not be hardcoded
         for filename, df in self._csv_file_handles:
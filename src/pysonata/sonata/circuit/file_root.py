@@ -30,18 +30,25 @@ import numpy as np
 from . import utils
 from .population import NodePopulation, EdgePopulation
 from .types_table import NodeTypesTable, EdgeTypesTable
+from .cache import ColumnCache
 
 
 class FileRoot(object):
     """Base class for both /nodes and /edges root group in h5 file"""
-    def __init__(self, root_name, h5_files, h5_mode, csv_files):
+    def __init__(self, root_name, h5_files, h5_mode, csv_files, cache=None, index_cache=None, use_memmap=True):
         """
         :param root_name: should either be 'nodes' or 'edges'
         :param h5_files: file (or list of files) containing nodes/edges
         :param h5_mode: currently only supporting 'r' mode in h5py
         :param csv_files: file (or list of files) containing node/edge types
+        :param cache: ColumnCache shared by the populations, if None a new cache is created
+        :param index_cache: IndexCache for storing the populations' derived indices on disk, None to disable
+        :param use_memmap: memory map the population datasets when possible rather than reading through h5py
         """
         self._root_name = root_name
+        self._cache = cache if cache is not None else ColumnCache()
+        self._index_cache = index_cache
+        self._use_memmap = use_memmap
         self._h5_handles = [utils.load_h5(f, h5_mode) for f in utils.listify(h5_files)]
         self._csv_handles = [(f, utils.load_csv(f)) for f in utils.listify(csv_files)]
 
@@ -76,6 +83,14 @@ class FileRoot(object):
     def types_table(self):
         return self._types_table
 
+    @property
+    def cache(self):
+        return self._cache
+
+    @property
+    def index_cache(self):
+        return self._index_cache
+
     @types_table.setter
     def types_table(self, types_table):
         self._types_table = types_table
@@ -128,8 +143,9 @@ class FileRoot(object):
 
 
 class NodesRoot(FileRoot):
-    def __init__(self, nodes, node_types, mode='r', gid_table=None):
-        super(NodesRoot, self).__init__('nodes', h5_files=nodes, h5_mode=mode, csv_files=node_types)
+    def __init__(self, nodes, node_types, mode='r', gid_table=None, cache=None, index_cache=None, use_memmap=True):
+        super(NodesRoot, self).__init__('nodes', h5_files=nodes, h5_mode=mode, csv_files=node_types, cache=cache,
+                                        index_cache=index_cache, use_memmap=use_memmap)
 
         # load the gid <--> (node_id, population) map if specified.
         self._gid_table = gid_table
@@ -159,49 +175,63 @@ class NodesRoot(FileRoot):
 
         self._gid_table = utils.load_h5(gid_table, 'r')
         # TODO: validate that the correct columns/dtypes exists.
-        gid_df = pd.DataFrame()
-        gid_df['gid'] = pd.Series(data=self._gid_table['gid'], dtype=self._gid_table['gid'].dtype)
-        gid_df['node_id'] = pd.Series(data=self._gid_table['node_id'], dtype=self._gid_table['node_id'].dtype)
-        gid_df['population'] = pd.Series(data=self._gid_table['population'])
-        population_names_ds = self._gid_table['population_names']
-        for pop_id, subset in gid_df.groupby(by='population'):
-            pop_name = population_names_ds[pop_id]
-            self._gid_table_groupby[pop_name] = subset
+        gids = np.asarray(self._gid_table['gid'][()])
+        node_ids = np.asarray(self._gid_table['node_id'][()])
+        pop_ids = np.asarray(self._gid_table['population'][()])
+        population_names = [n.decode() if isinstance(n, bytes) else n for n in self._gid_table['population_names'][()]]
+
+        # split table by population, keeping (gids, node_ids) arrays for each
+        self._gid_table_groupby = {}
+        order = np.argsort(pop_ids, kind='stable')
+        pop_splits = np.flatnonzero(np.diff(pop_ids[order])) + 1
+        for pop_rows in np.split(order, pop_splits):
+            if len(pop_rows) > 0:
+                pop_name = population_names[pop_ids[pop_rows[0]]]
+                self._gid_table_groupby[pop_name] = (gids[pop_rows], node_ids[pop_rows])
         self._has_gids = True
 
+        # Update any populations that have already been created, populations not in the table no longer have gids
+        for pop_name, pop_obj in self._populations_cache.items():
+            if pop_name in self._gid_table_groupby:
+                pop_obj.add_gids(*self._gid_table_groupby[pop_name], force=True)
+            else:
+                pop_obj.remove_gids()
+
     def generate_gids(self, file_name, gids=None, force=False):
         """Creates a gid <--> (node_id, population) table based on sonnet specifications.
 
-         Generating gids will take some time and so not recommend to call this during the simulation. Instead save
-         the file to the disk and pass in h5 file during the simulation (using gid_table parameter). In fact if you're
-         worried about efficeny don't use this method.
+        By default gids are assigned consecutively, starting at 0, going through each population in order. To use
+        a different assignment gids can be either
+
+          * a dictionary of population name --> offset (gids of the population will be offset, offset + 1, ...) or
+            an array of gids (one for every node, in the same order as the population)
+          * a function that takes a NodePopulation and returns an array of gids for each of its nodes.
+
+        Each population is written to the file in one block. Generating gids will still take some time for very large
+        networks so it's not recommend to call this during the simulation. Instead save the file to the disk and pass
+        in h5 file during the simulation (using gid_table parameter).
 
         :param file_name: Name of h5 file to save gid map to.
         :param gids: rule/list of gids to use
         :param force: set to true to overwrite existing gid map (default False).
         """
-
-        # TODO: This is very inefficent, fix (although not a priority as this function should be called sparingly)
-        # TODO: Allow users to pass in a list/function to determine gids
         # TODO: We should use an enumerated lookup table for population ds instead of storing strings
         # TODO: Move this to a utils function rather than a File
         if self.has_gids and not force:
             raise Exception('Nodes already have a gid table. Use force=True to overwrite existing gids.')
 
+        pop_name_list = [pname for pname in self.population_names]
+        pop_gids = self._assign_gids(pop_name_list, gids)
+        n_nodes = sum(len(g) for g in pop_gids)
+        if n_nodes > 0 and len(np.unique(np.concatenate(pop_gids))) != n_nodes:
+            raise Exception('Unable to generate gid table, gids are not unique.')
+
         dir_name = os.path.dirname(os.path.abspath(file_name))
         if not os.path.exists(dir_name):
             os.makedirs(dir_name)
 
         with h5py.File(file_name, 'w') as h5:
             # TODO: should we use mode 'x', or give an option to overwrite existing files
-            n_nodes = 0
-            ascii_len = 0  # store max population name for h5 fixed length strings
-            # Find population names and the total size of every population
-            for node_pop in self.populations:
-                n_nodes += len(node_pop)
-                name_nchars = len(node_pop.name)
-                ascii_len = ascii_len if ascii_len >= name_nchars else name_nchars
-
             # node_id and gid datasets should just be unsigned integers
             h5.create_dataset(name='gid', shape=(n_nodes,), dtype=np.uint64)
             h5.create_dataset(name='node_id', shape=(n_nodes,), dtype=np.uint64)
@@ -209,7 +239,6 @@ class NodesRoot(FileRoot):
             h5.create_dataset(name='population', shape=(n_nodes,), dtype=np.uint16)
 
             # Create a lookup table for pop-name
-            pop_name_list = [pname for pname in self.population_names]
             if utils.using_py3:
                 dt = h5py.special_dtype(vlen=str)  # python 3
             else:
@@ -219,42 +248,67 @@ class NodesRoot(FileRoot):
             for i, n in enumerate(pop_name_list):
                 h5['population_names'][i] = n
 
-            # write each (gid, node_id, population)
-            indx = 0
-            for node_pop in self.populations:
-                # TODO: Block write if special gid generator isn't being used
-                # TODO: Block write populations at least
-                pop_name = node_pop.name # encode('ascii', 'ignore')
-                pop_id = pop_name_list.index(pop_name)
-                for node in node_pop:
-                    h5['node_id'][indx] = node.node_id
-                    h5['population'][indx] = pop_id
-                    h5['gid'][indx] = indx
-                    indx += 1
+            # write (gid, node_id, population) for each population as a block
+            indx_beg = 0
+            for pop_id, (pop_name, gid_vals) in enumerate(zip(pop_name_list, pop_gids)):
+                indx_end = indx_beg + len(gid_vals)
+                h5['node_id'][indx_beg:indx_end] = self[pop_name].node_ids
+                h5['population'][indx_beg:indx_end] = pop_id
+                h5['gid'][indx_beg:indx_end] = gid_vals
+                indx_beg = indx_end
 
             # pass gid table to current nodes
-            self.set_gid_table(h5)
+            self.set_gid_table(h5, force=force)
+
+    def _assign_gids(self, pop_names, gids):
+        """Returns a list of gid arrays for each population (in the order of the population rows)"""
+        pop_gids = []
+        next_gid = 0
+        for pop_name in pop_names:
+            node_pop = self[pop_name]
+            if gids is None:
+                gid_vals = np.arange(next_gid, next_gid + len(node_pop), dtype=np.uint64)
+            elif callable(gids):
+                gid_vals = gids(node_pop)
+            elif pop_name not in gids:
+                raise Exception('gids not specified for node population {}.'.format(pop_name))
+            elif np.isscalar(gids[pop_name]):
+                gid_vals = np.arange(gids[pop_name], gids[pop_name] + len(node_pop), dtype=np.uint64)
+            else:
+                gid_vals = gids[pop_name]
+
+            gid_vals = np.asarray(gid_vals, dtype=np.uint64).reshape(-1)
+            if len(gid_vals) != len(node_pop):
+                raise Exception('Number of gids ({}) does not match the number of nodes in population {} ({}).'.format(
+                    len(gid_vals), pop_name, len(node_pop)))
+            pop_gids.append(gid_vals)
+            next_gid += len(node_pop)
+
+        return pop_gids
 
     def _build_types_table(self):
         self.types_table = NodeTypesTable()
         for _, csvhandle in self._csv_handles:
             self.types_table.add_table(csvhandle)
+        self.types_table.build_indicies()
 
     def _build_population(self, pop_name, pop_group):
-        return NodePopulation(pop_name, pop_group, self.node_types_table)
+        return NodePopulation(pop_name, pop_group, self.node_types_table, cache=self._cache,
+                              index_cache=self._index_cache, use_memmap=self._use_memmap)
 
     def __getitem__(self, population_name):
         # If their is a gids map then we must pass it into the population
         pop_obj = super(NodesRoot, self).__getitem__(population_name)
         if self.has_gids and (not pop_obj.has_gids) and (population_name in self._gid_table_groupby):
-            pop_obj.add_gids(self._gid_table_groupby[population_name])
+            pop_obj.add_gids(*self._gid_table_groupby[population_name])
 
         return pop_obj
 
 
 class EdgesRoot(FileRoot):
-    def __init__(self, edges, edge_types, mode='r'):
-        super(EdgesRoot, self).__init__(root_name='edges', h5_files=edges, h5_mode=mode, csv_files=edge_types)
+    def __init__(self, edges, edge_types, mode='r', cache=None, index_cache=None, use_memmap=True):
+        super(EdgesRoot, self).__init__(root_name='edges', h5_files=edges, h5_mode=mode, csv_files=edge_types,
+                                        cache=cache, index_cache=index_cache, use_memmap=use_memmap)
 
 
     @property
@@ -296,6 +350,8 @@ class EdgesRoot(FileRoot):
         self.types_table = EdgeTypesTable()
         for _, csvhandle in self._csv_handles:
             self.edge_types_table.add_table(csvhandle)
+        self.types_table.build_indicies()
 
     def _build_population(self, pop_name, pop_group):
-        return EdgePopulation(pop_name, pop_group, self.edge_types_table)
+        return EdgePopulation(pop_name, pop_group, self.edge_types_table, cache=self._cache,
+                              index_cache=self._index_cache, use_memmap=self._use_memmap)
@@ -24,8 +24,10 @@ import numpy as np
 import pandas as pd
 
 from .column_property import ColumnProperty
+from .query import build_query, check_columns
 from .node import Node, NodeSet
 from .edge import Edge, EdgeSet
+from .utils import expand_ranges, FILTER_CHUNK_SIZE
 
 
 class Group(object):
@@ -46,7 +48,7 @@ class Group(object):
         # TODO: combine group_columns, group_column_names and group_columns_map, doesn't need to be 3 structures
         self._group_column_map = {col.name: col for col in self._group_columns}
         self._group_column_names = set(col.name for col in self._group_columns)
-        self._group_table = {prop: h5_group[prop.name] for prop in self._group_columns}
+        self._group_table = {prop: parent.open_dataset(h5_group[prop.name]) for prop in self._group_columns}
         self._ncolumns = len(self._group_columns)
 
         self._all_columns = self._group_columns + self._types_table.columns
@@ -103,6 +105,11 @@ class Group(object):
         else:
             return KeyError
 
+    def has_property(self, property_name):
+        """Check if property_name is a column in either the group or the types table (or one of the population's
+        columns like node_id/node_type_id)."""
+        return property_name in self._all_column_names or self._parent.is_population_column(property_name)
+
     def check_format(self):
         # Check that all the properties have the same number of rows
         col_counts = [col.nrows for col in self._group_columns + self._dynamics_params_columns]
@@ -118,6 +125,22 @@ class Group(object):
     def to_dataframe(self):
         raise NotImplementedError
 
+    def iter_chunks(self, batch_size=None, columns=None, as_dataframe=False):
+        """Iterates through all the members of the group in blocks of rows, see Population.iter_chunks()
+
+        :param batch_size: maximum number of rows in each block.
+        :param columns: list of columns to return, by default all population, group and types-table columns.
+        :param as_dataframe: return each block as a pandas DataFrame instead of a dictionary of numpy arrays.
+        :return: A generator of {column_name: array of values} dictionaries (or DataFrames)
+        """
+        columns = self._parent.default_columns(self.group_id) if columns is None else columns
+        return self._parent.iter_chunks(batch_size=batch_size, columns=columns, as_dataframe=as_dataframe,
+                                        row_indicies=self._population_rows())
+
+    def _population_rows(self):
+        """Array of all the population rows belonging to the group"""
+        raise NotImplementedError
+
     def get_values(self, property_name, all_rows=False):
         """Returns all values for a group property.
 
@@ -136,9 +159,10 @@ class Group(object):
         return self._nrows
 
     def __getitem__(self, group_index):
+        read_row = self._parent.cache.read_row
         group_props = {}
         for cname, h5_obj in self._group_table.items():
-            group_props[cname] = h5_obj[group_index]
+            group_props[cname] = read_row(h5_obj, group_index)
         return group_props
 
     def __contains__(self, prop_name):
@@ -177,6 +201,10 @@ class NodeGroup(Group):
         self._parent_indicies = self._parent.group_indicies(self.group_id, build_cache=True)
         self._parent_indicies_built = True
 
+    def _population_rows(self):
+        self.build_indicies()
+        return self._parent_indicies
+
     def get_values(self, property_name, filtered_indicies=True):
         self.build_indicies()
         # TODO: Check if property_name is node_id, node_type, or gid
@@ -188,127 +216,89 @@ class NodeGroup(Group):
             else:
                 # Return only those values for group indicies with associated nodes
                 grp_indicies = self._parent.igroup_indicies(self._parent_indicies)
-                # It is possible that the group_index is unorderd or contains duplicates which will cause h5py slicing
-                # to fail. Thus convert to a numpy array
-                # TODO: loading the entire table is not good if the filtered nodes is small, consider building.
-                tmp_array = np.array(self._group_table[property_name])
-                return tmp_array[grp_indicies]
+                return self._parent.cache.read(self._group_table[property_name], grp_indicies)
 
         elif property_name in self._parent.node_types_table.columns:
-            # For properties that come from node-types table we need to build the results from scratch
-            # TODO: Need to performance test, I think this code could be optimized.
-            node_types_table = self._parent.node_types_table
-            nt_col = node_types_table.column(property_name)
-            tmp_array = np.empty(shape=len(self._parent_indicies), dtype=nt_col.dtype)
-            for i, ntid in enumerate(self.node_type_ids):
-                tmp_array[i] = node_types_table[ntid][property_name]
+            # For properties that come from node-types table broadcast the node-type values onto every node
+            return self._parent.node_types_table.broadcast(property_name, self.node_type_ids)
 
-            return tmp_array
+    def to_dataframe(self, columns=None, row_indicies=None):
+        """Returns a pandas DataFrame of the nodes in the group, with one row for every node.
 
-    def to_dataframe(self):
-        self.build_indicies()
+        Only the datasets needed for the selected columns are read. Columns from the node-types table (and string
+        group columns) are returned as categorical columns.
 
-        # Build a dataframe of group properties
-        # TODO: Include dynamics_params?
-        properties_df = pd.DataFrame()
-        for col in self._group_columns:
-            #if col.dimension > 1:
-            #    for i in range(col.dimension):
-            #        # TODO: see if column name exists in the attributes
-            #        col_name = '{}.{}'.format(col.name, i)
-            #        properties_df[col_name] = pd.Series(self._h5_group[col.name][:, i])
-            #else:
-                properties_df[col.name] = pd.Series(self._h5_group[col.name])
+        :param columns: list of column names to include. By default includes node_type_id, node_id, gid (if
+            available), all the group columns and all the node-types columns.
+        :param row_indicies: population rows (which must belong to this group) to include, by default all nodes in the
+            group in the same order as in the population.
+        :return: A pandas DataFrame
+        """
+        if row_indicies is None:
+            self.build_indicies()
+            row_indicies = self._parent_indicies
+        row_indicies = np.asarray(row_indicies, dtype=np.int64)
 
-        # Build a dataframe of parent node (node_id, gid, node_types, etc)
-        root_df = pd.DataFrame()
-        root_df['node_type_id'] = pd.Series(self.node_type_ids)
-        root_df['node_id'] = pd.Series(self.node_ids)
-        root_df['node_group_index'] = pd.Series(self._parent.igroup_indicies(self._parent_indicies))  # used as pivot
-        if self._parent.has_gids:
-            root_df['gid'] = self.gids
+        node_types_table = self._parent.node_types_table
+        if columns is None:
+            # TODO: Include dynamics_params?
+            columns = ['node_type_id', 'node_id'] + (['gid'] if self._parent.has_gids else [])
+            columns += [col.name for col in self._group_columns]
+            columns += [col.name for col in node_types_table.columns if col not in self._group_columns]
+
+        results_df = pd.DataFrame(index=pd.RangeIndex(len(row_indicies)))
+        node_type_ids = None
+        grp_indicies = None
+        for col_name in columns:
+            if col_name == 'gid':
+                col_vals = self._parent.igids(row_indicies)
+
+            elif col_name in self._group_column_names:
+                grp_indicies = self._parent.igroup_indicies(row_indicies) if grp_indicies is None else grp_indicies
+                col_vals = self._parent.cache.read(self._group_table[col_name], grp_indicies)
+                if col_vals.dtype.kind in 'OS':
+                    col_vals = pd.Categorical(col_vals)
+
+            elif self._parent.is_population_column(col_name):
+                col_vals = self._parent.iproperties(col_name, row_indicies)
+
+            elif col_name in node_types_table.columns:
+                node_type_ids = self._parent.inode_type_ids(row_indicies) if node_type_ids is None else node_type_ids
+                col_vals = node_types_table.broadcast(col_name, node_type_ids, categorical=True)
 
-        # merge group props df with parent df
-        results_df = root_df.merge(properties_df, how='left', left_on='node_group_index', right_index=True)
-        results_df = results_df.drop('node_group_index', axis=1)
+            else:
+                raise KeyError('Unknown property {} in group {}.'.format(col_name, self.group_id))
 
-        # Build node_types dataframe and merge
-        node_types_df = self._parent.node_types_table.to_dataframe()
-        # remove properties that exist in the group
-        node_types_cols = [c.name for c in self._parent.node_types_table.columns if c not in self._group_columns]
-        node_types_df = node_types_df[node_types_cols]
+            # multi-dimensional columns (eg. positions) will have an array for each row
+            results_df[col_name] = list(col_vals) if col_vals.ndim > 1 else col_vals
 
-        # TODO: consider caching these results
-        return results_df.merge(node_types_df, how='left', left_on='node_type_id', right_index=True)
+        return results_df
 
-    def filter(self, **filter_props):
-        """Filter all nodes in the group by key=value pairs.
+    def filter(self, *predicates, **filter_props):
+        """Filter all nodes in the group by key=value pairs and/or query predicates.
 
-        The filter specifications may apply to either node_type or group column properties. Currently at the moment
-        it only supports equivlency. An intersection (and operator) is done for every different filter pair. This will
-        produce a generator of all nodes matching the the filters.
+        The filter specifications may apply to either node_type or group column properties. A key=value pair checks
+        for equivlency (or membership if the value is a list), and more complex statements can be passed in as
+        predicates (see the query module). An intersection (and operator) is done for every different filter. The
+        filters are evaluated as numpy masks over chunks of the columns, so no Node objects are created until the
+        returned NodeSet is iterated over.
 
         for node in filter(pop_name='VIp', depth=10.0):
            assert(node['pop_name'] == 'VIp' and node['depth'] == 10.0)
 
+        for node in filter(col('depth') > 10.0, model_template=['nrn:IntFire1', 'nrn:IntFire2']):
+           assert(node['depth'] > 10.0)
+
+        :param predicates: query.Predicate objects.
         :param filter_props: keys and their values to filter nodes on.
-        :return: A generator that produces all valid nodes within the group with matching key==value pairs.
+        :return: A NodeSet of all valid nodes within the group with matching key==value pairs.
+        :raises KeyError: if a property is in neither the group, the node-types table or the population.
         """
-        # TODO: Integrate this with NodeSet.
-        self.build_indicies()
-        node_types_table = self._parent.node_types_table
-        node_type_filter = set(node_types_table.node_type_ids)  # list of valid node_type_ids
-        type_filter = False
-        group_prop_filter = {}  # list of 'prop_name'==prov_val for group datasets
-        group_filter = False
-        node_id_filter = []
-
-        # Build key==value lists
-        for filter_key, filter_val in filter_props.items():
-            # TODO: Check if node_type_id is an input
-            if filter_key in self._group_columns:
-                # keep of list of group_popertiess to filter
-                group_prop_filter[filter_key] = filter_val
-                group_filter = True
-
-            elif filter_key in node_types_table.columns:
-                # for node_types we just keep a list of all node_type_ids with matching key==value pairs
-                node_type_filter &= set(node_types_table.find(filter_key, filter_val))
-                type_filter = True
-
-            elif filter_key in ['node_id', 'node_ids']:
-                node_id_filter += filter_val
-
-            else:
-                # TODO: should we raise an exception?
-                # TODO: User logger
-                print('Could not find property {} in either group or types table. Ignoring.'.format(filter_key))
-
-        # iterate through all nodes, skipping ones that don't have matching key==value pairs
-        for indx in self._parent_indicies:
-            # TODO: Don't build the node until you filter out node_type_id
-            node = self._parent.get_row(indx)
-            if type_filter and node.node_type_id not in node_type_filter:
-                # confirm node_type_id is a correct one
-                continue
-
-            if node_id_filter and node.node_id not in node_id_filter:
-                continue
-
-            if group_filter:
-                # Filter by group property values
-                # TODO: Allow group properties to handle lists
-                src_failed = True
-                for k, v in group_prop_filter.items():
-                    if node[k] != v:
-                        break
-                else:
-                    src_failed = False
-
-                if src_failed:
-                    continue
-
-            yield node
+        query = build_query(*predicates, **filter_props)
+        check_columns(query, self.has_property)
+        selected_rows = list(self._parent._query_rows(query, group_id=self.group_id))
+        selected_rows = np.concatenate(selected_rows) if selected_rows else np.array([], dtype=np.int64)
+        return NodeSet(selected_rows, self._parent)
 
     def __iter__(self):
         self.build_indicies()
@@ -321,10 +311,7 @@ class EdgeGroup(Group):
         super(EdgeGroup, self).__init__(group_id, h5_group, parent)
         self._indicies_count = 0  # Used to keep track of number of indicies (since it contains multple ranges)
 
-        self.__itr_index = 0
-        self.__itr_range = []
-        self.__itr_range_idx = 0
-        self.__itr_range_max = 0
+        self.__itr = None
 
     def build_indicies(self, force=False):
         if self._parent_indicies_built and not force:
@@ -370,6 +357,13 @@ class EdgeGroup(Group):
         # TODO: consider caching these results
         return results_df.merge(edge_types_df, how='left', left_on='edge_type_id', right_index=True)
 
+    def _population_rows(self):
+        self.build_indicies()
+        if len(self._parent_indicies) == 0:
+            return np.zeros(0, dtype=np.int64)
+        parent_ranges = np.asarray(self._parent_indicies)
+        return expand_ranges(parent_ranges[:, 0], parent_ranges[:, 1])
+
     def _get_parent_ds(self, parent_ds):
         self.build_indicies()
         ds_vals = np.zeros(self._indicies_count, dtype=parent_ds.dtype)
@@ -413,44 +407,74 @@ class EdgeGroup(Group):
                 i += r_len
             return return_list
 
-    def filter(self, **filter_props):
-        # TODO: I'm not sure If I want to do this? Need to check on a larger dataset than I currently have.
-        raise NotImplementedError
+    def filter(self, *predicates, **filter_props):
+        """Filter all edges in the group by key=value pairs and/or query predicates, see NodeGroup.filter().
 
-    def __iter__(self):
+        Only the population rows covered by the group's ranges are read, one block at a time, and the query is
+        evaluated on each block as numpy masks. The result is an EdgeSet, which can be converted into a DataFrame
+        (EdgeSet.to_dataframe) or into arrays of source/target node_ids without creating any Edge objects.
+
+        edges = grp.filter(col('syn_weight') > 1.0, model_template='exp2syn')
+        src_ids, trg_ids = edges.source_node_ids, edges.target_node_ids
+
+        :param predicates: query.Predicate objects.
+        :param filter_props: keys and their values to filter edges on.
+        :return: An EdgeSet of all matching edges within the group, in population order.
+        :raises KeyError: if a property is in neither the group, the edge-types table or the population.
+        """
+        query = build_query(*predicates, **filter_props)
+        check_columns(query, self.has_property)
+        types_matches = {}  # only need to evaluate the types table once for each predicate
+        selected_rows = []
+        for block_beg, block_end in self._range_blocks():
+            mask = self._parent._query_mask(query, block_beg, block_end, self.group_id, types_matches)
+            selected_rows.append(np.flatnonzero(mask) + block_beg)
+
+        # blocks follow the order of the group's ranges, sort so the edges are returned in population order
+        selected_rows = np.sort(np.concatenate(selected_rows)) if selected_rows else np.zeros(0, dtype=np.int64)
+        return EdgeSet(selected_rows, self._parent)
+
+    def _range_blocks(self, block_size=None):
+        """Splits the group's population ranges into blocks of at most block_size rows. Consecutive (increasing) ranges
+        that are close together (eg. when groups are interleaved) are merged into a single block so they are read at the same
+        time, rows of the other groups in the block are masked out by the query.
+
+        :return: A generator of (row_beg, row_end) tuples
+        """
         self.build_indicies()
-        # TODO: Implement using an EdgeSet
-        if len(self._parent_indicies) == 0:
-            self.__itr_max_range = 0
-            self.__itr_range = []
-            self.__itr_index = 0
-        else:
-            # Stop at the largest range end (I'm not sure if the indicies are ordered, if we can make it ordered then
-            # in the future just use self_parent_indicies[-1][1]
-            self.__itr_range_max = len(self._parent_indicies)
-            self.__itr_range_idx = 0
-            self.__itr_range = self._parent_indicies[0]
-            self.__itr_index = self.__itr_range[0]
+        block_size = block_size or FILTER_CHUNK_SIZE
+        block_beg = block_end = None
+        for r_beg, r_end in self._parent_indicies:
+            r_beg, r_end = int(r_beg), int(r_end)
+            if block_beg is not None and r_beg >= block_end and r_end - block_beg <= block_size:
+                block_end = r_end
+                continue
+
+            if block_beg is not None:
+                yield block_beg, block_end
+
+            # ranges larger than a block are split up
+            while r_end - r_beg > block_size:
+                yield r_beg, r_beg + block_size
+                r_beg += block_size
+            block_beg, block_end = r_beg, r_end
 
+        if block_beg is not None and block_end > block_beg:
+            yield block_beg, block_end
+
+    def __iter__(self):
+        # TODO: Implement using an EdgeSet
+        self.__itr = self._iter_ranges()
         return self
 
+    def _iter_ranges(self):
+        self.build_indicies()
+        for r_beg, r_end in self._parent_indicies:
+            for edge in self._parent._iter_rows(row_beg=r_beg, row_end=r_end):
+                yield edge
+
     def next(self):
         return self.__next__()
 
     def __next__(self):
-        if self.__itr_range_idx >= self.__itr_range_max:
-            raise StopIteration
-
-        nxt_edge = self._parent.get_row(self.__itr_index)
-        self.__itr_index += 1
-        if self.__itr_index >= self.__itr_range[1]:
-            # iterator has moved past the current range
-            self.__itr_range_idx += 1
-            if self.__itr_range_idx < self.__itr_range_max:
-                # move the iterator onto next range
-                self.__itr_range = self._parent_indicies[self.__itr_range_idx]  # update range
-                self.__itr_index = self.__itr_range[0]  # update iterator to start and the beginning of new range
-            else:
-                self.__itr_range = []
-
-        return nxt_edge
+        return next(self.__itr)
@@ -0,0 +1,192 @@
+# Copyright 2019. Allen Institute. All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+# disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following
+# disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+import numpy as np
+
+from .utils import range_itr
+
+
+# Number of ids read at a time when checking if a dataset is just 0, 1, 2, ..., N-1
+ID_CHECK_CHUNK_SIZE = 2**20
+
+
+class ArangeColumn(object):
+    """Stand-in for an implicit id dataset where the id of every row is just the row number."""
+    def __init__(self, nrows, dtype=np.uint64):
+        self._nrows = nrows
+        self._dtype = np.dtype(dtype)
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def shape(self):
+        return (self._nrows,)
+
+    def __len__(self):
+        return self._nrows
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return np.arange(*item.indices(self._nrows), dtype=self._dtype)
+        elif isinstance(item, tuple) and len(item) == 0:
+            return np.arange(self._nrows, dtype=self._dtype)
+        elif np.isscalar(item):
+            if not (-self._nrows <= item < self._nrows):
+                raise IndexError('index {} is out of bounds for size {}'.format(item, self._nrows))
+            return self._dtype.type(item % self._nrows)
+        else:
+            return np.arange(self._nrows, dtype=self._dtype)[np.asarray(item)]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.arange(self._nrows, dtype=dtype or self._dtype)
+
+
+class IdIndex(object):
+    """A lookup table from a set of unique ids (node_id, gid, etc) to the row they appear in.
+
+    If the ids are just 0, 1, ..., N-1 (or any other consecutive range, eg. gids offset + 0, 1, ..., N-1) the index
+    is implicit and doesn't store anything. Otherwise it stores the ids as a sorted array (and the row order if the ids
+    aren't already sorted) and uses a binary search for lookups.
+    """
+    def __init__(self, ids=None, nrows=None, offset=0):
+        self._sorted_ids = None  # Sorted array of all the ids (None if implicit)
+        self._sorted_rows = None  # row of each id in _sorted_ids (None if ids are already sorted)
+        self._offset = offset  # id of the first row if implicit
+
+        if ids is None:
+            self._nrows = nrows
+            self._implicit = True
+        else:
+            ids = np.asarray(ids)
+            self._nrows = len(ids)
+            self._implicit = False
+            if self._nrows > 0 and int(ids[-1]) - int(ids[0]) == self._nrows - 1 and \
+                    np.all(np.diff(ids.astype(np.int64)) == 1):
+                # consecutive ids, row can be calculated directly from the id
+                self._implicit = True
+                self._offset = int(ids[0])
+            elif self._nrows > 1 and np.any(ids[1:] <= ids[:-1]):
+                row_dtype = np.uint32 if self._nrows < np.iinfo(np.uint32).max else np.uint64
+                order = np.argsort(ids, kind='stable')
+                self._sorted_ids = ids[order]
+                self._sorted_rows = order.astype(row_dtype)
+            else:
+                self._sorted_ids = ids
+
+    @classmethod
+    def from_dataset(cls, ids_ds, chunk_size=None):
+        """Build an index from a dataset of ids, checking in chunks if the ids are implicit before loading them
+        all into memory.
+        """
+        if isinstance(ids_ds, ArangeColumn):
+            return cls(nrows=len(ids_ds))
+
+        chunk_size = chunk_size or ID_CHECK_CHUNK_SIZE
+        nrows = len(ids_ds)
+        for chunk_beg in range_itr(0, nrows, chunk_size):
+            chunk_end = min(chunk_beg + chunk_size, nrows)
+            if not np.array_equal(ids_ds[chunk_beg:chunk_end], np.arange(chunk_beg, chunk_end)):
+                break
+        else:
+            return cls(nrows=nrows)
+
+        return cls(ids=np.asarray(ids_ds[()]))
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Rebuilds an index from the arrays returned by to_arrays(). The arrays are used as is, so they can be memory
+        mapped."""
+        index = cls(nrows=int(arrays['header'][1]), offset=int(arrays['header'][2]))
+        index._implicit = bool(arrays['header'][0])
+        index._sorted_ids = arrays.get('sorted_ids', None)
+        index._sorted_rows = arrays.get('sorted_rows', None)
+        return index
+
+    def to_arrays(self):
+        """Returns the index as a dictionary of numpy arrays, eg. for saving to disk"""
+        arrays = {'header': np.array([int(self._implicit), self._nrows, self._offset], dtype=np.int64)}
+        if self._sorted_ids is not None:
+            arrays['sorted_ids'] = self._sorted_ids
+        if self._sorted_rows is not None:
+            arrays['sorted_rows'] = self._sorted_rows
+        return arrays
+
+    @property
+    def is_implicit(self):
+        return self._implicit
+
+    @property
+    def offset(self):
+        """For an implicit index, the id of the first row"""
+        return self._offset
+
+    @property
+    def nbytes(self):
+        """Memory used by the index"""
+        return sum(arr.nbytes for arr in [self._sorted_ids, self._sorted_rows] if arr is not None)
+
+    def rows(self, ids):
+        """Returns an array of the rows for a list of ids, raises a KeyError if one or more ids doesn't exist.
+
+        :param ids: array of ids, may be unordered and contain duplicates.
+        :return: array of row numbers, in the same order as ids
+        """
+        ids = np.asarray(ids)
+        rows, valid = self._lookup(ids)
+        if not np.all(valid):
+            raise KeyError('id(s) {} not found.'.format(ids[~valid][:10].tolist()))
+
+        return rows
+
+    def contains(self, ids):
+        """Returns a boolean mask of which ids in a list exist in the index"""
+        return self._lookup(np.asarray(ids))[1]
+
+    def _lookup(self, ids):
+        """Returns (rows, valid) arrays, where the value of rows is undefined for any id that isn't valid"""
+        if self._implicit:
+            rows = ids.astype(np.int64) - self._offset
+            valid = (rows >= 0) & (rows < self._nrows)
+
+        else:
+            pos = np.searchsorted(self._sorted_ids, ids)
+            pos[pos >= self._nrows] = self._nrows - 1 if self._nrows > 0 else 0
+            valid = self._sorted_ids[pos] == ids if self._nrows > 0 else np.zeros(ids.shape, dtype=bool)
+            rows = pos if self._sorted_rows is None else self._sorted_rows[pos]
+
+        return rows, valid
+
+    def row(self, id_val):
+        """Returns the row number of a single id"""
+        return int(self.rows(np.array([id_val]))[0])
+
+    def __contains__(self, id_val):
+        try:
+            self.row(id_val)
+            return True
+        except KeyError:
+            return False
+
+    def __len__(self):
+        return self._nrows
@@ -0,0 +1,322 @@
+# Copyright 2019. Allen Institute. All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+# disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following
+# disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+import os
+import json
+import shutil
+import uuid
+import hashlib
+import tempfile
+import numpy as np
+import six
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, processes may end up building the same index at the same time
+    fcntl = None
+
+
+INDEX_CACHE_VERSION = 1
+
+# Number of bytes hashed at the start and the end of a file when checking if it has changed
+HASH_SAMPLE_SIZE = 2**20
+
+
+class IndexCache(object):
+    """An on-disk cache of the indices derived from a circuit's hdf5 files (node_id --> row lookups, group --> rows,
+    etc), so they only have to be built once rather than by every process that opens the file.
+
+    The indices of each hdf5 file are stored in their own directory, either next to the file or inside of cache_dir,
+    with every array saved as a .npy file so it can be memory mapped (no copy) when it is loaded. The directory
+    records the path, size, modification time and a hash of the file. If any of them change the next time the file
+    is opened all the stored indices are removed. To keep the check cheap for very large files only the first and last
+    HASH_SAMPLE_SIZE bytes are hashed.
+
+    Entries are written to a temporary directory and then renamed, so multiple processes can share the same cache.
+    """
+    def __init__(self, cache_dir=None):
+        """
+        :param cache_dir: directory to store the indices in, if None they are stored next to each hdf5 file
+        """
+        self._cache_dir = cache_dir
+        self._checked_dirs = {}  # path of hdf5 file --> index directory, once it has been validated
+        self._file_keys = {}  # path of hdf5 file --> manifest the index directory was validated against
+
+    @property
+    def cache_dir(self):
+        return self._cache_dir
+
+    def load(self, h5_path, entry_name):
+        """Returns the arrays of an entry, memory mapped, or None if the entry doesn't exist (or is out of date).
+
+        :param h5_path: path of the hdf5 file the index was built from
+        :param entry_name: name of the index, eg 'nodes.v1.node_id_index'
+        :return: dictionary of array name --> numpy.memmap, or None
+        """
+        entry_dir = os.path.join(self._index_dir(h5_path), entry_name)
+        if not os.path.isdir(entry_dir):
+            return None
+
+        try:
+            return {fname[:-4]: np.load(os.path.join(entry_dir, fname), mmap_mode='r', allow_pickle=False)
+                    for fname in os.listdir(entry_dir) if fname.endswith('.npy')}
+        except (IOError, OSError):
+            # the directory was invalidated by another process while loading
+            return None
+
+    def load_or_build(self, h5_path, entry_name, build_fnc):
+        """Returns the (memory mapped) arrays of an entry, building and saving it first if it doesn't exist. Only one
+        process at a time builds an entry, any others opening the same file wait for it to finish and then load it.
+
+        :param h5_path: path of the hdf5 file the index was built from
+        :param entry_name: name of the index
+        :param build_fnc: function that returns a dictionary of array name --> numpy array
+        :return: dictionary of array name --> numpy.memmap
+        """
+        arrays = self.load(h5_path, entry_name)
+        if arrays is not None:
+            return arrays
+
+        lock_path = os.path.join(self._index_dir(h5_path), '.{}.lock'.format(entry_name))
+        with _FileLock(lock_path):
+            arrays = self.load(h5_path, entry_name)
+            if arrays is None:
+                built_arrays = build_fnc()
+                self.save(h5_path, entry_name, built_arrays)
+                # use the stored copy so the builder also shares the memory with the other processes
+                arrays = self.load(h5_path, entry_name)
+                if arrays is None:
+                    # the index directory was invalidated (eg. the hdf5 file changed) while the entry was being built
+                    arrays = built_arrays
+        return arrays
+
+    def save(self, h5_path, entry_name, arrays):
+        """Stores the arrays of an index. If the entry already exists (eg. written by another process) it is kept.
+
+        :param h5_path: path of the hdf5 file the index was built from
+        :param entry_name: name of the index
+        :param arrays: dictionary of array name --> numpy array
+        """
+        index_dir = self._index_dir(h5_path)
+        entry_dir = os.path.join(index_dir, entry_name)
+        if os.path.isdir(entry_dir):
+            return
+
+        try:
+            tmp_dir = tempfile.mkdtemp(prefix='.{}.'.format(entry_name), dir=index_dir)
+        except OSError:
+            # the index directory was invalidated by another process, the entry just won't be cached
+            return
+        for array_name, values in arrays.items():
+            np.save(os.path.join(tmp_dir, '{}.npy'.format(array_name)), np.asarray(values), allow_pickle=False)
+
+        if self._read_manifest(index_dir) != self._file_keys.get(os.path.abspath(h5_path), None):
+            # the hdf5 file changed (and another process reset the directory) while the index was being built
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # another process has already saved the entry
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def clear(self, h5_path):
+        """Removes all the stored indices of an hdf5 file"""
+        self._checked_dirs.pop(os.path.abspath(h5_path), None)
+        _discard_dir(self._index_path(h5_path))
+
+    def clear_all(self, stale_only=False):
+        """Removes the stored indices of every hdf5 file in cache_dir.
+
+        :param stale_only: only remove the indices of files that have since been changed or deleted
+        """
+        if self._cache_dir is None:
+            raise ValueError('clear_all() requires an IndexCache with a cache_dir.')
+
+        self._checked_dirs.clear()
+        self._file_keys.clear()
+        if not os.path.isdir(self._cache_dir):
+            return
+
+        for dir_name in os.listdir(self._cache_dir):
+            if not dir_name.startswith('.') or '.index_cache.' not in dir_name or '.stale.' in dir_name:
+                continue
+
+            index_dir = os.path.join(self._cache_dir, dir_name)
+            if stale_only:
+                manifest = self._read_manifest(index_dir)
+                if not isinstance(manifest, dict):
+                    # manifest is still being written
+                    continue
+                h5_path = manifest.get('path', None)
+                if h5_path is not None and os.path.exists(h5_path) and self._file_key(h5_path) == manifest:
+                    continue
+
+            _discard_dir(index_dir)
+
+    def _index_path(self, h5_path):
+        h5_path = os.path.abspath(h5_path)
+        dir_name = '.{}.index_cache'.format(os.path.basename(h5_path))
+        if self._cache_dir is None:
+            return os.path.join(os.path.dirname(h5_path), dir_name)
+        else:
+            # different files can have the same basename
+            path_hash = hashlib.sha1(h5_path.encode('utf-8')).hexdigest()[:12]
+            return os.path.join(self._cache_dir, '{}.{}'.format(dir_name, path_hash))
+
+    def _index_dir(self, h5_path):
+        """Returns the directory for the indices of an hdf5 file, creating it (or clearing it if the file has changed)
+        if necessary"""
+        h5_path = os.path.abspath(h5_path)
+        if h5_path in self._checked_dirs and os.path.isdir(self._checked_dirs[h5_path]):
+            return self._checked_dirs[h5_path]
+
+        index_dir = self._index_path(h5_path)
+        manifest_path = os.path.join(index_dir, 'manifest.json')
+        file_key = self._file_key(h5_path)
+        if os.path.exists(manifest_path) and self._read_manifest(index_dir) != file_key:
+            _discard_dir(index_dir)
+
+        if not os.path.exists(manifest_path):
+            if not os.path.isdir(index_dir):
+                try:
+                    os.makedirs(index_dir)
+                except OSError:
+                    if not os.path.isdir(index_dir):
+                        raise
+
+            # write then rename so other processes never see a partial manifest
+            fd, tmp_path = tempfile.mkstemp(prefix='.manifest.', dir=index_dir)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(file_key, f)
+            os.rename(tmp_path, manifest_path)
+
+        self._checked_dirs[h5_path] = index_dir
+        self._file_keys[h5_path] = file_key
+        return index_dir
+
+    @staticmethod
+    def _read_manifest(index_dir):
+        try:
+            with open(os.path.join(index_dir, 'manifest.json'), 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _file_key(h5_path):
+        file_stat = os.stat(h5_path)
+        file_hash = hashlib.sha1()
+        with open(h5_path, 'rb') as f:
+            file_hash.update(f.read(HASH_SAMPLE_SIZE))
+            if file_stat.st_size > HASH_SAMPLE_SIZE:
+                f.seek(max(HASH_SAMPLE_SIZE, file_stat.st_size - HASH_SAMPLE_SIZE))
+                file_hash.update(f.read(HASH_SAMPLE_SIZE))
+
+        return {
+            'version': INDEX_CACHE_VERSION,
+            'path': h5_path,
+            'size': file_stat.st_size,
+            'mtime': getattr(file_stat, 'st_mtime_ns', file_stat.st_mtime),
+            'hash': file_hash.hexdigest()
+        }
+
+
+class SharedIndexCache(IndexCache):
+    """An IndexCache kept in shared memory (/dev/shm), so all the processes on a host use a single copy of each index.
+
+    The first process that needs an index builds it, the rest wait for it and then memory map the same pages
+    read-only, so the memory used for the indices doesn't grow with the number of ranks per host. If /dev/shm doesn't
+    exist the system's temp directory is used instead.
+
+    The indices persist after the processes exit (so later jobs on the same host can reuse them) and take up RAM until
+    they are removed or the host reboots. The indices of an hdf5 file are only replaced when that same file is opened
+    again, so call clear_all() at the end of a job to free the memory, or clear_all(stale_only=True) to just remove the
+    indices of files that have been changed or deleted.
+    """
+    def __init__(self, cache_dir=None):
+        if cache_dir is None:
+            shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+            cache_dir = os.path.join(shm_dir, 'sonata_index_cache')
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                if not os.path.isdir(cache_dir):
+                    raise
+        super(SharedIndexCache, self).__init__(cache_dir=cache_dir)
+
+
+class _FileLock(object):
+    """Exclusive lock between processes on the same host, using flock on a lock file"""
+    def __init__(self, lock_path):
+        self._lock_path = lock_path
+        self._lock_file = None
+
+    def __enter__(self):
+        if fcntl is not None:
+            try:
+                self._lock_file = open(self._lock_path, 'a')
+            except (IOError, OSError):
+                # directory was invalidated by another process, go ahead without the lock
+                return self
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._lock_file is not None:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+            self._lock_file.close()
+            self._lock_file = None
+
+
+def _discard_dir(index_dir):
+    """Removes an index directory. It is renamed first (which is atomic) and only then deleted, so other processes
+    that are still using it never see it partially deleted: they either find the complete old directory, or a missing
+    one and have to rebuild."""
+    stale_dir = '{}.stale.{}'.format(index_dir, uuid.uuid4().hex)
+    try:
+        os.rename(index_dir, stale_dir)
+    except OSError:
+        # doesn't exist, or already moved aside by another process
+        return
+    shutil.rmtree(stale_dir, ignore_errors=True)
+
+
+def as_index_cache(index_cache):
+    """Converts the index_cache option of File into an IndexCache (or None if disabled). Can be True (store the
+    indices next to the hdf5 files), 'shm' (shared memory, see SharedIndexCache), a directory path, or an IndexCache
+    object."""
+    if index_cache is None or index_cache is False:
+        return None
+    elif index_cache is True:
+        return IndexCache()
+    elif index_cache == 'shm':
+        return SharedIndexCache()
+    elif isinstance(index_cache, six.string_types):
+        return IndexCache(cache_dir=index_cache)
+    elif isinstance(index_cache, IndexCache):
+        return index_cache
+    else:
+        raise ValueError('Invalid index_cache {}.'.format(index_cache))
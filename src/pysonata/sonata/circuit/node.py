@@ -20,16 +20,33 @@
 # WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
+import numpy as np
+
+from .utils import MISSING_GID
 
 
 class NodeSet(object):
+    """A selection of nodes within a population.
+
+    The nodes are stored as an array of population row indicies, which may be in any order and contain duplicates.
+    Properties are fetched for the entire selection at once, with a single coalesced read for each dataset, and Node
+    objects are only created when iterating through the set.
+    """
     # TODO: Merge NodeSet and NodePopulation
     def __init__(self, node_indicies, population, **parameters):
-        self._indicies = node_indicies
+        self._indicies = np.asarray(node_indicies, dtype=np.int64).reshape(-1)
         self._n_nodes = len(self._indicies)
         self._population = population
 
-        self.__itr_index = 0
+        self.__itr = None
+
+    @property
+    def population(self):
+        return self._population
+
+    @property
+    def row_indicies(self):
+        return self._indicies
 
     @property
     def node_ids(self):
@@ -43,94 +60,146 @@ class NodeSet(object):
     def node_type_ids(self):
         return self._population.inode_type_ids(self._indicies)
 
-    '''
     @property
-    def node_types(self):
-        return [self._population._node_types_table[ntid] for ntid in self._node_type_ids]
-    '''
+    def group_ids(self):
+        return self._population.igroup_ids(self._indicies)
 
     def get_properties(self, property_name):
-        raise NotImplementedError
+        """Returns an array of values of a property for every node in the set.
+
+        :param property_name: name of a group, node-types or population (node_id, node_type_id, etc) column
+        :return: A numpy array, in the same order as the NodeSet
+        """
+        return self._population.iproperties(property_name, self._indicies)
+
+    def to_dataframe(self, columns=None):
+        """Returns a pandas DataFrame of the selected nodes, one row for every node. See NodePopulation.to_dataframe
+
+        :param columns: list of columns to include, by default will include all group and node-types columns
+        :return: A pandas DataFrame
+        """
+        return self._population.to_dataframe(columns=columns, row_indicies=self._indicies)
+
+    def iter_chunks(self, batch_size=None, columns=None, as_dataframe=False):
+        """Iterates through the selected nodes in blocks, see NodePopulation.iter_chunks()
+
+        :param batch_size: maximum number of nodes in each block.
+        :param columns: list of columns to return, by default all population, group and node-types columns.
+        :param as_dataframe: return each block as a pandas DataFrame instead of a dictionary of numpy arrays.
+        :return: A generator of {column_name: array of values} dictionaries (or DataFrames)
+        """
+        return self._population.iter_chunks(batch_size=batch_size, columns=columns, as_dataframe=as_dataframe,
+                                            row_indicies=self._indicies)
+
+    def sample(self, n=None, frac=None, stratify_by=None, seed=None):
+        """Returns a random sample of the nodes in the set as a new NodeSet, see NodePopulation.sample()"""
+        return NodeSet(self._population._sample_rows(n, frac, stratify_by, seed, row_indicies=self._indicies),
+                       self._population)
+
+    def union(self, other):
+        """Returns a new NodeSet with all the (unique) nodes in this set or other"""
+        self._check_population(other)
+        return NodeSet(np.union1d(self._indicies, other.row_indicies), self._population)
+
+    def intersection(self, other):
+        """Returns a new NodeSet with all the (unique) nodes in both this set and other"""
+        self._check_population(other)
+        return NodeSet(np.intersect1d(self._indicies, other.row_indicies), self._population)
+
+    def difference(self, other):
+        """Returns a new NodeSet with all the (unique) nodes in this set but not in other"""
+        self._check_population(other)
+        return NodeSet(np.setdiff1d(self._indicies, other.row_indicies), self._population)
+
+    def _check_population(self, other):
+        if not isinstance(other, NodeSet):
+            raise TypeError('Expected a NodeSet, got {}.'.format(type(other)))
+        if other.population is not self._population:
+            raise ValueError('Unable to combine NodeSets from different populations.')
+
+    def __or__(self, other):
+        return self.union(other)
+
+    def __and__(self, other):
+        return self.intersection(other)
+
+    def __sub__(self, other):
+        return self.difference(other)
 
     def __len__(self):
         return self._n_nodes
 
     def __iter__(self):
-        self.__itr_index = 0
+        self.__itr = self._population._iter_rows(self._indicies)
         return self
 
     def next(self):
         return self.__next__()
 
     def __next__(self):
-        if self.__itr_index >= self._n_nodes:
-            raise StopIteration
-
-        node = self._population.get_row(self._indicies[self.__itr_index])
-        self.__itr_index += 1
-        return node
+        return next(self.__itr)
 
 
 class Node(object):
+    """A single node, a lightweight view of one row of a ColumnBlock.
+
+    The node only stores a reference to the block and its offset within it, properties are looked up (and the
+    block's columns loaded) the first time they are accessed. Compared to storing the properties of every node in
+    dictionaries this greatly reduces the memory and number of allocations when iterating through a population.
+    """
+    __slots__ = ('_block', '_offset')
+
     # TODO: include population name/reference
-    # TODO: make a dictionary (or preferably a collections.MutableMap
-    def __init__(self, node_id, node_type_id, node_types_props, group_id, group_props, dynamics_params, gid=None):
-        self._node_id = node_id
-        self._gid = gid
-        self._node_type_id = node_type_id
-        self._node_type_props = node_types_props
-        self._group_id = group_id
-        self._group_props = group_props
+    def __init__(self, block, offset):
+        self._block = block
+        self._offset = offset
 
     @property
     def node_id(self):
-        return self._node_id
+        return self._block.value('node_id', self._offset)
 
     @property
     def gid(self):
-        return self._gid
+        if not self._block.population.has_gids:
+            return None
+
+        gid = self._block.value('gid', self._offset)
+        if gid == MISSING_GID:
+            raise KeyError('Node {} does not have a gid.'.format(self.node_id))
+        return gid
 
     @property
     def group_id(self):
-        return self._group_id
+        return self._block.value('node_group_id', self._offset)
 
     @property
     def node_type_id(self):
-        return self._node_type_id
+        return self._block.value('node_type_id', self._offset)
 
     @property
     def group_props(self):
-        return self._group_props
+        return self._block.group_props(self._offset)
 
     @property
     def node_type_properties(self):
-        return self._node_type_props
+        return self._block.types_props(self._offset)
 
     @property
     def dynamics_params(self):
         raise NotImplementedError
 
     def __getitem__(self, prop_key):
-        if prop_key in self._group_props:
-            return self._group_props[prop_key]
-        elif prop_key in self._node_type_props:
-            return self._node_type_props[prop_key]
-        elif prop_key == 'node_id':
-            return self.node_id
-        elif property == 'node_type_id':
-            return self.node_type_id
-        else:
-            raise KeyError('Unknown property {}'.format(prop_key))
+        return self._block.get(prop_key, self._offset)
 
     def __contains__(self, prop_key):
-        return prop_key in self._group_props or prop_key in self._node_type_props
+        return self._block.contains(prop_key, self._offset)
 
     def __repr__(self):
         return self.__str__()
 
     def __str__(self):
-        ret_dict = self._node_type_props.copy()
-        ret_dict.update(self._group_props)
+        ret_dict = self.node_type_properties.copy()
+        ret_dict.update(self.group_props)
         ret_dict['node_id'] = self.node_id
         ret_dict['node_type_id'] = self.node_type_id
         return str(ret_dict)
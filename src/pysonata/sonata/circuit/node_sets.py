@@ -0,0 +1,171 @@
+# Copyright 2019. Allen Institute. All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+# disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following
+# disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+import json
+import numpy as np
+import six
+
+from .node import NodeSet
+from .utils import listify
+
+
+class NodeSets(object):
+    """The node sets of a simulation (see the "Node Sets File" section of the developer guide), resolved against the
+    node populations of a circuit.
+
+    A basic node set is a dictionary of property: value(s) rules, which is evaluated on each population with the same
+    vectorized path used by NodePopulation.filter(). The special "population" and "node_id" (or "gids") rules are
+    looked up directly rather than filtered on. A compound node set is a list of other node sets, and is the union of
+    them. Each node set is only resolved the first time it is used, after that its rows are kept in memory.
+
+        node_sets = NodeSets('node_sets.json', circuit.nodes)
+        for pop_name, nodes in node_sets['bio_layer45'].items():
+            ...
+    """
+    def __init__(self, node_sets, nodes):
+        """
+        :param node_sets: path to a node sets json file, or a dictionary of node sets
+        :param nodes: NodesRoot (or File) containing the node populations
+        """
+        if isinstance(node_sets, six.string_types):
+            with open(node_sets, 'r') as f:
+                node_sets = json.load(f)
+        if not isinstance(node_sets, dict):
+            raise ValueError('node sets must be a dictionary of node-set name --> definition.')
+
+        self._definitions = node_sets
+        self._nodes = getattr(nodes, 'nodes', nodes)
+        self._resolved = {}  # node-set name --> {population name: sorted array of rows}
+
+    @property
+    def names(self):
+        return list(self._definitions.keys())
+
+    def definition(self, name):
+        return self._definitions[name]
+
+    def rows(self, name, population=None):
+        """Returns the population rows of every node in a node set.
+
+        :param name: name of node set
+        :param population: name of a population, if None will return the rows for all the populations
+        :return: A sorted array of rows for population, or a dictionary of population name --> array of rows
+        """
+        pop_rows = self._resolve(name, [])
+        if population is None:
+            return pop_rows
+        return pop_rows.get(population, np.zeros(0, dtype=np.int64))
+
+    def mask(self, name, population):
+        """Returns the node set as a boolean mask over the rows of a population"""
+        mask = np.zeros(len(self._nodes[population]), dtype=bool)
+        mask[self.rows(name, population)] = True
+        return mask
+
+    def get(self, name, population=None):
+        """Returns the nodes of a node set.
+
+        :param name: name of node set
+        :param population: name of a population, if None will return the nodes in every population
+        :return: A NodeSet, or a dictionary of population name --> NodeSet (only populations containing part of the
+            node set are included).
+        """
+        if population is not None:
+            return NodeSet(self.rows(name, population), self._nodes[population])
+
+        return {pop_name: NodeSet(rows, self._nodes[pop_name])
+                for pop_name, rows in self.rows(name).items() if len(rows) > 0}
+
+    def clear(self):
+        """Removes all the resolved node sets from memory"""
+        self._resolved = {}
+
+    def _resolve(self, name, parents):
+        if name in self._resolved:
+            return self._resolved[name]
+
+        if name not in self._definitions:
+            raise KeyError('Unknown node set {}.'.format(name))
+        if name in parents:
+            raise ValueError('Node set {} contains itself ({}).'.format(name, ' -> '.join(parents + [name])))
+
+        definition = self._definitions[name]
+        if isinstance(definition, list):
+            # compound node set
+            pop_rows = {}
+            for child_name in definition:
+                for pop_name, rows in self._resolve(child_name, parents + [name]).items():
+                    pop_rows[pop_name] = np.union1d(pop_rows[pop_name], rows) if pop_name in pop_rows else rows
+        elif isinstance(definition, dict):
+            pop_rows = self._resolve_basic(definition)
+        else:
+            raise ValueError('Invalid definition for node set {}.'.format(name))
+
+        self._resolved[name] = pop_rows
+        return pop_rows
+
+    def _resolve_basic(self, definition):
+        filter_props = dict(definition)
+        pop_names = listify(filter_props.pop('population', self._nodes.population_names))
+        node_ids = filter_props.pop('node_id', None)
+        gids = filter_props.pop('gids', None)
+
+        pop_rows = {}
+        for pop_name in pop_names:
+            if pop_name not in self._nodes:
+                continue
+
+            population = self._nodes[pop_name]
+            rows = None
+            if node_ids is not None:
+                ids = np.asarray(listify(node_ids))
+                ids = ids[population.node_id_index.contains(ids)]
+                rows = np.unique(population.node_id_index.rows(ids))
+
+            if gids is not None:
+                gid_rows = np.unique(population.gid_rows(listify(gids), ignore_missing=True)) if population.has_gids \
+                    else np.zeros(0, dtype=np.int64)
+                rows = gid_rows if rows is None else np.intersect1d(rows, gid_rows, assume_unique=True)
+
+            if any(not population.has_property(prop) for prop in filter_props):
+                # a population without one of the properties can't have any matching nodes
+                rows = np.zeros(0, dtype=np.int64)
+
+            elif filter_props and (rows is None or len(rows) > 0):
+                matches = population.filter(**filter_props).row_indicies
+                rows = matches if rows is None else np.intersect1d(rows, matches, assume_unique=True)
+
+            if rows is None:
+                rows = np.arange(len(population), dtype=np.int64)
+
+            pop_rows[pop_name] = np.asarray(rows, dtype=np.int64)
+
+        return pop_rows
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def __contains__(self, name):
+        return name in self._definitions
+
+    def __len__(self):
+        return len(self._definitions)
@@ -20,21 +20,91 @@
 # WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
+import os
 import pandas as pd
 import h5py
 import numpy as np
 
-from .utils import range_itr, get_attribute_h5
+from .utils import range_itr, get_attribute_h5, expand_ranges, partition_range, memmap_dataset, \
+    FILTER_CHUNK_SIZE, MISSING_GID
 from .node import Node, NodeSet
 from .edge import Edge, EdgeSet
 from .group import NodeGroup, EdgeGroup
+from .query import build_query, check_columns
+from .index import IdIndex, ArangeColumn
+from .cache import ColumnCache
+from .column_block import ColumnBlock
+from .spatial import GridIndex
+from ..iotools import sonata_world_comm
+
+
+# Default number of rows in each block returned by iter_chunks(), also used when iterating one node/edge at a time
+DEFAULT_BATCH_SIZE = 10000
+
+
+def _combine_values(n_rows, grp_values):
+    """Merges the values of a property from different groups into one array.
+
+    :param n_rows: size of the returned array
+    :param grp_values: a list of (rows_mask, values) tuples
+    """
+    if len(grp_values) == 1 and np.all(grp_values[0][0]):
+        # Typical case, all rows belong to the same group
+        return grp_values[0][1]
+
+    dtypes = set(vals.dtype for _, vals in grp_values)
+    shapes = set(vals.shape[1:] for _, vals in grp_values)
+    all_rows = np.any([rows for rows, _ in grp_values], axis=0) if grp_values else np.zeros(n_rows, dtype=bool)
+    if len(shapes) > 1:
+        # Multi-dimensional columns with a different number of dimensions in each group
+        combined_values = np.full(n_rows, None, dtype=object)
+        for rows, vals in grp_values:
+            combined_values[np.flatnonzero(rows)] = list(vals)
+        return combined_values
+
+    shape = (n_rows,) + (shapes.pop() if shapes else ())
+    if len(dtypes) == 1 and np.all(all_rows):
+        combined_values = np.empty(shape, dtype=dtypes.pop())
+    elif all(np.issubdtype(dt, np.number) for dt in dtypes):
+        combined_values = np.full(shape, np.nan, dtype=np.result_type(np.float64, *dtypes))
+    else:
+        combined_values = np.full(shape, None, dtype=object)
+
+    for rows, vals in grp_values:
+        combined_values[rows] = vals
+    return combined_values
+
+
+def _as_id_array(node_ids):
+    """Converts a list, array, range or any other iterable (eg. a generator) of node_ids into a numpy array"""
+    if not hasattr(node_ids, '__len__'):
+        node_ids = list(node_ids)
+    return np.asarray(node_ids, dtype=np.int64).reshape(-1)
+
+
+def _random_subset(rng, n_items, k):
+    """Uniformly picks k out of n_items without replacement, returning a sorted array of positions. When k is small
+    compared to n_items only O(k) memory is used."""
+    if k >= n_items:
+        return np.arange(n_items, dtype=np.int64)
+    elif k*4 > n_items:
+        return np.sort(rng.permutation(n_items)[:k])
+
+    # draw (with replacement) until there are at least k unique values, then randomly pick k of them
+    picks = np.zeros(0, dtype=np.int64)
+    while len(picks) < k:
+        picks = np.unique(np.concatenate((picks, rng.randint(0, n_items, size=k + k//10 + 1).astype(np.int64))))
+    return np.sort(rng.permutation(picks)[:k])
 
 
 class Population(object):
-    def __init__(self, pop_name, pop_group, types_table):
+    def __init__(self, pop_name, pop_group, types_table, cache=None, index_cache=None, use_memmap=True):
         self._pop_name = pop_name
         self._pop_group = pop_group
         self._types_table = types_table
+        self._cache = cache if cache is not None else ColumnCache(max_bytes=0)
+        self._index_cache = index_cache  # IndexCache for storing derived indices on disk, None if disabled
+        self._use_memmap = use_memmap
         self._nrows = 0
 
         # For storing individual groups
@@ -43,18 +113,40 @@ class Population(object):
         self._group_cache = {}  # grp-id --> soneta.io.Group() object
 
         # Refrences to most of the population's primary dataset
-        self._type_id_ds = pop_group[self.type_ids_column]
-        self._group_id_ds = pop_group[self.group_id_column]
-        self._group_index_ds = pop_group[self.group_index_column]
+        self._type_id_ds = self.open_dataset(pop_group[self.type_ids_column])
+        self._group_id_ds = self.open_dataset(pop_group[self.group_id_column])
+        self._group_index_ds = self.open_dataset(pop_group[self.group_index_column])
 
         self._group_indicies = {}  # grp-id --> list of rows indicies
         self._group_indicies_cache_built = False
+        self._group_runs = None  # run-length encoding of the group_id column, see _get_group_runs()
+
+        self._population_columns = {}  # reserved column name --> population dataset (eg. node_type_id)
+        self._column_aliases = {}  # Alternative names used when filtering, eg. node_ids --> node_id
 
     @property
     def name(self):
         """name of current population"""
         return self._pop_name
 
+    @property
+    def cache(self):
+        """ColumnCache used for reading the population and group datasets"""
+        return self._cache
+
+    @property
+    def index_cache(self):
+        return self._index_cache
+
+    def open_dataset(self, dataset):
+        """Returns a read-only memory map of an hdf5 dataset if possible (see utils.memmap_dataset), otherwise the
+        h5py dataset itself."""
+        if self._use_memmap:
+            ds_memmap = memmap_dataset(dataset)
+            if ds_memmap is not None:
+                return ds_memmap
+        return dataset
+
     @property
     def group_ids(self):
         """List of all group_ids belonging to population"""
@@ -93,6 +185,20 @@ class Population(object):
     def type_ids_column(self):
         raise NotImplementedError
 
+    @property
+    def population_columns(self):
+        """List of the columns stored in the population (rather than in a group or the types table)"""
+        return list(self._population_columns.keys())
+
+    def is_population_column(self, property_name):
+        """Check if property_name is a column (or alias of a column) stored in the population"""
+        return self._column_aliases.get(property_name, property_name) in self._population_columns
+
+    def has_property(self, property_name):
+        """Check if property_name is a population column or exists in any of the groups or the types table"""
+        return self.is_population_column(property_name) or property_name in self._types_table.columns or \
+            any(property_name in grp_h5 for grp_h5 in self._group_map.values())
+
     def to_dataframe(self):
         """Convert Population to dataframe"""
         raise NotImplementedError
@@ -116,30 +222,348 @@ class Population(object):
          more memory (default False)
         :return: A (possibly empty) list of row indicies (non-contiguous, but unique)
         """
+        if not self._group_indicies_cache_built and (build_cache or self._index_cache is not None):
+            # When the index cache is on the indicies of every group are stored, so they only ever need to be built once
+            self._build_group_indicies()
+
         if self._group_indicies_cache_built:
             return self._group_indicies.get(group_id, [])
 
         else:
-            tmp_index = pd.DataFrame()
-            # TODO: Need to check the memory overhead, especially for edges. See if an iterative search is just as fast
-            tmp_index['grp_id'] = pd.Series(self._group_id_ds[()], dtype=self._group_id_ds.dtype)
-            tmp_index['row_indx'] = pd.Series(range_itr(self._nrows), dtype=np.uint32)
-            if build_cache:
-                # save all indicies as arrays
-                self._group_indicies = {grp_id: np.array(subset['row_indx'])
-                                        for grp_id, subset in tmp_index.groupby(by='grp_id')}
-                self._group_indicies_cache_built = True
-                return self._group_indicies.get(group_id, [])
-            else:
-                # TODO: Manually del tmp_index to clear out the memory?
-                tmp_index = tmp_index[tmp_index['grp_id'] == group_id]
-                return np.array(tmp_index['row_indx'])
+            run_begs, run_ends = self.group_ranges(group_id)
+            return expand_ranges(run_begs, run_ends).astype(self._row_dtype)
+
+    def group_ranges(self, group_id):
+        """Returns the rows of a group as contiguous [beg, end) ranges.
+
+        :param group_id: id of a given group
+        :return: tuple of (range_begs, range_ends) arrays, in the order the rows appear in the population
+        """
+        run_begs, run_ends, run_group_ids = self._get_group_runs()
+        grp_runs = run_group_ids == group_id
+        return run_begs[grp_runs], run_ends[grp_runs]
+
+    @property
+    def _row_dtype(self):
+        return np.uint32 if self._nrows < np.iinfo(np.uint32).max else np.uint64
+
+    def _get_group_runs(self):
+        """Run-length encoding of the group_id column, as (run_begs, run_ends, run_group_ids) arrays. Rows of a group
+        are usually stored together so there are only a few runs, and they are found with a single chunked pass through
+        the dataset."""
+        if self._group_runs is not None:
+            return self._group_runs
+
+        if len(self._group_map) == 1:
+            # Don't need to read anything, every row belongs to the same group
+            grp_id = list(self._group_map.keys())[0]
+            self._group_runs = (np.array([0], dtype=np.int64), np.array([self._nrows], dtype=np.int64),
+                                np.array([grp_id], dtype=np.int64))
+            return self._group_runs
+
+        self._group_runs = self._find_runs(self._group_id_ds)
+        return self._group_runs
+
+    def _find_runs(self, dataset):
+        """Run-length encoding of an integer population dataset, read one chunk (of FILTER_CHUNK_SIZE rows) at a time.
+
+        :return: tuple of (run_begs, run_ends, run_values) arrays
+        """
+        run_begs = []
+        run_values = []
+        for chunk_beg in range_itr(0, self._nrows, FILTER_CHUNK_SIZE):
+            chunk_end = min(chunk_beg + FILTER_CHUNK_SIZE, self._nrows)
+            values = np.asarray(dataset[chunk_beg:chunk_end], dtype=np.int64)
+            chunk_runs = np.concatenate(([0], np.flatnonzero(np.diff(values)) + 1))
+            run_begs.append(chunk_runs + chunk_beg)
+            run_values.append(values[chunk_runs])
+
+        run_begs = np.concatenate(run_begs) if run_begs else np.zeros(0, dtype=np.int64)
+        run_values = np.concatenate(run_values) if run_values else np.zeros(0, dtype=np.int64)
+
+        # merge runs that were split across two chunks
+        is_new_run = np.concatenate(([True], run_values[1:] != run_values[:-1])) if len(run_begs) > 0 \
+            else np.zeros(0, dtype=bool)
+        run_begs = run_begs[is_new_run]
+        run_values = run_values[is_new_run]
+        run_ends = np.concatenate((run_begs[1:], [self._nrows])).astype(np.int64)
+        return run_begs, run_ends, run_values
+
+    def _build_group_indicies(self):
+        def build_arrays():
+            # stored as one array of rows, sorted by group, with the offset of each group
+            run_begs, run_ends, run_group_ids = self._get_group_runs()
+            run_order = np.argsort(run_group_ids, kind='stable')
+            group_ids, group_runs = np.unique(run_group_ids[run_order], return_index=True)
+            group_lens = np.add.reduceat(run_ends[run_order] - run_begs[run_order], group_runs) if len(group_ids) > 0 \
+                else np.zeros(0, dtype=np.int64)
+            return {
+                'group_ids': group_ids.astype(np.int64),
+                'group_offsets': np.concatenate(([0], np.cumsum(group_lens))).astype(np.int64),
+                'rows': expand_ranges(run_begs[run_order], run_ends[run_order]).astype(self._row_dtype)
+            }
+
+        arrays = self._load_or_build_index('group_indicies', build_arrays)
+        offsets = arrays['group_offsets']
+        self._group_indicies = {int(grp_id): arrays['rows'][offsets[i]:offsets[i + 1]]
+                                for i, grp_id in enumerate(arrays['group_ids'])}
+        self._group_indicies_cache_built = True
+
+    def _index_entry(self, index_name):
+        return '{}.{}'.format(self._pop_group.name.strip('/').replace('/', '.'), index_name)
+
+    def _load_or_build_index(self, index_name, build_fnc, force=False):
+        """Returns the arrays of a derived index from the index cache, or if it isn't stored (or the cache is off)
+        calls build_fnc() to create them."""
+        if self._index_cache is None or force:
+            return build_fnc()
+        return self._index_cache.load_or_build(self._pop_group.file.filename, self._index_entry(index_name), build_fnc)
+
+    def _query_rows(self, query, group_id=None, chunk_size=None):
+        """Evaluates a query (see query.build_query) over the population one contiguous chunk at a time.
+
+        :param query: A query.Predicate, or None to select every row
+        :param group_id: If set only rows belonging to given group are selected
+        :param chunk_size: max number of rows read at one time
+        :return: A generator of (non-empty) arrays of the row indicies that match the query
+        """
+        chunk_size = chunk_size or FILTER_CHUNK_SIZE
+        types_matches = {}  # only need to evaluate the types table once for each predicate
+        for chunk_beg in range_itr(0, self._nrows, chunk_size):
+            chunk_end = min(chunk_beg + chunk_size, self._nrows)
+            mask = self._query_mask(query, chunk_beg, chunk_end, group_id, types_matches)
+            selected_rows = np.flatnonzero(mask) + chunk_beg
+            if len(selected_rows) > 0:
+                yield selected_rows
+
+    def _query_mask(self, query, chunk_beg, chunk_end, group_id=None, types_matches=None):
+        """Returns a boolean mask for population rows chunk_beg to chunk_end that match the query"""
+        types_matches = {} if types_matches is None else types_matches
+        chunk_cols = {}  # values of population datasets for the current chunk, so each is only read once
+
+        def chunk_column(col_name):
+            if col_name not in chunk_cols:
+                chunk_cols[col_name] = self._cache.read_range(self._population_columns[col_name], chunk_beg, chunk_end)
+            return chunk_cols[col_name]
+
+        group_ids = chunk_column(self.group_id_column)
+        group_ids_list = np.unique(group_ids) if group_id is None else [group_id]
+        group_rows = {grp_id: group_ids == grp_id for grp_id in group_ids_list}
+
+        def leaf_mask(leaf):
+            col_name = self._column_aliases.get(leaf.column, leaf.column)
+            if col_name in self._population_columns:
+                return leaf.mask(chunk_column(col_name))
+
+            mask = np.zeros(chunk_end - chunk_beg, dtype=bool)
+            for grp_id, grp_rows in group_rows.items():
+                grp = self.get_group(grp_id)
+                if col_name in grp:
+                    grp_indicies = chunk_column(self.group_index_column)[grp_rows]
+                    mask[grp_rows] = leaf.mask(self._cache.read(grp.get_dataset(col_name), grp_indicies))
+
+                elif col_name in self._types_table.columns:
+                    if id(leaf) not in types_matches:
+                        types_matches[id(leaf)] = self._types_table.evaluate(leaf)
+                    type_indicies = self._types_table.type_indicies(chunk_column(self.type_ids_column)[grp_rows])
+                    mask[grp_rows] = types_matches[id(leaf)].take(type_indicies)
+
+            return mask
+
+        mask = np.ones(chunk_end - chunk_beg, dtype=bool) if query is None else query.evaluate(leaf_mask)
+        if group_id is not None:
+            mask &= group_rows[group_id]
+        return mask
+
+    def itype_ids(self, row_indicies):
+        return self._cache.read(self._type_id_ds, row_indicies)
 
     def igroup_ids(self, row_indicies):
-        return self._group_id_ds[list(row_indicies)]
+        return self._cache.read(self._group_id_ds, row_indicies)
 
     def igroup_indicies(self, row_indicies):
-        return self._group_index_ds[list(row_indicies)]
+        return self._cache.read(self._group_index_ds, row_indicies)
+
+    def iproperties(self, property_name, row_indicies):
+        """Returns the values of a property (population, group or types-table column) for a list of rows.
+
+        Each dataset is read once, using coalesced hyperslab reads, so the rows may be in any order and contain
+        duplicates. If a row belongs to a group without the property its value will be NaN (or None for
+        non-numeric properties).
+
+        :param property_name: name of property/column
+        :param row_indicies: list of population rows
+        :return: numpy array of values, same order as row_indicies
+        """
+        return self._read_columns([property_name], row_indicies=row_indicies)[property_name]
+
+    def iter_chunks(self, batch_size=None, columns=None, as_dataframe=False, row_indicies=None):
+        """Iterates through the population in blocks of rows, returning the values of each column for the whole block
+        at once. Much faster than iterating through one node/edge at a time when only a few properties are needed.
+
+        :param batch_size: maximum number of rows in each block (default 10000).
+        :param columns: list of columns to return, by default all population, group and types-table columns.
+        :param as_dataframe: return each block as a pandas DataFrame instead of a dictionary of numpy arrays.
+        :param row_indicies: list of rows to iterate through, by default will iterate through the entire population.
+        :return: A generator of {column_name: array of values} dictionaries (or DataFrames)
+        """
+        batch_size = batch_size or DEFAULT_BATCH_SIZE
+        columns = self.default_columns() if columns is None else list(columns)
+        for col_name in columns:
+            if not self._has_chunk_column(col_name):
+                raise KeyError('Unknown property {}'.format(col_name))
+
+        if row_indicies is None:
+            for chunk_beg in range_itr(0, self._nrows, batch_size):
+                chunk_end = min(chunk_beg + batch_size, self._nrows)
+                chunk = self._read_columns(columns, row_range=(chunk_beg, chunk_end))
+                yield self._chunk_dataframe(chunk, columns) if as_dataframe else chunk
+
+        else:
+            row_indicies = np.asarray(row_indicies, dtype=np.int64).reshape(-1)
+            for chunk_beg in range_itr(0, len(row_indicies), batch_size):
+                chunk = self._read_columns(columns, row_indicies=row_indicies[chunk_beg:(chunk_beg + batch_size)])
+                yield self._chunk_dataframe(chunk, columns) if as_dataframe else chunk
+
+    def _sample_rows(self, n=None, frac=None, stratify_by=None, seed=None, row_indicies=None):
+        """Returns a (sorted) random sample of the population rows, or of row_indicies. See NodePopulation.sample()"""
+        if (n is None) == (frac is None):
+            raise ValueError('Please specify either n or frac.')
+        if (n is not None and n < 0) or (frac is not None and not 0.0 <= frac <= 1.0):
+            raise ValueError('Invalid sample size.')
+
+        rng = seed if isinstance(seed, np.random.RandomState) else np.random.RandomState(seed)
+        n_items = self._nrows if row_indicies is None else len(row_indicies)
+        sample_size = lambda n_stratum: n if n is not None else int(round(frac*n_stratum))
+
+        if stratify_by is None:
+            positions = _random_subset(rng, n_items, sample_size(n_items))
+
+        else:
+            # Only the stratify_by column(s) are read for every row, the rest of the columns are only read for the
+            # rows in the sample.
+            columns = [stratify_by] if not isinstance(stratify_by, (list, tuple)) else list(stratify_by)
+            chunks = list(self.iter_chunks(columns=columns, row_indicies=row_indicies, batch_size=FILTER_CHUNK_SIZE))
+            strata = np.zeros(n_items, dtype=np.int64)
+            for col_name in columns:
+                values = np.concatenate([c[col_name] for c in chunks]) if chunks else np.zeros(0)
+                codes, uniques = pd.factorize(values)
+                # rows with a missing value (NaN/None) are never sampled
+                strata = np.where((codes < 0) | (strata < 0), -1, strata*max(len(uniques), 1) + codes)
+
+            order = np.argsort(strata, kind='stable')
+            stratum_splits = np.flatnonzero(np.diff(strata[order])) + 1
+            positions = []
+            for stratum_positions in np.split(order, stratum_splits):
+                if len(stratum_positions) == 0 or strata[stratum_positions[0]] < 0:
+                    continue
+                picks = _random_subset(rng, len(stratum_positions), sample_size(len(stratum_positions)))
+                positions.append(stratum_positions[picks])
+            positions = np.sort(np.concatenate(positions)) if positions else np.zeros(0, dtype=np.int64)
+
+        return positions if row_indicies is None else np.asarray(row_indicies, dtype=np.int64)[positions]
+
+    def _partition_rows(self, rank, size, strategy):
+        """Returns the (sorted) population rows assigned to rank"""
+        if not 0 <= rank < size:
+            raise ValueError('Invalid partition rank {} of size {}.'.format(rank, size))
+
+        if strategy == 'round_robin':
+            return np.arange(rank, self._nrows, size, dtype=np.int64)
+        elif strategy == 'contiguous':
+            row_beg, row_end = partition_range(rank, size, self._nrows)
+            return np.arange(row_beg, row_end, dtype=np.int64)
+        else:
+            raise ValueError('Unknown partition strategy {}.'.format(strategy))
+
+    def _iter_rows(self, row_indicies=None, row_beg=0, row_end=None):
+        """Generator of Node/Edge records for a list of rows (or contiguous range of rows). Records are created in
+        blocks that share the column values, see ColumnBlock.
+        """
+        if row_indicies is None:
+            row_end = self._nrows if row_end is None else row_end
+            for block_beg in range_itr(row_beg, row_end, DEFAULT_BATCH_SIZE):
+                block = ColumnBlock(self, row_range=(block_beg, min(block_beg + DEFAULT_BATCH_SIZE, row_end)))
+                for offset in range_itr(len(block)):
+                    yield self._build_record(block, offset)
+
+        else:
+            for block_beg in range_itr(0, len(row_indicies), DEFAULT_BATCH_SIZE):
+                block = ColumnBlock(self, row_indicies=row_indicies[block_beg:(block_beg + DEFAULT_BATCH_SIZE)])
+                for offset in range_itr(len(block)):
+                    yield self._build_record(block, offset)
+
+    def _build_record(self, block, offset):
+        raise NotImplementedError
+
+    def default_columns(self, group_id=None):
+        """List of all the columns in the population (or just those for group_id): population columns first, then the
+        group columns and finally the types-table columns."""
+        columns = list(self._population_columns.keys())
+        groups = self.groups if group_id is None else [self.get_group(group_id)]
+        for grp in groups:
+            columns += [c.name for c in grp.group_columns if c.name not in columns]
+        columns += [c.name for c in self._types_table.columns if c.name not in columns]
+        return columns
+
+    def _has_chunk_column(self, column_name):
+        return self.has_property(column_name)
+
+    def _read_columns(self, columns, row_indicies=None, row_range=None):
+        """Reads a set of columns for either a list of rows or a contiguous range of rows (row_range=(beg, end)),
+        reading each of the population datasets only once.
+
+        :return: dictionary of column_name --> numpy array of values
+        """
+        if row_range is not None:
+            n_rows = row_range[1] - row_range[0]
+            read_population_ds = lambda ds: self._cache.read_range(ds, row_range[0], row_range[1])
+        else:
+            row_indicies = np.asarray(row_indicies, dtype=np.int64).reshape(-1)
+            n_rows = len(row_indicies)
+            read_population_ds = lambda ds: self._cache.read(ds, row_indicies)
+
+        population_values = {}
+
+        def population_column(col_name):
+            if col_name not in population_values:
+                population_values[col_name] = read_population_ds(self._population_columns[col_name])
+            return population_values[col_name]
+
+        group_rows = None
+        values = {}
+        for property_name in columns:
+            col_name = self._column_aliases.get(property_name, property_name)
+            if col_name in self._population_columns:
+                values[property_name] = population_column(col_name)
+                continue
+
+            if group_rows is None:
+                group_ids = population_column(self.group_id_column)
+                group_rows = [(grp_id, group_ids == grp_id) for grp_id in np.unique(group_ids)]
+
+            grp_values = []  # list of (rows mask, values) for every group
+            for grp_id, grp_rows in group_rows:
+                grp = self.get_group(grp_id)
+                if col_name in grp:
+                    grp_indicies = population_column(self.group_index_column)[grp_rows]
+                    grp_values.append((grp_rows, self._cache.read(grp.get_dataset(col_name), grp_indicies)))
+
+                elif col_name in self._types_table.columns:
+                    type_ids = population_column(self.type_ids_column)[grp_rows]
+                    grp_values.append((grp_rows, self._types_table.broadcast(col_name, type_ids)))
+
+            if len(grp_values) == 0 and not self.has_property(col_name):
+                raise KeyError('Unknown property {}'.format(property_name))
+
+            values[property_name] = _combine_values(n_rows, grp_values)
+
+        return values
+
+    @staticmethod
+    def _chunk_dataframe(chunk, columns):
+        # multi-dimensional columns (eg. positions) are stored as a list in each row, like in Group.to_dataframe()
+        return pd.DataFrame({c: list(chunk[c]) if chunk[c].ndim > 1 else chunk[c] for c in columns}, columns=columns)
 
     def _find_groups(self):
         """Create a map between group-id and h5py.Group reference"""
@@ -159,25 +583,41 @@ class Population(object):
 
 
 class NodePopulation(Population):
-    def __init__(self, pop_name, pop_group, node_types_tables):
-        super(NodePopulation, self).__init__(pop_name=pop_name, pop_group=pop_group, types_table=node_types_tables)
+    def __init__(self, pop_name, pop_group, node_types_tables, cache=None, index_cache=None, use_memmap=True):
+        super(NodePopulation, self).__init__(pop_name=pop_name, pop_group=pop_group, types_table=node_types_tables,
+                                             cache=cache, index_cache=index_cache, use_memmap=use_memmap)
 
-        # TODO: node_ids can be implicit
-        self._node_id_ds = pop_group['node_id']
+        if 'node_id' in pop_group:
+            self._node_id_ds = self.open_dataset(pop_group['node_id'])
+        else:
+            # node_ids are implicit, ie node_id == row number
+            self._node_id_ds = ArangeColumn(len(self._type_id_ds))
         self._nrows = len(self._node_id_ds)
 
-        # TODO: This isn't necessary if only using iterator. Delay building index until get_node() is called.
-        self._index_nid2row = None  # A lookup from node_id --> h5 row number
+        self._population_columns = {
+            'node_id': self._node_id_ds,
+            self.type_ids_column: self._type_id_ds,
+            self.group_id_column: self._group_id_ds,
+            self.group_index_column: self._group_index_ds
+        }
+        self._column_aliases = {'node_ids': 'node_id', 'node_type_ids': 'node_type_id'}
+
+        # A lookup from node_id --> h5 row number, not built until needed (eg. get_node_id() is called).
+        self._index_nid2row = None
         self._node_id_index_built = False
-        self._build_node_id_index()
 
         # indicies for gid <--> node_id map
         self._has_gids = False
-        self._index_gid2row = None  # gid --> row (for searching by gid)
-        self._index_row2gid = None  # row --> gid (for iterator or searching by node-id)
-        self._gid_lookup_fnc = lambda _: None  # for looking up gid by row, use fnc pointer rather than conditional
+        self._index_gid2row = None  # IdIndex of gid --> position in _gid_rows (for searching by gid)
+        self._gid_rows = None  # rows that have a gid, sorted (None if every row has a gid)
+        self._row_gids = None  # row --> gid, array with a value for every row of the population
+        self._row_has_gid = None  # boolean mask of rows that have a gid (None if every row has a gid)
+
+        # GridIndex of the node positions, not built until a spatial query is made
+        self._spatial_index = None
+        self._spatial_columns = None
 
-        self.__itr_index = 0  # for iterator
+        self.__itr = None  # for iterator
 
     @property
     def group_id_column(self):
@@ -201,14 +641,18 @@ class NodePopulation(Population):
 
     @property
     def gids(self):
-        if self.has_gids:
-            return np.array(self._index_gid2row.index)
-        else:
+        if not self.has_gids:
             return None
+        elif self._row_has_gid is None:
+            return self._row_gids
+        else:
+            return self._row_gids[self._row_has_gid]
 
     @property
-    def node_types_table(self):
-        return self._types_table
+    def node_id_index(self):
+        """IdIndex lookup table of node_id --> row number"""
+        self._build_node_id_index()
+        return self._index_nid2row
 
     @property
     def index_column_name(self):
@@ -218,113 +662,351 @@ class NodePopulation(Population):
     def node_types_table(self):
         return self.types_table
 
-    def add_gids(self, gid_map_df, force=False):
+    def add_gids(self, gids, node_ids=None, force=False):
+        """Maps gids onto the nodes of the population.
+
+        :param gids: array of gids, or a DataFrame with gid and node_id columns
+        :param node_ids: array of node_ids, one for each gid (if gids isn't a DataFrame)
+        :param force: set to True to replace existing gids.
+        """
         if self.has_gids and not force:
             # TODO: not sure if it's best to return an exception or just continue on in silence?
             raise Exception('Node population {} already has gids mapped onto node-ids.'.format(self.name))
             # return
 
-        # Create map from gid --> node_id --> row #
-        self._build_node_id_index()
-        tmp_df = pd.DataFrame()
-        tmp_df['row_id'] = self._index_nid2row.index
-        tmp_df['node_id'] = self._index_nid2row
-        gid_map_df = gid_map_df.merge(tmp_df, how='left', left_on='node_id', right_on='node_id')
-        gid_map_df = gid_map_df.drop(['node_id', 'population'], axis=1)
-        self._index_gid2row = gid_map_df.set_index('gid')
-        self._index_row2gid = gid_map_df.set_index('row_id')
-        self._gid_lookup_fnc = lambda row_indx: self._index_row2gid.loc[row_indx]['gid']
+        if isinstance(gids, pd.DataFrame):
+            gids, node_ids = gids['gid'].values, gids['node_id'].values
+
+        # Build the gid <--> row lookups, in row order
+        rows = self.node_id_index.rows(np.asarray(node_ids))
+        gids = np.asarray(gids)
+        order = np.argsort(rows, kind='stable')
+        rows, gids = rows[order], gids[order]
+        if len(rows) > 1 and np.any(rows[1:] == rows[:-1]):
+            raise Exception('Node population {} has nodes with more than one gid.'.format(self.name))
+
+        if len(rows) == self._nrows:
+            # Every node has a gid (typical)
+            self._gid_rows = None
+            self._row_gids = gids
+            self._row_has_gid = None
+        else:
+            self._gid_rows = rows
+            self._row_gids = np.full(self._nrows, MISSING_GID, dtype=np.int64)
+            self._row_gids[rows] = gids
+            self._row_has_gid = np.zeros(self._nrows, dtype=bool)
+            self._row_has_gid[rows] = True
+
+        self._index_gid2row = IdIndex(gids)
         self._has_gids = True
 
-    def to_dataframe(self):
-        if len(self.groups) == 1:
-            return self.get_group(self.group_ids[0]).to_dataframe()
+    def remove_gids(self):
+        """Removes any gids mapped onto the nodes of the population"""
+        self._has_gids = False
+        self._index_gid2row = None
+        self._gid_rows = None
+        self._row_gids = None
+        self._row_has_gid = None
+
+    def to_dataframe(self, columns=None, row_indicies=None):
+        """Returns a pandas DataFrame of nodes in the population.
+
+        Each group is converted separately (see NodeGroup.to_dataframe) and concatenated together, so the rows
+        will be in the same order as the population (or row_indicies). If a group doesn't contain one of the columns
+        its values will be NaN.
+
+        :param columns: list of column names to include, by default includes all group and node-types columns. Raises a
+            KeyError if a column isn't in the population.
+        :param row_indicies: list of rows to include, by default will include every node.
+        :return: A pandas DataFrame
+        """
+        if columns is not None:
+            for col_name in columns:
+                if not (col_name == 'gid' and self.has_gids) and not self.has_property(col_name):
+                    raise KeyError('Could not find property {} in population {}.'.format(col_name, self.name))
+
+        if row_indicies is None:
+            row_indicies = np.arange(self._nrows, dtype=np.int64)
+            group_ids = np.asarray(self._group_id_ds[()])
         else:
-            dataframes = []
-            for grp_id in self.group_ids:
-                dataframes.append(self.get_group(grp_id)).to_datframe()
-            dataframes = dataframes.set_index('node_id')
-            return dataframes
+            row_indicies = np.asarray(row_indicies, dtype=np.int64).reshape(-1)
+            group_ids = self.igroup_ids(row_indicies)
 
-    def get_row(self, row_indx):
-        # TODO: Use helper function so we don't have to lookup gid/node_id twice
-        # Note: I'm not cacheing the nodes for memory purposes, but it might be beneificial too.
-        node_id = self._node_id_ds[row_indx]
-        node_type_id = self._type_id_ds[row_indx]
-        node_group_id = self._group_id_ds[row_indx]
-        node_group_index = self._group_index_ds[row_indx]
+        group_dfs = []
+        for grp_id in np.unique(group_ids):
+            grp = self.get_group(grp_id)
+            grp_columns = None if columns is None else [c for c in columns if grp.has_property(c) or c == 'gid']
+            grp_positions = np.flatnonzero(group_ids == grp_id)
+            grp_df = grp.to_dataframe(columns=grp_columns, row_indicies=row_indicies[grp_positions])
+            grp_df.index = grp_positions
+            group_dfs.append(grp_df)
 
-        node_type_props = self.node_types_table[node_type_id]
-        node_group_props = self.get_group(node_group_id)[node_group_index]
-        node_gid = self._gid_lookup_fnc(row_indx)
+        if len(group_dfs) == 0:
+            return pd.DataFrame(columns=columns)
 
-        return Node(node_id, node_type_id, node_type_props, node_group_id, node_group_props, None, gid=node_gid)
+        elif len(group_dfs) == 1:
+            nodes_df = group_dfs[0]
+
+        else:
+            nodes_df = pd.concat(group_dfs, sort=False).sort_index()
+            # concat will convert categorical columns with different categories into object columns
+            category_cols = set(c for df in group_dfs for c in df.columns if isinstance(df[c].dtype, pd.CategoricalDtype))
+            for col_name in category_cols:
+                nodes_df[col_name] = nodes_df[col_name].astype('category')
+
+        if columns is not None:
+            nodes_df = nodes_df.reindex(columns=columns)
+
+        return nodes_df.reset_index(drop=True)
+
+    def get_row(self, row_indx):
+        return Node(ColumnBlock(self, row_range=(row_indx, row_indx + 1)), 0)
+
+    def _build_record(self, block, offset):
+        return Node(block, offset)
 
     def get_rows(self, row_indicies):
         """Returns a set of all nodes based on list of row indicies.
 
-        Warning: currently due to the use of h5py, the list must be ordered and cannot contain duplicates.
-
-        :param row_indicies: A list of row indicies
+        :param row_indicies: A list of row indicies, may be unordered and contain duplicates.
         :return: An iterable NodeSet of nodes in the specified indicies
         """
-        # TODO: Check that row_indicies is unsigned and the max (which will be the last value) < n_rows
-        # TODO: Check order and check for duplicates in list
+        # TODO: Check that row_indicies is unsigned and the max < n_rows
         return NodeSet(row_indicies, self)
 
     def inode_ids(self, row_indicies):
-        # You get errors if row_indicies is a numpy array or panda series so convert to python list
-        # TODO: list conversion can be expensive, see if h5py will work with np arrays natively.
-        return self._node_id_ds[list(row_indicies)]
+        return self._cache.read(self._node_id_ds, row_indicies)
 
     def igids(self, row_indicies):
-        gids = self._gid_lookup_fnc(row_indicies)
-        if gids is not None:
-            gids = np.array(gids)
-        return gids
+        """Returns the gid of each row, or MISSING_GID (-1) for any node that isn't in the gid table. Returns None if
+        the population doesn't have gids."""
+        if not self.has_gids:
+            return None
+
+        return self._row_gids[np.asarray(row_indicies, dtype=np.int64)]
+
+    def gid_rows(self, gids, ignore_missing=False):
+        """Returns an array of population rows for a list of gids, raises a KeyError if a gid doesn't exist (or if
+        ignore_missing is True just skips it)."""
+        if not self.has_gids:
+            raise KeyError('Node population {} does not have gids.'.format(self.name))
+
+        if ignore_missing:
+            gids = np.asarray(gids)
+            gids = gids[self._index_gid2row.contains(gids)]
+        positions = self._index_gid2row.rows(gids)
+        return positions if self._gid_rows is None else self._gid_rows[positions]
 
     def inode_type_ids(self, row_indicies):
-        # self._node_type_id_ds
-        return self._type_id_ds[list(row_indicies)]
+        return self._cache.read(self._type_id_ds, row_indicies)
+
+    def default_columns(self, group_id=None):
+        columns = super(NodePopulation, self).default_columns(group_id)
+        if self.has_gids:
+            columns.insert(1, 'gid')
+        return columns
+
+    def _has_chunk_column(self, column_name):
+        return (column_name == 'gid' and self.has_gids) or self.has_property(column_name)
+
+    def _read_columns(self, columns, row_indicies=None, row_range=None):
+        if 'gid' not in columns:
+            return super(NodePopulation, self)._read_columns(columns, row_indicies, row_range)
+
+        values = super(NodePopulation, self)._read_columns([c for c in columns if c != 'gid'], row_indicies,
+                                                           row_range)
+        values['gid'] = self.igids(np.arange(*row_range) if row_range is not None else row_indicies)
+        return values
 
     def get_node_id(self, node_id):
-        row_indx = self._index_nid2row.iloc[node_id]
-        return self.get_row(row_indx)
+        """Find node(s) by their node_id.
+
+        :param node_id: A node_id, or a list/array of node_ids.
+        :return: A Node if node_id is a scalar, otherwise a NodeSet with nodes in the same order as node_id
+        """
+        if np.isscalar(node_id):
+            return self.get_row(self.node_id_index.row(node_id))
+        else:
+            return self.get_node_ids(node_id)
 
     def get_gid(self, gid):
-        # assert(self.has_gids)
-        row_indx = self._index_gid2row.iloc[gid]['row_id']
-        return self.get_row(row_indx)
+        """Find node(s) by their gid.
+
+        :param gid: A gid, or a list/array of gids.
+        :return: A Node if gid is a scalar, otherwise a NodeSet with nodes in the same order as gid
+        """
+        if np.isscalar(gid):
+            return self.get_row(int(self.gid_rows([gid])[0]))
+        else:
+            return self.get_gids(gid)
+
+    def get_node_ids(self, node_ids):
+        """Find a batch of nodes by their node_ids. The ids are converted to rows all at once, and the properties of the
+        returned NodeSet are fetched with a single (sorted and de-duplicated) read of each dataset.
+
+        :param node_ids: list/array of node_ids, may be unordered and contain duplicates.
+        :return: A NodeSet, in the same order as node_ids
+        """
+        return NodeSet(self.node_id_index.rows(np.asarray(node_ids).reshape(-1)), self)
+
+    def get_gids(self, gids):
+        """Find a batch of nodes by their gids, see get_node_ids().
+
+        :param gids: list/array of gids, may be unordered and contain duplicates.
+        :return: A NodeSet, in the same order as gids
+        """
+        return NodeSet(self.gid_rows(np.asarray(gids).reshape(-1)), self)
+
+    def partition(self, rank=None, size=None, strategy='round_robin'):
+        """Returns the subset of nodes that belong to one rank, for splitting the population between MPI processes.
+        Only the rows of the partition are read, and the population's node_id index is never built.
+
+        :param rank: rank of the partition, by default the MPI rank of the process
+        :param size: number of partitions, by default the number of MPI processes
+        :param strategy: either 'round_robin' (row i goes to rank i % size) or 'contiguous' (each rank gets a
+            contiguous block of rows, which only requires a single hyperslab read for each dataset).
+        :return: A NodeSet
+        """
+        rank = sonata_world_comm.MPI_rank if rank is None else rank
+        size = sonata_world_comm.MPI_size if size is None else size
+        return NodeSet(self._partition_rows(rank, size, strategy), self)
+
+    def sample(self, n=None, frac=None, stratify_by=None, seed=None):
+        """Returns a uniform random sample of the nodes. The rows are picked before anything is read, so only the nodes
+        in the sample are fetched from the hdf5 file (apart from the stratify_by column(s)).
+
+        :param n: number of nodes in the sample (or in each stratum), groups with fewer nodes are included entirely.
+        :param frac: fraction of the nodes (or of each stratum) to sample, use instead of n.
+        :param stratify_by: column name, or list of column names (eg. 'node_type_id'), to sample each unique value
+            separately.
+        :param seed: random seed (or numpy RandomState) for reproducible samples.
+        :return: A NodeSet, in the same order as the nodes appear in the population.
+        """
+        return NodeSet(self._sample_rows(n, frac, stratify_by, seed), self)
 
-    def filter(self, **filter_props):
-        for grp in self.groups:
-            for node in grp.filter(**filter_props):
-                yield node
+    def filter(self, *predicates, **filter_props):
+        """Find all nodes in the population that match a query.
+
+        Queries can be key==value pairs (or membership if value is a list) and/or predicates built using the
+        query module, eg. filter(col('x') > 100.0, model_type='biophysical'). Nodes in a group that doesn't contain a
+        filtered property will not match, if none of the groups (or the node-types table) have the property a KeyError
+        is raised. See NodeGroup.filter() for more details.
+
+        :param predicates: query.Predicate objects
+        :param filter_props: keys and their values to filter nodes on.
+        :return: A NodeSet of matching nodes, in the same order as they appear in the population.
+        """
+        query = build_query(*predicates, **filter_props)
+        check_columns(query, self.has_property)
+        selected_rows = list(self._query_rows(query))
+        selected_rows = np.concatenate(selected_rows) if selected_rows else np.array([], dtype=np.int64)
+        return NodeSet(selected_rows, self)
+
+    def spatial_index(self, columns=None, cell_size=None, path=None, force=False):
+        """Returns a GridIndex of the node positions, which is built the first time it is needed and then kept in
+        memory. Nodes in a group without the position column(s) are not included in the index.
+
+        :param columns: position column(s), either a single (n_nodes, n_dims) column or a list of columns for each
+            dimension. By default will use 'positions' if it exists, otherwise x, y (and z).
+        :param cell_size: width of each cell of the grid, by default chosen from the density of the nodes.
+        :param path: file to save the index to. If the file already exists (and was built with the same columns for a
+            population of the same size) the index is loaded from it rather than reading the positions.
+        :param force: rebuild the index even if it already exists.
+        :return: A GridIndex of population rows
+        """
+        columns = self._position_columns(columns)
+        if self._spatial_index is not None and self._spatial_columns == columns and not force:
+            return self._spatial_index
+
+        index = None
+        if path is not None and os.path.exists(path) and not force:
+            index, metadata = GridIndex.load(path)
+            if list(metadata.get('columns', [])) != list(columns) or int(metadata.get('nrows', -1)) != self._nrows \
+                    or (cell_size is not None and cell_size != index.cell_size):
+                index = None
+
+        if index is None:
+            positions = [self._read_positions(chunk, columns) for chunk in self.iter_chunks(columns=columns)]
+            positions = np.concatenate(positions) if positions else np.zeros((0, len(columns)))
+            index = GridIndex(positions, cell_size=cell_size)
+            if path is not None:
+                index.save(path, columns=np.array(columns), nrows=self._nrows)
+
+        self._spatial_index = index
+        self._spatial_columns = columns
+        return index
+
+    def query_box(self, lower, upper, columns=None):
+        """Find all nodes inside a box, lower <= position <= upper.
+
+        :param lower: position of the lower corner of the box, eg. [x_min, y_min, z_min]
+        :param upper: position of the upper corner of the box
+        :param columns: position column(s) to use, see spatial_index()
+        :return: A NodeSet, in the same order as the nodes appear in the population.
+        """
+        return NodeSet(self.spatial_index(columns=columns).query_box(lower, upper), self)
+
+    def query_radius(self, center, radius, columns=None):
+        """Find all nodes within a distance of center.
+
+        :return: A NodeSet, in the same order as the nodes appear in the population.
+        """
+        return NodeSet(self.spatial_index(columns=columns).query_radius(center, radius), self)
+
+    def k_nearest(self, point, k, columns=None):
+        """Find the k nodes closest to point.
+
+        :return: A NodeSet ordered by the distance of each node to point (closest first).
+        """
+        return NodeSet(self.spatial_index(columns=columns).k_nearest(point, k), self)
+
+    def _position_columns(self, columns):
+        if columns is None:
+            if self.has_property('positions'):
+                columns = ['positions']
+            else:
+                columns = [c for c in ['x', 'y', 'z'] if self.has_property(c)]
+                if len(columns) < 2:
+                    raise KeyError('Unable to find position columns for population {}.'.format(self.name))
+        elif not isinstance(columns, (list, tuple)):
+            columns = [columns]
+
+        return list(columns)
+
+    @staticmethod
+    def _read_positions(chunk, columns):
+        if len(columns) == 1:
+            positions = chunk[columns[0]]
+            if positions.dtype == object:
+                # some nodes are in a group without the column
+                n_dims = max(len(p) for p in positions if p is not None and np.ndim(p) > 0)
+                positions = np.array([p if p is not None and np.ndim(p) > 0 else [np.nan]*n_dims for p in positions],
+                                     dtype=np.float64)
+            return np.asarray(positions, dtype=np.float64).reshape(len(positions), -1)
+        else:
+            return np.column_stack([np.asarray(chunk[c], dtype=np.float64) for c in columns])
 
     def _build_node_id_index(self, force=False):
         if self._node_id_index_built and not force:
             return
 
-        self._index_nid2row = pd.Series(range_itr(self._nrows), index=self._node_id_ds, dtype=self._node_id_ds.dtype)
+        # If node_ids are 0, 1, 2, ... then no need to store the index.
+        build_fnc = lambda: IdIndex.from_dataset(self._node_id_ds).to_arrays()
+        self._index_nid2row = IdIndex.from_arrays(self._load_or_build_index('node_id_index', build_fnc, force=force))
         self._node_id_index_built = True
 
     def _build_group(self, group_id, group_h5):
         return NodeGroup(group_id, group_h5, self)
 
     def __iter__(self):
-        self.__itr_index = 0
+        self.__itr = self._iter_rows()
         return self
 
     def next(self):
         return self.__next__()
 
     def __next__(self):
-        if self.__itr_index >= self._nrows:
-            raise StopIteration
-
-        nxt_node = self.get_row(self.__itr_index)
-        self.__itr_index += 1
-        return nxt_node
+        return next(self.__itr)
 
     def __getitem__(self, item):
         if isinstance(item, slice):
@@ -338,7 +1020,7 @@ class NodePopulation(Population):
             return self.get_row(item)
 
         elif isinstance(item, list):
-            return NodeSet(item)
+            return NodeSet(item, self)
         else:
             print('Unable to get item using {}.'.format(type(item)))
 
@@ -351,20 +1033,30 @@ class EdgePopulation(Population):
             self.lookup_table = lookup_table
             self.edge_table = edge_table
 
-    def __init__(self, pop_name, pop_group, edge_types_tables):
-        super(EdgePopulation, self).__init__(pop_name=pop_name, pop_group=pop_group, types_table=edge_types_tables)
+    def __init__(self, pop_name, pop_group, edge_types_tables, cache=None, index_cache=None, use_memmap=True):
+        super(EdgePopulation, self).__init__(pop_name=pop_name, pop_group=pop_group, types_table=edge_types_tables,
+                                             cache=cache, index_cache=index_cache, use_memmap=use_memmap)
 
         # keep reference to source and target datasets
-        self._source_node_id_ds = pop_group['source_node_id']
-        self._target_node_id_ds = pop_group['target_node_id']
+        self._source_node_id_ds = self.open_dataset(pop_group['source_node_id'])
+        self._target_node_id_ds = self.open_dataset(pop_group['target_node_id'])
 
         self._nrows = len(self._source_node_id_ds)
 
+        self._population_columns = {
+            'source_node_id': self._source_node_id_ds,
+            'target_node_id': self._target_node_id_ds,
+            self.type_ids_column: self._type_id_ds,
+            self.group_id_column: self._group_id_ds,
+            self.group_index_column: self._group_index_ds
+        }
+        self._column_aliases = {'group_id': 'edge_group_id'}
+
         # TODO: Throw an error/warning if missing
         self._source_population = EdgePopulation.get_source_population(pop_group)
         self._target_population = EdgePopulation.get_target_population(pop_group)
 
-        self.__itr_index = 0
+        self.__itr = None
 
         # TODO: use a function pointer for get_index so it doesn't have to run a conditional every time
         # TODO: add property and/or property so user can determine what indicies exists.
@@ -438,8 +1130,8 @@ class EdgePopulation(Population):
                                                                                         'range_to_edge_id'))
 
                 # Cache the index
-                targets_lookup = index_grp['node_id_to_range']
-                edges_range = index_grp['range_to_edge_id']
+                targets_lookup = self.open_dataset(index_grp['node_id_to_range'])
+                edges_range = self.open_dataset(index_grp['range_to_edge_id'])
                 index_obj = self.__IndexStruct(targets_lookup, edges_range)
 
                 # Determine the type of index
@@ -465,171 +1157,191 @@ class EdgePopulation(Population):
         if len(self._group_map) == 1:
             return len(self), [[0, len(self)]]
 
-        grp_indicies = super(EdgePopulation, self).group_indicies(group_id, build_cache=False)
-        if len(grp_indicies) == 0:
+        range_begs, range_ends = self.group_ranges(group_id)
+        if len(range_begs) == 0:
             # Return an index with no ranges
             return 0, []
 
-        # cluster into ranges. Naively implement, there is probably a faster way to cluster an ordered array!
-        range_beg = grp_indicies[0]
-        ranges = []
-        for i in range_itr(1, len(grp_indicies)):
-            if (grp_indicies[i-1]+1) != grp_indicies[i]:
-                ranges.append([range_beg, grp_indicies[i-1]+1])
-                range_beg = grp_indicies[i]
-        ranges.append([range_beg, grp_indicies[-1]+1])
-        return len(grp_indicies), np.array(ranges, dtype=np.uint32)
-
-    '''
-    def _get_target_index(self):
-        # TODO: Do only once
-        if self._targets_index is not None:
+        return int(np.sum(range_ends - range_begs)), np.column_stack((range_begs, range_ends)).astype(self._row_dtype)
+
+    def _get_node_index(self, direction):
+        """Returns the target_to_source (direction='target') or source_to_target index of the population. If the file
+        doesn't have the index it is built the first time it's needed, see _build_node_index()."""
+        if direction == 'target':
+            if self._targets_index is None:
+                self._targets_index = self._build_node_index(self._target_node_id_ds, 'target_to_source')
+                self._has_target_index = True
             return self._targets_index
 
-        if 'incidies' in self._pop_group:
-            if 'target_to_source' in self._pop_group['incidies']:
-                targets_lookup = self._pop_group['incidies']['target_to_source']['node_id_to_range']
-                edges_range = self._pop_group['incidies']['target_to_source']['range_to_edge_id']
-                self._targets_index = self.__IndexStruct(targets_lookup, edges_range)
-                return self._targets_index
+        elif direction == 'source':
+            if self._sources_index is None:
+                self._sources_index = self._build_node_index(self._source_node_id_ds, 'source_to_target')
+                self._has_source_index = True
+            return self._sources_index
 
-        # TODO: What to do if index doesn't exist?
-        raise NotImplementedError
-    '''
+        else:
+            raise ValueError('Unknown index direction {}, must be either "source" or "target".'.format(direction))
+
+    def _build_node_index(self, node_ids_ds, index_name):
+        """Builds a node_id --> edge rows index from the source or target_node_id dataset, in the same (CSR) format as
+        the sonata indices: node_id_to_range[node_id] is the [beg, end) of the node's ranges in range_to_edge_id, and
+        each range in range_to_edge_id is a [beg, end) of edge rows.
+
+        Every run of consecutive edges with the same node_id becomes one range, found by reading the dataset one chunk
+        at a time, so a population that is sorted by node_id only needs one range per node. The ranges are then sorted
+        by node_id with a (stable) argsort. If the File has an index_cache the index is stored with the other indices.
+        """
+        def build_arrays():
+            run_begs, run_ends, run_node_ids = self._find_runs(node_ids_ds)
+            n_nodes = int(np.max(run_node_ids)) + 1 if len(run_node_ids) > 0 else 0
+            run_order = np.argsort(run_node_ids, kind='stable')
+            node_offsets = np.concatenate(([0], np.cumsum(np.bincount(run_node_ids, minlength=n_nodes))))
+            return {
+                'node_id_to_range': np.column_stack((node_offsets[:-1], node_offsets[1:])).astype(np.int64),
+                'range_to_edge_id': np.column_stack((run_begs[run_order], run_ends[run_order])).astype(self._row_dtype)
+            }
+
+        arrays = self._load_or_build_index(index_name, build_arrays)
+        return self.__IndexStruct(arrays['node_id_to_range'], arrays['range_to_edge_id'])
 
     def get_row(self, index):
-        src_node = self._source_node_id_ds[index]
-        trg_node = self._target_node_id_ds[index]
-        edge_type_id = self._type_id_ds[index]
-        edge_types_props = self.edge_types_table[edge_type_id]
-
-        edge_group_id = self._group_id_ds[index]
-        edge_group_index = self._group_index_ds[index]
-        edge_group_props = self.get_group(edge_group_id)[edge_group_index]
-        return Edge(trg_node_id=trg_node, src_node_id=src_node, source_pop=self.source_population,
-                    target_pop=self.target_population, group_id = edge_group_id,
-                    group_props=edge_group_props, edge_types_props=edge_types_props)
-
-    def filter(self, **filter_props):
-        selected_edge_types = set(self.edge_types_table.edge_type_ids)
-        types_filter = False  # Do we need to filter results by edge_type_id
-        if 'edge_type_id' in filter_props:
-            # TODO: Make sure the edge_type_id is valid
-            selected_edge_types = set([filter_props['edge_type_id']])
-            del filter_props['edge_type_id']
-            types_filter = True
-
-        if 'group_id' in filter_props:
-            grp_id = filter_props['group_id']
-            grp_id = [grp_id] if np.isscalar(grp_id) else grp_id
-            selected_groups = set(grp_id)
-            del filter_props['group_id']
-        else:
-            selected_groups = set(self._group_map.keys())  # list of grp_id's that will be used
-
-        group_prop_filter = {}  # list of actual query statements
-        group_filter = False  # do we need to filter results by group_id
-
-        # Go through filter key==value pairs, create filters for groups and edge_types
-        for filter_key, filter_val in filter_props.items():
-            # Find out what groups, if any, the column should search in.
-            group_query = False  # If it's querying a group property don't look in edge_types
-            types_query = False
-            for grp_id, grp_h5 in self._group_map.items():
-                if filter_key in grp_h5:
-                    # TODO: Need to check the dtype's match
-                    selected_groups &= set([grp_id])
-                    group_prop_filter[filter_key] = filter_val
-                    group_query = True
-                    group_filter = True
-
-            if (not group_query) and filter_key in self.edge_types_table.columns:
-                # Presearch the edge types and get only those edge_type_ids which match key==val
-                selected_edge_types &= set(self.edge_types_table.find(filter_key, filter_val))
-                types_filter = True
-                types_query = True
-
-            if not (group_query or types_query):
-                # Property key neither exists in a group or the edge_types_table
-                raise Exception('Could not find property {}'.format(filter_key))
-
-        # Iterate through all nodes, only returning those that match the filter
-        for indx in range_itr(self._nrows):
-            # Filter by edge_type_id
-            if types_filter:
-                # TODO: Invert the selected_edge_types, it will be faster to fail immeditely than search the entire list
-                if self._type_id_ds[indx] not in selected_edge_types:
-                    continue
+        return Edge(ColumnBlock(self, row_range=(index, index + 1)), 0)
 
-            # Filter by group properties
-            if group_filter:
-                # TODO: Invert group search
-                grp_id = self._group_id_ds[indx]
-                if grp_id not in selected_groups:
-                    continue
+    def _build_record(self, block, offset):
+        return Edge(block, offset)
 
-                grp_index = self._group_index_ds[indx]
-                search_failed = True
-                for prop_key, prop_val in group_prop_filter.items():
-                    if prop_val != self._group_map[grp_id][prop_key][grp_index]:
-                        break
-                else:
-                    search_failed = False
+    def sample(self, n=None, frac=None, stratify_by=None, seed=None):
+        """Returns a uniform random sample of the edges, see NodePopulation.sample(). Use stratify_by to sample each
+        pathway separately, eg. stratify_by=['source_node_id', 'edge_type_id'].
 
-                if search_failed:
-                    continue
+        :return: An EdgeSet, in the same order as the edges appear in the population.
+        """
+        return EdgeSet(self._sample_rows(n, frac, stratify_by, seed), self)
 
-            yield self.get_row(indx)
+    def filter(self, *predicates, **filter_props):
+        """Find all edges that match a query.
+
+        Queries can be key==value pairs (or membership if value is a list) and/or predicates built using the query
+        module, eg. filter(col('syn_weight').between(0.5, 1.0), edge_type_id=[101, 102]). Properties may be in
+        the edge-types table, one of the groups, or a population column (source_node_id, group_id, etc).
+
+        :param predicates: query.Predicate objects
+        :param filter_props: keys and their values to filter edges on.
+        :return: A generator of all matching edges.
+        """
+        # Iterate through the population in chunks, Edge objects are only created for the rows that match the filter
+        for selected_rows in self.filter_rows(*predicates, **filter_props):
+            for edge in self._iter_rows(selected_rows):
+                yield edge
+
+    def filter_rows(self, *predicates, **filter_props):
+        """Like filter(), but instead of Edge objects returns the population rows of the matching edges. The population
+        is read in contiguous chunks (of FILTER_CHUNK_SIZE rows) and the query is evaluated on each as numpy masks.
+
+        :return: A generator of (sorted, non-empty) arrays of matching rows, one for each chunk.
+        """
+        query = build_query(*predicates, **filter_props)
+        check_columns(query, self.has_property)
+        return self._query_rows(query)
+
+    def select(self, *predicates, **filter_props):
+        """Like filter(), but returns all the matching edges as an EdgeSet.
+
+        :return: An EdgeSet, in the same order as the edges appear in the population.
+        """
+        selected_rows = list(self.filter_rows(*predicates, **filter_props))
+        return EdgeSet(np.concatenate(selected_rows) if selected_rows else np.zeros(0, dtype=np.int64), self)
+
+    def partition(self, rank=None, size=None, strategy='target', target_node_ids=None):
+        """Returns the subset of edges that belong to one rank, for splitting the population between MPI processes.
+        Only the rows (or index ranges) of the partition are read, for the 'target' strategy the target index is built
+        first if the file doesn't have one.
+
+        :param rank: rank of the partition, by default the MPI rank of the process
+        :param size: number of partitions, by default the number of MPI processes
+        :param strategy: either 'round_robin', 'contiguous' (see NodePopulation.partition) or 'target', where every
+            edge is assigned to the same rank as its target node. Target nodes are split round-robin by node_id,
+            which matches NodePopulation.partition(strategy='round_robin') when node_ids are 0, 1, ..., N-1.
+        :param target_node_ids: for the 'target' strategy, the list of target nodes owned by this rank (eg. the
+            node_ids of a node partition) instead of using round-robin.
+        :return: An EdgeSet
+        """
+        rank = sonata_world_comm.MPI_rank if rank is None else rank
+        size = sonata_world_comm.MPI_size if size is None else size
+        if strategy != 'target':
+            return EdgeSet(self._partition_rows(rank, size, strategy), self)
+
+        if not 0 <= rank < size:
+            raise ValueError('Invalid partition rank {} of size {}.'.format(rank, size))
+
+        # Use the target index (built the first time if the file doesn't have one) so only the edge ranges of this
+        # rank's nodes are read
+        targets_index = self._get_node_index('target')
+        if target_node_ids is None:
+            target_node_ids = np.arange(rank, len(targets_index.lookup_table), size)
+        return EdgeSet(np.sort(self._index_rows(targets_index, target_node_ids)), self)
+
+    def _index_rows(self, index_struct, lookup_ids):
+        """Uses a source/target index to find all the edge rows for a list of node_ids. Rather than one lookup per
+        node the index datasets are read using batched reads, and edge ranges that follow on from each other (eg.
+        consecutive target nodes of an edge file sorted by target) are merged before being expanded into rows.
+
+        :return: array of edge rows, ordered by lookup_ids
+        """
+        lookup_ids = np.asarray(lookup_ids, dtype=np.int64).reshape(-1)
+        lookup_ids = lookup_ids[(lookup_ids >= 0) & (lookup_ids < len(index_struct.lookup_table))]
+        if len(lookup_ids) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        lookup_ranges = self._cache.read(index_struct.lookup_table, lookup_ids).astype(np.int64)
+        range_indicies = expand_ranges(lookup_ranges[:, 0], lookup_ranges[:, 1])
+        if len(range_indicies) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        edge_ranges = self._cache.read(index_struct.edge_table, range_indicies).astype(np.int64)
+        range_begs, range_ends = edge_ranges[:, 0], edge_ranges[:, 1]
+        is_new_range = np.concatenate(([True], range_begs[1:] != range_ends[:-1]))
+        if not np.all(is_new_range):
+            merged_begs = np.flatnonzero(is_new_range)
+            range_begs = range_begs[merged_begs]
+            range_ends = range_ends[np.concatenate((merged_begs[1:], [len(is_new_range)])) - 1]
+        return expand_ranges(range_begs, range_ends)
 
     def get_target(self, target_node_id):
-        # TODO: Raise an exception, or call find() and log a warning that the index is not available
-        # TODO: check validity of target_node_id (non-negative integer and smaller than index range)
-        assert(self._has_target_index)
-        return self._get_index(self._targets_index, target_node_id)
+        """Returns all the edges that target a node, see get_targets()"""
+        return self.get_targets([target_node_id])
 
     def get_targets(self, target_node_ids):
-        # TODO: verify input is iterable
-        assert(self._has_target_index)
-        trg_index = self._targets_index
-        for trg_id in target_node_ids:
-            for edge in self._get_index(trg_index, trg_id):
-                yield edge
+        """Returns all the edges that target a list of nodes, using the target_to_source index (which is built if
+        the file doesn't have one).
+
+        All the lookups are done at once: the node_id_to_range rows of every node are read together, followed by all
+        their range_to_edge_id rows, using coalesced reads. Properties of the edges can then be gathered for the whole
+        set, eg. get_targets(node_ids).get_properties('syn_weight') or .to_dataframe(), rather than one Edge at a time.
+
+        :param target_node_ids: list or array of node_ids, node_ids without any edges are ignored.
+        :return: An EdgeSet, ordered by target_node_ids (and by row for the edges of each node).
+        """
+        return EdgeSet(self._index_rows(self._get_node_index('target'), _as_id_array(target_node_ids)), self)
 
     def get_source(self, source_node_id):
-        assert(self._has_source_index)
-        return self._get_index(self._sources_index, source_node_id)
+        """Returns all the edges from a node, see get_sources()"""
+        return self.get_sources([source_node_id])
 
     def get_sources(self, source_node_ids):
-        assert(self._has_target_index)
-        trg_index = self._sources_index
-        for src_id in source_node_ids:
-            for edge in self._get_index(trg_index, src_id):
-                yield edge
-
-    def _get_index(self, index_struct, lookup_id):
-        # TODO: Use a EdgeSet instead
-        if lookup_id >= len(index_struct.lookup_table):
-            # TODO: Store length in index
-            raise StopIteration
+        """Returns all the edges from a list of nodes using the source_to_target index, see get_targets().
 
-        edges_table = index_struct.edge_table
-        lookup_beg, lookup_end = index_struct.lookup_table[lookup_id]
-        for i in range_itr(lookup_beg, lookup_end):
-            edge_indx_beg, edge_indx_end = edges_table[i]
-            for edge_indx in range_itr(edge_indx_beg, edge_indx_end):
-                yield self.get_row(edge_indx)
+        :param source_node_ids: list or array of node_ids, node_ids without any edges are ignored.
+        :return: An EdgeSet, ordered by source_node_ids (and by row for the edges of each node).
+        """
+        return EdgeSet(self._index_rows(self._get_node_index('source'), _as_id_array(source_node_ids)), self)
 
     def __iter__(self):
-        self.__itr_index = 0
+        self.__itr = self._iter_rows()
         return self
 
     def __next__(self):
-        if self.__itr_index >= self._nrows:
-            raise StopIteration
-
-        next_edge = self.get_row(self.__itr_index)
-        self.__itr_index += 1
-        return next_edge
+        return next(self.__itr)
 
     def next(self):
         return self.__next__()
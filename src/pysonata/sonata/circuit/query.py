@@ -0,0 +1,422 @@
+# Copyright 2019. Allen Institute. All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+# disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following
+# disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+"""Predicates for filtering node and edge populations.
+
+A predicate is built from column references and can be combined using the & (and), | (or) and ~ (not) operators:
+
+    from sonata.circuit.query import col
+    pred = (col('syn_weight').between(0.5, 1.0) | (col('nsyns') > 10)) & ~col('model_template').startswith('nrn:')
+    for edge in edges.filter(pred):
+        ...
+
+Predicates are evaluated on arrays of column values (one chunk of the population at a time) and return a boolean mask.
+For a row whose group doesn't contain the column the leaf predicate will evaluate to False. Missing values are not
+treated specially by ~ (not), so ~(col('tuning_angle') == 0.0) also matches every row in a group without a
+tuning_angle column. Use col('tuning_angle').exists() to only select the rows that have the column:
+
+    (col('tuning_angle') != 0.0) & col('tuning_angle').exists()
+
+Multi-dimensional columns (eg. positions) are compared row by row, a comparison (or between) is True only if it is True
+for every element of the row, and isin is True if the row is equal to one of the given rows.
+"""
+import re
+import operator
+import numpy as np
+import six
+
+
+class Predicate(object):
+    """Base class for a (compiled) query statement."""
+
+    @property
+    def columns(self):
+        """Set of column names used by the predicate"""
+        raise NotImplementedError
+
+    @property
+    def leaves(self):
+        """List of all the individual column predicates"""
+        raise NotImplementedError
+
+    def evaluate(self, leaf_mask):
+        """Evaluates predicate, returning a boolean mask.
+
+        :param leaf_mask: function that takes a ColumnPredicate and returns a boolean mask for the current chunk.
+        :return: numpy boolean array
+        """
+        raise NotImplementedError
+
+    def __and__(self, other):
+        return And(self, as_predicate(other))
+
+    def __or__(self, other):
+        return Or(self, as_predicate(other))
+
+    def __invert__(self):
+        return Not(self)
+
+
+class ColumnPredicate(Predicate):
+    """A predicate on a single column, the leaf of any query"""
+    def __init__(self, column):
+        self._column = column
+
+    @property
+    def column(self):
+        return self._column
+
+    @property
+    def columns(self):
+        return {self._column}
+
+    @property
+    def leaves(self):
+        return [self]
+
+    def evaluate(self, leaf_mask):
+        return leaf_mask(self)
+
+    def mask(self, values):
+        """Returns a boolean mask for an array of column values"""
+        raise NotImplementedError
+
+
+class Compare(ColumnPredicate):
+    _ops = {
+        '==': operator.eq,
+        '!=': operator.ne,
+        '<': operator.lt,
+        '<=': operator.le,
+        '>': operator.gt,
+        '>=': operator.ge
+    }
+
+    def __init__(self, column, op, value):
+        super(Compare, self).__init__(column)
+        if op not in self._ops:
+            raise ValueError('Unknown comparison operator {}'.format(op))
+        self._op = op
+        self._value = value
+
+    def mask(self, values):
+        values = _decode_strings(values, self._value)
+        mask = self._ops[self._op](values, self._value)
+        if values.ndim > 1:
+            # multi-dimensional columns (eg. positions) are compared row by row
+            mask = np.all(mask, axis=1) if self._op != '!=' else np.any(mask, axis=1)
+        return np.asarray(mask, dtype=bool)
+
+    def __repr__(self):
+        return '{} {} {!r}'.format(self.column, self._op, self._value)
+
+
+class IsIn(ColumnPredicate):
+    def __init__(self, column, values):
+        super(IsIn, self).__init__(column)
+        self._values = list(values)
+
+    def mask(self, values):
+        values = _decode_strings(values, self._values[0] if self._values else None)
+        if values.ndim > 1:
+            return self._row_mask(values)
+        return np.isin(values, self._values)
+
+    def _row_mask(self, values):
+        # for multi-dimensional columns each value is a whole row, eg. isin([[x0, y0, z0], [x1, y1, z1]])
+        rows = np.asarray(self._values)
+        if len(self._values) == 0:
+            return np.zeros(len(values), dtype=bool)
+
+        rows = rows.reshape(1, -1) if rows.ndim == 1 else rows
+        if rows.ndim != 2 or rows.shape[1] != values.shape[1]:
+            raise ValueError('Column {} has rows of size {}, unable to check membership of {!r}.'.format(
+                self.column, values.shape[1], self._values))
+
+        mask = np.zeros(len(values), dtype=bool)
+        for row in rows:
+            mask |= np.all(values == row, axis=1)
+        return mask
+
+    def __repr__(self):
+        return '{} in {!r}'.format(self.column, self._values)
+
+
+class Between(ColumnPredicate):
+    """Range check, by default lower <= x < upper. Set inclusive to 'both', 'neither', 'left' or 'right' to change."""
+    def __init__(self, column, lower, upper, inclusive='left'):
+        super(Between, self).__init__(column)
+        if inclusive not in ['both', 'neither', 'left', 'right']:
+            raise ValueError('inclusive must be either "both", "neither", "left" or "right"')
+        self._lower = lower
+        self._upper = upper
+        self._inclusive = inclusive
+
+    def mask(self, values):
+        lower_op = operator.ge if self._inclusive in ['both', 'left'] else operator.gt
+        upper_op = operator.le if self._inclusive in ['both', 'right'] else operator.lt
+        mask = np.ones(values.shape, dtype=bool)
+        if self._lower is not None:
+            mask &= lower_op(values, self._lower)
+        if self._upper is not None:
+            mask &= upper_op(values, self._upper)
+        if values.ndim > 1:
+            # multi-dimensional columns (eg. positions) have to be in range for every element of the row
+            mask = np.all(mask.reshape(len(values), -1), axis=1)
+        return mask
+
+    def __repr__(self):
+        lbracket = '[' if self._inclusive in ['both', 'left'] else '('
+        rbracket = ']' if self._inclusive in ['both', 'right'] else ')'
+        return '{} in {}{}, {}{}'.format(self.column, lbracket, self._lower, self._upper, rbracket)
+
+
+class StringMatch(ColumnPredicate):
+    """String matching, either 'startswith', 'endswith', 'contains' (substring) or 'match' (regular expression)"""
+    def __init__(self, column, method, pattern):
+        super(StringMatch, self).__init__(column)
+        if method not in ['startswith', 'endswith', 'contains', 'match']:
+            raise ValueError('Unknown string match {}'.format(method))
+        self._method = method
+        self._pattern = pattern
+        if method == 'match':
+            regex = re.compile(pattern)
+            self._match_fnc = lambda s: regex.search(s) is not None
+        elif method == 'contains':
+            self._match_fnc = lambda s: pattern in s
+        else:
+            self._match_fnc = lambda s: getattr(s, method)(pattern)
+
+    def mask(self, values):
+        values = _decode_strings(values, '')
+        if len(values) == 0:
+            return np.zeros(0, dtype=bool)
+
+        # Strings are typically categorical (model_template, pop_name, etc) so only check the unique values
+        uniques, inverse = np.unique(np.asarray(values, dtype=object).astype(str), return_inverse=True)
+        is_match = np.array([self._match_fnc(u) for u in uniques], dtype=bool)
+        mask = is_match[inverse.reshape(-1)]
+        if values.dtype == object:
+            # missing values (None/NaN in a csv) never match
+            mask &= np.array([isinstance(v, six.string_types) for v in values], dtype=bool)
+        return mask
+
+    def __repr__(self):
+        return '{}.{}({!r})'.format(self.column, self._method, self._pattern)
+
+
+class Exists(ColumnPredicate):
+    """True for every row that has the column, ie. belongs to a group (or types table) that contains it"""
+    def mask(self, values):
+        return np.ones(len(values), dtype=bool)
+
+    def __repr__(self):
+        return '{}.exists()'.format(self.column)
+
+
+class And(Predicate):
+    def __init__(self, left, right):
+        self._left = left
+        self._right = right
+
+    @property
+    def columns(self):
+        return self._left.columns | self._right.columns
+
+    @property
+    def leaves(self):
+        return self._left.leaves + self._right.leaves
+
+    def evaluate(self, leaf_mask):
+        mask = self._left.evaluate(leaf_mask)
+        if not np.any(mask):
+            # Don't bother reading columns for the right side
+            return mask
+        return mask & self._right.evaluate(leaf_mask)
+
+    def __repr__(self):
+        return '({!r}) & ({!r})'.format(self._left, self._right)
+
+
+class Or(Predicate):
+    def __init__(self, left, right):
+        self._left = left
+        self._right = right
+
+    @property
+    def columns(self):
+        return self._left.columns | self._right.columns
+
+    @property
+    def leaves(self):
+        return self._left.leaves + self._right.leaves
+
+    def evaluate(self, leaf_mask):
+        mask = self._left.evaluate(leaf_mask)
+        if np.all(mask):
+            return mask
+        return mask | self._right.evaluate(leaf_mask)
+
+    def __repr__(self):
+        return '({!r}) | ({!r})'.format(self._left, self._right)
+
+
+class Not(Predicate):
+    """Negation of a predicate. Rows without a column evaluate to False for any predicate on that column before being
+    negated, so they will match the negated predicate (see the module docs and Column.exists())."""
+    def __init__(self, pred):
+        self._pred = pred
+
+    @property
+    def columns(self):
+        return self._pred.columns
+
+    @property
+    def leaves(self):
+        return self._pred.leaves
+
+    def evaluate(self, leaf_mask):
+        return ~self._pred.evaluate(leaf_mask)
+
+    def __repr__(self):
+        return '~({!r})'.format(self._pred)
+
+
+class Column(object):
+    """Reference to a node/edge property, used to build predicates."""
+    def __init__(self, name):
+        self._name = name
+
+    @property
+    def name(self):
+        return self._name
+
+    def __eq__(self, other):
+        return Compare(self._name, '==', other)
+
+    def __ne__(self, other):
+        return Compare(self._name, '!=', other)
+
+    def __lt__(self, other):
+        return Compare(self._name, '<', other)
+
+    def __le__(self, other):
+        return Compare(self._name, '<=', other)
+
+    def __gt__(self, other):
+        return Compare(self._name, '>', other)
+
+    def __ge__(self, other):
+        return Compare(self._name, '>=', other)
+
+    __hash__ = None
+
+    def isin(self, values):
+        return IsIn(self._name, values)
+
+    def between(self, lower, upper, inclusive='left'):
+        return Between(self._name, lower, upper, inclusive)
+
+    def startswith(self, prefix):
+        return StringMatch(self._name, 'startswith', prefix)
+
+    def endswith(self, suffix):
+        return StringMatch(self._name, 'endswith', suffix)
+
+    def contains(self, substring):
+        return StringMatch(self._name, 'contains', substring)
+
+    def match(self, pattern):
+        return StringMatch(self._name, 'match', pattern)
+
+    def exists(self):
+        return Exists(self._name)
+
+    def __repr__(self):
+        return 'col({!r})'.format(self._name)
+
+
+def col(name):
+    """Creates a reference to a column that can be used to build a predicate, eg col('x') > 100.0. A predicate is False
+    for rows that don't have the column, including when it is negated with ~ (use col(name).exists() to exclude them).
+    """
+    return Column(name)
+
+
+def as_predicate(obj):
+    if not isinstance(obj, Predicate):
+        raise TypeError('Unable to use {} as a query predicate.'.format(obj))
+    return obj
+
+
+def build_query(*predicates, **filter_props):
+    """Combines a list of predicates and key==value pairs into a single predicate. If the value of a key is a list
+    then it is treated as a membership test. A key's value may also be a predicate on that same column, eg.
+    filter(x=col('x') > 10.0), but usually predicates are just passed in as positional arguments.
+
+    :return: A Predicate, or None if there is nothing to filter on.
+    """
+    query = None
+    statements = [as_predicate(p) for p in predicates]
+    for key, val in filter_props.items():
+        if isinstance(val, Predicate):
+            if val.columns != {key}:
+                raise ValueError('Predicate {!r} for {} uses column(s) {}, pass it as a positional argument '
+                                 'instead.'.format(val, key, sorted(val.columns)))
+            statements.append(val)
+        elif isinstance(val, (list, tuple, set, np.ndarray)):
+            statements.append(IsIn(key, val))
+        else:
+            statements.append(Compare(key, '==', val))
+
+    for stmt in statements:
+        query = stmt if query is None else And(query, stmt)
+
+    return query
+
+
+def check_columns(query, has_property):
+    """Raises a KeyError if a query uses a property that doesn't exist.
+
+    :param query: A Predicate (or None)
+    :param has_property: function that returns True if a property name exists, eg. Population.has_property
+    """
+    if query is None:
+        return
+
+    for col_name in sorted(query.columns):
+        if not has_property(col_name):
+            raise KeyError('Could not find property {}'.format(col_name))
+
+
+def _decode_strings(values, query_val):
+    """hdf5 strings are often returned as bytes, convert them if they are being compared to a str"""
+    if not isinstance(query_val, six.string_types) or len(values) == 0:
+        return values
+
+    if values.dtype.kind == 'S':
+        return values.astype(str)
+    elif values.dtype == object and isinstance(values.flat[0], bytes):
+        return np.array([v.decode() if isinstance(v, bytes) else v for v in values.flat],
+                        dtype=object).reshape(values.shape)
+    else:
+        return values
@@ -0,0 +1,204 @@
+# Copyright 2019. Allen Institute. All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without modification, are permitted provided that the
+# following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this list of conditions and the following
+# disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice, this list of conditions and the following
+# disclaimer in the documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+# INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+import numpy as np
+
+from .utils import expand_ranges
+
+
+# Average number of points in each cell of the grid when the cell size isn't specified
+NODES_PER_CELL = 8
+
+# The grid is never allowed to have more than this many cells per point (eg. if cell_size is too small)
+MAX_CELLS_RATIO = 4
+
+
+class GridIndex(object):
+    """A uniform grid over a set of 2D or 3D points (node positions), for finding the points in a region.
+
+    The bounding box of the points is split into cubic cells and the points are stored sorted by the cell they fall
+    in, along with the offset of the first point of every cell. A region query only has to look at the points in the
+    cells that overlap the region, so the cost scales with the size of the result rather than the number of points.
+    """
+    def __init__(self, positions, rows=None, cell_size=None):
+        positions = np.asarray(positions, dtype=np.float64)
+        if positions.ndim != 2:
+            raise ValueError('positions must be a 2D array of shape (n_points, n_dims).')
+
+        rows = np.arange(len(positions), dtype=np.int64) if rows is None else np.asarray(rows, dtype=np.int64)
+        has_position = np.all(np.isfinite(positions), axis=1)
+        if not np.all(has_position):
+            # nodes without a position (eg. in a group without the column) are never returned
+            positions = positions[has_position]
+            rows = rows[has_position]
+
+        self._ndims = positions.shape[1]
+        self._lower = np.min(positions, axis=0) if len(positions) > 0 else np.zeros(self._ndims)
+        self._upper = np.max(positions, axis=0) if len(positions) > 0 else np.zeros(self._ndims)
+        self._cell_size = self._find_cell_size(len(positions), cell_size)
+        self._shape = self._grid_shape(self._cell_size)
+
+        cell_ids = self._cell_ids(positions)
+        order = np.argsort(cell_ids, kind='stable')
+        self._positions = positions[order]
+        self._rows = rows[order]
+        cell_counts = np.bincount(cell_ids, minlength=int(np.prod(self._shape)))
+        self._cell_starts = np.concatenate(([0], np.cumsum(cell_counts))).astype(np.int64)
+
+    @classmethod
+    def load(cls, path):
+        """Loads an index saved with GridIndex.save().
+
+        :return: tuple of (GridIndex, dictionary of the metadata saved with the index)
+        """
+        with np.load(path, allow_pickle=False) as arrays:
+            index = cls.__new__(cls)
+            index._positions = arrays['positions']
+            index._rows = arrays['rows']
+            index._cell_starts = arrays['cell_starts']
+            index._lower = arrays['lower']
+            index._upper = arrays['upper']
+            index._shape = tuple(int(s) for s in arrays['shape'])
+            index._cell_size = float(arrays['cell_size'])
+            index._ndims = len(index._shape)
+            metadata = {k[5:]: arrays[k] for k in arrays.files if k.startswith('meta_')}
+
+        return index, metadata
+
+    @property
+    def ndims(self):
+        return self._ndims
+
+    @property
+    def cell_size(self):
+        return self._cell_size
+
+    @property
+    def shape(self):
+        """number of cells along each dimension"""
+        return self._shape
+
+    @property
+    def bounds(self):
+        """(lower, upper) corners of the bounding box of all the points"""
+        return self._lower, self._upper
+
+    @property
+    def nbytes(self):
+        return self._positions.nbytes + self._rows.nbytes + self._cell_starts.nbytes
+
+    def save(self, path, **metadata):
+        """Saves the index to a numpy .npz file, along with any metadata (arrays or scalars) needed to check the
+        index is still valid when it gets loaded."""
+        arrays = {'meta_{}'.format(k): np.asarray(v) for k, v in metadata.items()}
+        with open(path, 'wb') as f:
+            np.savez(f, positions=self._positions, rows=self._rows, cell_starts=self._cell_starts, lower=self._lower,
+                     upper=self._upper, shape=np.array(self._shape), cell_size=self._cell_size, **arrays)
+
+    def query_box(self, lower, upper):
+        """Returns the rows of all the points with lower <= position <= upper (for every dimension).
+
+        :return: sorted array of rows
+        """
+        lower = self._as_point(lower)
+        upper = self._as_point(upper)
+        candidates = self._candidates(lower, upper)
+        positions = self._positions[candidates]
+        in_box = np.all((positions >= lower) & (positions <= upper), axis=1)
+        return np.sort(self._rows[candidates[in_box]])
+
+    def query_radius(self, center, radius):
+        """Returns the rows of all the points within radius (inclusive) of center.
+
+        :return: sorted array of rows
+        """
+        center = self._as_point(center)
+        candidates = self._candidates(center - radius, center + radius)
+        dists2 = np.sum((self._positions[candidates] - center)**2, axis=1)
+        return np.sort(self._rows[candidates[dists2 <= radius**2]])
+
+    def k_nearest(self, point, k):
+        """Returns the rows of the k points nearest to point, ordered by their distance (ties are ordered by row).
+        If there are fewer than k points they are all returned.
+
+        :return: array of rows
+        """
+        point = self._as_point(point)
+        k = min(int(k), len(self._rows))
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64)
+
+        # Start with a search radius that would be expected to hold k points and keep doubling it until it does.
+        radius = self._cell_size*max(1.0, (float(k)/NODES_PER_CELL)**(1.0/self._ndims))
+        while True:
+            candidates = self._candidates(point - radius, point + radius)
+            dists2 = np.sum((self._positions[candidates] - point)**2, axis=1)
+            covers_all = np.all(point - radius <= self._lower) and np.all(point + radius >= self._upper)
+            if covers_all or np.count_nonzero(dists2 <= radius**2) >= k:
+                rows = self._rows[candidates]
+                return rows[np.lexsort((rows, dists2))[:k]]
+            radius *= 2.0
+
+    def _as_point(self, point):
+        point = np.asarray(point, dtype=np.float64).reshape(-1)
+        if len(point) != self._ndims:
+            raise ValueError('Expected a point with {} dimensions, got {}.'.format(self._ndims, len(point)))
+        return point
+
+    def _candidates(self, lower, upper):
+        """Returns the (sorted) positions of all the points in the cells that overlap the box [lower, upper]"""
+        if len(self._rows) == 0 or np.any(lower > upper) or np.any(upper < self._lower) or \
+                np.any(lower > self._upper):
+            return np.zeros(0, dtype=np.int64)
+
+        max_coords = np.array(self._shape) - 1
+        lower_coords = np.clip(np.floor((lower - self._lower)/self._cell_size), 0, max_coords).astype(np.int64)
+        upper_coords = np.clip(np.floor((upper - self._lower)/self._cell_size), 0, max_coords).astype(np.int64)
+        cell_coords = np.meshgrid(*[np.arange(l, u + 1) for l, u in zip(lower_coords, upper_coords)], indexing='ij')
+        cells = np.ravel_multi_index([c.reshape(-1) for c in cell_coords], self._shape)
+        return expand_ranges(self._cell_starts[cells], self._cell_starts[cells + 1])
+
+    def _cell_ids(self, positions):
+        max_coords = np.array(self._shape) - 1
+        coords = np.clip(np.floor((positions - self._lower)/self._cell_size), 0, max_coords).astype(np.int64)
+        return np.ravel_multi_index(coords.T, self._shape) if len(positions) > 0 else np.zeros(0, dtype=np.int64)
+
+    def _grid_shape(self, cell_size):
+        return tuple(int(s) for s in np.floor((self._upper - self._lower)/cell_size).astype(np.int64) + 1)
+
+    def _find_cell_size(self, n_points, cell_size):
+        extents = self._upper - self._lower
+        if cell_size is None:
+            # Choose a size so that on average each cell has NODES_PER_CELL points, ignoring any flat dimensions
+            extents = extents[extents > 0]
+            if n_points == 0 or len(extents) == 0:
+                return 1.0
+            cell_volume = np.prod(extents)*NODES_PER_CELL/float(n_points)
+            cell_size = cell_volume**(1.0/len(extents))
+
+        if cell_size <= 0:
+            raise ValueError('cell_size must be a positive number.')
+
+        max_cells = MAX_CELLS_RATIO*max(n_points, 1)
+        while np.prod(np.array(self._grid_shape(cell_size), dtype=np.float64)) > max_cells:
+            cell_size *= 2.0
+        return float(cell_size)
@@ -28,6 +28,11 @@ import math
 from .column_property import ColumnProperty
 
 
+# Use a dense type_id --> index array when the range of the type_ids is no larger than this many times the number of
+# types, otherwise fall back to a binary search.
+DENSE_INDEX_RATIO = 16
+
+
 def remove_nans(types_dict):
     """Convert nan values to None in type row (dict)"""
     for k, v in types_dict.items():
@@ -47,8 +52,19 @@ class TypesTable(object):
         self._cached_node_types = {}
         self._df_cache = None
 
+        # Dense lookup tables, built by build_indicies() once all the tables are added. Every column is stored as an
+        # array with one value for each type_id (in sorted order), so a column can be broadcast onto a list of type_ids
+        # with a single take.
+        self._sorted_type_ids = None
+        self._dense_index = None  # type_id - _dense_offset --> index in _sorted_type_ids (or -1), None if too sparse
+        self._dense_offset = 0
+        self._column_arrays = {}  # column name --> array of values, aligned with _sorted_type_ids
+        self._column_categories = {}  # column name --> (codes, categories) for non-numeric columns
+        self._inverted_index = {}  # column name --> {value: sorted array of type_ids with that value}
+
         self._itr_indx = 0
         self._itr_end = 0
+        self._itr_ids = []
 
     @property
     def index_column_name(self):
@@ -56,7 +72,7 @@ class TypesTable(object):
 
     @property
     def type_ids(self):
-        return self._index_typeid2df.keys()
+        return list(self._index_typeid2df.keys())
 
     @property
     def columns(self):
@@ -77,6 +93,15 @@ class TypesTable(object):
                 raise Exception('Multiple {}s with value {}.'.format(self.index_column_name, type_id))
             self._index_typeid2df[type_id] = nt_df
 
+        # invalidate any lookup tables
+        self._df_cache = None
+        self._sorted_type_ids = None
+        self._dense_index = None
+        self._column_arrays = {}
+        self._column_categories = {}
+        self._inverted_index = {}
+        self._cached_node_types = {}
+
         columns = ColumnProperty.from_csv(nt_df)
         for col in columns:
             self._columns[col.name] = col
@@ -94,25 +119,154 @@ class TypesTable(object):
         :param silent: Set to true to prevent KeyError if column_key doesn't exist (default=False)
         :return: A (potentially empty) list of type_ids
         """
-        if not silent and column_key not in self.columns:
-            raise KeyError
-
-        is_list = isinstance(column_val, list)
-        selected_ids = []  # running list of valid type-ids
-        column_dtype = self.column(column_key).dtype
-        for df in self._column_map[column_key]:
-            # if a csv column has all NONE values, pandas will load the values as float(NaN)'s. Thus for str/object
-            # columns we need to check dtype otherwise we'll get an invalid comparisson.
-            if df[column_key].dtype == column_dtype:
-                if is_list:
-                    indicies = df[df[column_key].isin(column_val)].index
-                else:
-                    indicies = df[df[column_key] == column_val].index
-
-                if len(indicies) > 0:
-                    selected_ids.extend(list(indicies))
-
-        return selected_ids
+        if column_key not in self._columns:
+            if silent:
+                return []
+            raise KeyError(column_key)
+
+        # Use the inverted index of value --> type_ids rather than comparing every row of the column
+        self.build_indicies()
+        value_index = self._inverted_index[column_key]
+        if isinstance(column_val, list):
+            matches = [value_index[v] for v in column_val if v in value_index]
+            return list(np.unique(np.concatenate(matches))) if matches else []
+        else:
+            return list(value_index.get(column_val, []))
+
+    def type_indicies(self, type_ids):
+        """Converts an array of type_ids into their position in the dense lookup tables.
+
+        :param type_ids: array of node/edge_type_ids
+        :return: array of indicies, same size as type_ids
+        """
+        self.build_indicies()
+        type_ids = np.asarray(type_ids)
+        if self._dense_index is not None:
+            offsets = type_ids.astype(np.int64) - self._dense_offset
+            valid = (offsets >= 0) & (offsets < len(self._dense_index))
+            indicies = np.full(type_ids.shape, -1, dtype=np.int64)
+            indicies[valid] = self._dense_index[offsets[valid]]
+            valid = indicies >= 0
+        else:
+            n_types = len(self._sorted_type_ids)
+            indicies = np.searchsorted(self._sorted_type_ids, type_ids)
+            valid = indicies < n_types
+            valid[valid] = self._sorted_type_ids[indicies[valid]] == type_ids[valid]
+
+        if not np.all(valid):
+            raise KeyError('{}(s) {} not found'.format(self.index_column_name, np.unique(type_ids[~valid])[:10]))
+        return indicies
+
+    def column_values(self, column_name):
+        """Returns an array of all the values of a column, in the order of the sorted type_ids."""
+        self.build_indicies()
+        if column_name == self.index_column_name:
+            return self._sorted_type_ids
+        return self._column_arrays[column_name]
+
+    def broadcast(self, column_name, type_ids, categorical=False):
+        """Returns the value of a column for each of the type_ids.
+
+        :param column_name: name of types-table column
+        :param type_ids: array of node/edge_type_ids, may contain repeats and be in any order.
+        :param categorical: Set to True to return non-numeric columns as a pandas.Categorical
+        :return: An array of values, same size as type_ids
+        """
+        indicies = self.type_indicies(type_ids)
+        if categorical and column_name in self._column_categories:
+            codes, categories = self._column_categories[column_name]
+            return pd.Categorical.from_codes(codes.take(indicies), categories)
+
+        return self.column_values(column_name).take(indicies, axis=0)
+
+    def evaluate(self, predicate):
+        """Evaluates a predicate (see query module) on the types table
+
+        :param predicate: A query.Predicate object
+        :return: boolean array, one value for each type (in the order of the sorted type_ids)
+        """
+        self.build_indicies()
+
+        def leaf_mask(leaf):
+            if leaf.column == self.index_column_name:
+                return leaf.mask(self._sorted_type_ids)
+            elif leaf.column in self._column_arrays:
+                return leaf.mask(self._column_arrays[leaf.column])
+            else:
+                return np.zeros(len(self._sorted_type_ids), dtype=bool)
+
+        return predicate.evaluate(leaf_mask)
+
+    def select(self, predicate):
+        """Returns a list of type_ids whose properties matches a predicate on a types column (see query module)
+
+        :param predicate: A query.Predicate object
+        :return: A (potentially empty) list of type_ids
+        """
+        return list(self._sorted_type_ids[self.evaluate(predicate)])
+
+    def build_indicies(self, force=False):
+        """Compiles all the added tables into the lookup tables used by find(), broadcast(), etc: an array of the
+        sorted type_ids (and a dense type_id --> index array when possible), one array of values per column with
+        categorical codes for non-numeric columns, and an inverted value --> type_ids index for every column.
+
+        Called automatically after the types tables are loaded, and again if a new table is added.
+        """
+        if self._sorted_type_ids is not None and not force:
+            return
+
+        self._column_arrays = {}
+        self._column_categories = {}
+        self._inverted_index = {}
+        self._dense_index = None
+        if len(self._dataframes) == 0:
+            self._sorted_type_ids = np.array([], dtype=np.int64)
+            return
+
+        # type_ids are unique across tables so combining them is just a concatenation
+        types_df = self._dataframes[0] if len(self._dataframes) == 1 else pd.concat(self._dataframes, sort=False)
+        types_df = types_df.sort_index()
+        self._sorted_type_ids = np.asarray(types_df.index)
+        self._build_dense_index()
+
+        for col_name in types_df.columns:
+            col_vals = types_df[col_name]
+            if pd.api.types.is_numeric_dtype(col_vals.dtype):
+                values = col_vals.to_numpy()
+                uniques, inverse = np.unique(values, return_inverse=True)
+                inverse = inverse.reshape(-1)
+            else:
+                values = col_vals.to_numpy(dtype=object)
+                inverse, uniques = pd.factorize(values)
+                self._column_categories[col_name] = (inverse, uniques)
+
+            self._column_arrays[col_name] = values
+            self._inverted_index[col_name] = self._build_inverted_index(uniques, inverse)
+
+    def _build_dense_index(self):
+        type_ids = self._sorted_type_ids
+        if len(type_ids) == 0 or not np.issubdtype(type_ids.dtype, np.integer):
+            return
+
+        id_range = int(type_ids[-1]) - int(type_ids[0]) + 1
+        if id_range <= DENSE_INDEX_RATIO*len(type_ids):
+            self._dense_offset = int(type_ids[0])
+            self._dense_index = np.full(id_range, -1, dtype=np.int64)
+            self._dense_index[type_ids.astype(np.int64) - self._dense_offset] = np.arange(len(type_ids))
+
+    def _build_inverted_index(self, uniques, inverse):
+        """Returns a dictionary of value --> sorted array of the type_ids with that value (ignoring NaN/None)"""
+        order = np.argsort(inverse, kind='stable')
+        value_splits = np.flatnonzero(np.diff(inverse[order])) + 1
+        value_index = {}
+        for value_rows in np.split(order, value_splits):
+            if len(value_rows) == 0 or inverse[value_rows[0]] < 0:
+                continue
+            value = uniques[inverse[value_rows[0]]]
+            if isinstance(value, numbers.Real) and math.isnan(value):
+                continue
+            value_index[value.item() if isinstance(value, np.generic) else value] = self._sorted_type_ids[value_rows]
+        return value_index
 
     def to_dataframe(self, cache=False):
         if self._df_cache is not None:
@@ -153,7 +307,8 @@ class TypesTable(object):
 
     def __iter__(self):
         self._itr_indx = 0
-        self._itr_end = len(self.type_ids)
+        self._itr_ids = self.type_ids
+        self._itr_end = len(self._itr_ids)
         return self
 
     def next(self):
@@ -163,7 +318,7 @@ class TypesTable(object):
         if self._itr_indx >= self._itr_end:
             raise StopIteration
 
-        ntid = self.type_ids[self._itr_indx]
+        ntid = self._itr_ids[self._itr_indx]
         self._itr_indx += 1
         return self[ntid]
 
@@ -178,7 +333,10 @@ class TypesTable(object):
             if type_id in self._cached_node_types:
                 return self._cached_node_types[type_id]
             else:
-                nt_dict = self._index_typeid2df[type_id].loc[type_id].to_dict()
+                # only include the columns from the csv file the type_id was defined in
+                type_indx = self.type_indicies([type_id])[0]
+                nt_dict = {col_name: self._column_arrays[col_name][type_indx]
+                           for col_name in self._index_typeid2df[type_id].columns}
                 # TODO: consider just removing key from dict if value is None/NaN
                 remove_nans(nt_dict)  # pd turns None into np.nan's. Temp soln is to just convert them back.
                 self._cached_node_types[type_id] = nt_dict
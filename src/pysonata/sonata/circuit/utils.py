@@ -33,6 +33,15 @@ VERSION_ATTR = 'version'
 VERSION_NA = 'NA'
 VERSION_CURRENT = '0.1'
 
+# When reading a list of indicies from a dataset, the max gap between rows before splitting it into a separate read
+READ_MAX_GAP = 4096
+
+# gid of the nodes that aren't in a (partial) gid table, when reading the gid column of a population
+MISSING_GID = -1
+
+# Max number of rows evaluated at one time when filtering, keeps the memory bounded for very large populations
+FILTER_CHUNK_SIZE = 2**20
+
 try:
     ver_split = VERSION_CURRENT.split('.')
     VERSION_MAJOR = ver_split[0]
@@ -108,6 +117,86 @@ def add_hdf5_version(hdf5_handle):
     hdf5_handle['/'].attrs['version'] = [np.uint32(VERSION_MAJOR), np.uint32(VERSION_MINOR)]
 
 
+def read_indicies(dataset, indicies, max_gap=None):
+    """Returns the values of a dataset at the given indicies using coalesced hyperslab reads.
+
+    Unlike h5py fancy indexing the indicies don't need to be ordered and may contain duplicates. The unique indicies
+    are sorted and split into blocks wherever there is a gap larger than max_gap, and each block is read from the
+    dataset in one go. So a dense selection will only require a single read.
+
+    :param dataset: A h5py.Dataset (or numpy array)
+    :param indicies: array of indicies
+    :param max_gap: max number of unused rows to read between two indicies before starting a new block
+    :return: A numpy array of values in the same order as indicies
+    """
+    max_gap = READ_MAX_GAP if max_gap is None else max_gap
+    indicies = np.asarray(indicies, dtype=np.int64).reshape(-1)
+    if len(indicies) == 0:
+        return np.empty((0,) + tuple(dataset.shape[1:]), dtype=dataset.dtype)
+
+    unique_indicies, inverse = np.unique(indicies, return_inverse=True)
+    block_splits = np.flatnonzero(np.diff(unique_indicies) > max_gap) + 1
+    if len(block_splits) == 0:
+        indx_beg = unique_indicies[0]
+        values = dataset[indx_beg:(unique_indicies[-1] + 1)][unique_indicies - indx_beg]
+    else:
+        values = []
+        for block in np.split(unique_indicies, block_splits):
+            indx_beg = block[0]
+            values.append(dataset[indx_beg:(block[-1] + 1)][block - indx_beg])
+        values = np.concatenate(values)
+
+    return values[inverse.reshape(-1)]
+
+
+def memmap_dataset(dataset):
+    """Returns a read-only numpy.memmap of a dataset's values directly from the hdf5 file, or None if the dataset
+    can't be memory mapped (chunked/compressed, strings, external storage, in-memory file, etc).
+
+    Reading from the memmap skips the hdf5 library entirely, and the pages are shared by every process on the same
+    machine that opens the file.
+    """
+    if not isinstance(dataset, h5py.Dataset) or dataset.chunks is not None or dataset.size == 0:
+        # chunked is the only layout that can have compression/filters
+        return None
+
+    if dataset.dtype.kind not in 'iuf' or dataset.dtype.names is not None:
+        return None
+
+    h5_file = dataset.file
+    if h5_file.driver not in ('sec2', 'stdio') or h5_file.userblock_size != 0:
+        return None
+
+    offset = dataset.id.get_offset()
+    if offset is None:
+        # space not allocated, or stored in an external file
+        return None
+
+    try:
+        return np.memmap(h5_file.filename, mode='r', dtype=dataset.dtype, offset=offset, shape=dataset.shape)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def expand_ranges(range_begs, range_ends):
+    """Converts a list of [beg, end) ranges into one array of all the indicies in the ranges, in order. Empty (or
+    invalid) ranges are skipped."""
+    range_begs = np.asarray(range_begs, dtype=np.int64).reshape(-1)
+    range_lens = np.maximum(np.asarray(range_ends, dtype=np.int64).reshape(-1) - range_begs, 0)
+    n_indicies = int(np.sum(range_lens))
+    if n_indicies == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    # the offset from the position in the returned array to the index for each range
+    range_offsets = range_begs - (np.cumsum(range_lens) - range_lens)
+    return np.arange(n_indicies, dtype=np.int64) + np.repeat(range_offsets, range_lens)
+
+
+def partition_range(rank, size, n_items):
+    """Splits n_items into size (almost) equal contiguous blocks, returns the [beg, end) range of block rank"""
+    return (n_items*rank)//size, (n_items*(rank + 1))//size
+
+
 if sys.version_info[0] == 3:
     using_py3 = True
     range_itr = range
@@ -27,5 +27,5 @@ def thalamocortical():
                                               'examples/v1_v1_edge_types.csv']))
 
 
-def load_circuit_files(data_files, data_type_files):
-    return File(data_files=_append_fdir(data_files), data_type_files=_append_fdir(data_type_files))
\ No newline at end of file
+def load_circuit_files(data_files, data_type_files, **kwargs):
+    return File(data_files=_append_fdir(data_files), data_type_files=_append_fdir(data_type_files), **kwargs)
\ No newline at end of file
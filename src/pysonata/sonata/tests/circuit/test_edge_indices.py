@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+import pytest
+import h5py
+import numpy as np
+
+from sonata.circuit import File, add_edge_indices
+from sonata.circuit.utils import expand_ranges
+from conftest import _append_fdir
+
+
+def _index_rows(index_grp, node_id):
+    lookup_beg, lookup_end = index_grp['node_id_to_range'][node_id]
+    edge_ranges = index_grp['range_to_edge_id'][lookup_beg:lookup_end]
+    return expand_ranges(edge_ranges[:, 0], edge_ranges[:, 1])
+
+
+@pytest.mark.parametrize('chunk_size,compression', [
+    (None, 'gzip'),
+    (1000, None),  # many sorted chunks to merge, stored contiguously
+    (100, 'lzf')
+])
+def test_add_edge_indices(net, chunk_size, compression):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        edges_path = os.path.join(tmp_dir, 'v1_v1_edges.h5')
+        shutil.copy(_append_fdir('examples/v1_v1_edges.h5'), edges_path)
+        with h5py.File(edges_path, 'r+') as h5:
+            del h5['/edges/v1_to_v1/indicies']
+
+        stats = add_edge_indices(edges_path, chunk_size=chunk_size, compression=compression,
+                                 chunk_rows=None if compression is None else 4096)
+        assert(set(stats.keys()) == {'source_to_target', 'target_to_source'})
+        assert(stats['target_to_source']['n_edges'] == 48286 and stats['target_to_source']['n_nodes'] == 449)
+        assert(stats['target_to_source']['n_ranges'] == 449)  # edges are sorted by target
+        assert(stats['source_to_target']['edges_per_sec'] > 0)
+
+        orig_h5 = h5py.File(_append_fdir('examples/v1_v1_edges.h5'), 'r')
+        with h5py.File(edges_path, 'r') as h5:
+            for direction in ['source_to_target', 'target_to_source']:
+                index_grp = h5['/edges/v1_to_v1/indices'][direction]
+                orig_grp = orig_h5['/edges/v1_to_v1/indicies'][direction]
+                assert(index_grp['node_id_to_range'].dtype == np.uint64)
+                assert((index_grp['range_to_edge_id'].compression is None) == (compression is None))
+                for node_id in range(449):
+                    assert(np.all(_index_rows(index_grp, node_id) == _index_rows(orig_grp, node_id)))
+        orig_h5.close()
+
+        # indices are used when the file is opened
+        edges = File(data_files=edges_path, data_type_files=_append_fdir('examples/v1_v1_edge_types.csv')).edges
+        edges = edges['v1_to_v1']
+        assert(edges._has_target_index and edges._has_source_index)
+        assert([e.source_node_id for e in edges.get_target(100)] ==
+               [e.source_node_id for e in net.edges['v1_to_v1'].get_target(100)])
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def test_add_edge_indices_existing():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        edges_path = os.path.join(tmp_dir, 'v1_v1_edges.h5')
+        shutil.copy(_append_fdir('examples/v1_v1_edges.h5'), edges_path)
+        with pytest.raises(ValueError):
+            add_edge_indices(edges_path, population='v1_to_v1')
+        with pytest.raises(ValueError):
+            add_edge_indices(edges_path, population='not_a_population', overwrite=True)
+        with pytest.raises(ValueError):
+            add_edge_indices(edges_path, directions='not_a_direction', overwrite=True)
+
+        # legacy "indicies" group is updated in place
+        stats = add_edge_indices(edges_path, directions='source_to_target', overwrite=True)
+        assert(list(stats.keys()) == ['source_to_target'])
+        with h5py.File(edges_path, 'r') as h5:
+            assert('indices' not in h5['/edges/v1_to_v1'])
+            assert(set(h5['/edges/v1_to_v1/indicies'].keys()) == {'source_to_target', 'target_to_source'})
+            n_ranges = len(h5['/edges/v1_to_v1/indicies/source_to_target/range_to_edge_id'])
+            assert(n_ranges == stats['source_to_target']['n_ranges'])
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
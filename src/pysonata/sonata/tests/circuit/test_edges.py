@@ -1,6 +1,14 @@
+import os
+import shutil
+import tempfile
 import pytest
+import h5py
+import numpy as np
 
-from sonata.circuit import File, Edge
+from sonata.circuit import File, Edge, EdgeSet
+from sonata.circuit.query import col
+from sonata.circuit.utils import expand_ranges
+from conftest import _append_fdir
 
 
 def test_edge_population(net):
@@ -37,6 +45,78 @@ def test_population_itr_selected(net):
     assert((i+1) == 4184)
 
 
+def test_get_targets_batched(net):
+    edges = net.edges['v1_to_v1']
+    target_ids = np.array(edges.get_group(0).trg_node_ids)
+    source_ids = np.array(edges.get_group(0).src_node_ids)
+
+    edge_set = edges.get_targets(np.array([100, 3, 4, 5, 100, 100000]))
+    assert(isinstance(edge_set, EdgeSet))
+    expected_rows = np.concatenate([np.flatnonzero(target_ids == n) for n in [100, 3, 4, 5, 100]])
+    assert(np.all(edge_set.row_indicies == expected_rows))
+    assert(np.all(edge_set.target_node_ids == target_ids[expected_rows]))
+    assert(np.all(edge_set.source_node_ids == source_ids[expected_rows]))
+    assert([e.source_node_id for e in edge_set] == list(source_ids[expected_rows]))
+
+    edges_df = edge_set.to_dataframe(columns=['target_node_id', 'nsyns', 'delay'])
+    assert(len(edges_df) == len(expected_rows) and np.all(edges_df['delay'] == 2.0))
+
+    # any iterable of node_ids
+    assert(len(edges.get_sources(n for n in range(250, 300))) == 4184)
+    assert(np.all(np.isin(edges.get_sources(range(250, 300)).source_node_ids, np.arange(250, 300))))
+    assert(len(edges.get_targets([])) == 0 and len(edges.get_target(100000)) == 0)
+
+
+def test_built_node_index(net):
+    edges = net.edges['v1_to_v1']
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        # copy of the edges file without any indices
+        edges_path = os.path.join(tmp_dir, 'v1_v1_edges.h5')
+        shutil.copy(_append_fdir('examples/v1_v1_edges.h5'), edges_path)
+        with h5py.File(edges_path, 'r+') as h5:
+            del h5['/edges/v1_to_v1/indicies']
+
+        net_noindex = File(data_files=edges_path, data_type_files=_append_fdir('examples/v1_v1_edge_types.csv'),
+                           index_cache=tmp_dir)
+        edges_noindex = net_noindex.edges['v1_to_v1']
+        assert(not edges_noindex._has_target_index and not edges_noindex._has_source_index)
+
+        # partitioning by target builds the target index rather than scanning the edges
+        assert(np.all(edges_noindex.partition(rank=1, size=3).row_indicies ==
+                      edges.partition(rank=1, size=3).row_indicies))
+        assert(edges_noindex._has_target_index and not edges_noindex._has_source_index)
+        assert(len(edges_noindex.partition(rank=0, size=3, target_node_ids=[])) == 0)
+
+        # index is built on the first lookup, and gives the same edges as the index stored in the file
+        assert([e.source_node_id for e in edges_noindex.get_target(100)] ==
+               [e.source_node_id for e in edges.get_target(100)])
+        assert([e.target_node_id for e in edges_noindex.get_sources([0, 349, 10000])] ==
+               [e.target_node_id for e in edges.get_sources([0, 349, 10000])])
+        assert(edges_noindex._has_target_index and edges_noindex._has_source_index)
+
+        for direction in ['source', 'target']:
+            built_index = edges_noindex._get_node_index(direction)
+            file_index = edges._get_node_index(direction)
+            assert(len(built_index.lookup_table) == len(file_index.lookup_table))
+            for node_id in [0, 1, 100, 448]:
+                built_ranges = built_index.edge_table[slice(*built_index.lookup_table[node_id])]
+                file_ranges = file_index.edge_table[slice(*file_index.lookup_table[node_id])]
+                assert(np.all(expand_ranges(built_ranges[:, 0], built_ranges[:, 1]) ==
+                              expand_ranges(file_ranges[:, 0], file_ranges[:, 1])))
+
+        # sorted by target so there is a single range for every target node
+        assert(len(edges_noindex._get_node_index('target').edge_table) == 449)
+
+        # stored in the index cache for the next time the file is opened
+        cache_dirs = [d for d in os.listdir(tmp_dir) if d.startswith('.v1_v1_edges.h5.index_cache')]
+        assert(len(cache_dirs) == 1)
+        assert({'edges.v1_to_v1.target_to_source', 'edges.v1_to_v1.source_to_target'} <=
+               set(os.listdir(os.path.join(tmp_dir, cache_dirs[0]))))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
 def test_population_search(net):
     edges = net.edges['v1_to_v1']
 
@@ -58,6 +138,121 @@ def test_population_search(net):
     assert((i+1) == 551)
 
 
+def test_population_search_predicates(net):
+    edges = net.edges['v1_to_v1']
+    nsyns = edges.get_group(0).get_values('nsyns')
+
+    for i, edge in enumerate(edges.filter(col('nsyns') > 5)):
+        assert(edge['nsyns'] > 5)
+    assert((i+1) == np.count_nonzero(nsyns > 5))
+
+    assert(sum(1 for _ in edges.filter(col('nsyns').between(2, 5))) == np.count_nonzero((nsyns >= 2) & (nsyns < 5)))
+
+    # mixed group, edge-types and population columns
+    for edge in edges.filter(~col('dynamics_params').startswith('AMPA') & (col('nsyns') <= 4),
+                             target_node_id=[1, 10, 100]):
+        assert(edge.target_node_id in [1, 10, 100])
+        assert(not edge['dynamics_params'].startswith('AMPA'))
+        assert(edge['nsyns'] <= 4)
+
+    with pytest.raises(KeyError):
+        next(edges.filter(col('not_a_column') == 0))
+
+
+def test_population_select(net, monkeypatch):
+    edges = net.edges['v1_to_v1']
+    nsyns = edges.get_group(0).get_values('nsyns')
+    type_ids = np.array(edges.type_ids)
+    expected_rows = np.flatnonzero((nsyns > 5) & (type_ids == 3))
+
+    edge_set = edges.select(col('nsyns') > 5, edge_type_id=3)
+    assert(isinstance(edge_set, EdgeSet))
+    assert(np.all(edge_set.row_indicies == expected_rows))
+    assert(np.all(edge_set.get_properties('nsyns') > 5) and np.all(edge_set.edge_type_ids == 3))
+    assert(len(edges.select(nsyns=-1)) == 0)
+
+    # rows are returned one chunk at a time
+    monkeypatch.setattr('sonata.circuit.population.FILTER_CHUNK_SIZE', 10000)
+    row_chunks = list(edges.filter_rows(col('nsyns') > 5, edge_type_id=3))
+    assert(len(row_chunks) > 1 and all(np.all(np.diff(rows) > 0) for rows in row_chunks))
+    assert(np.all(np.concatenate(row_chunks) == expected_rows))
+    assert([e.source_node_id for e in edges.filter(col('nsyns') > 5, edge_type_id=3)] ==
+           list(edge_set.source_node_ids))
+
+    with pytest.raises(KeyError):
+        edges.filter_rows(not_a_column=0)
+
+
+def test_edge_records(net):
+    edges = net.edges['v1_to_v1']
+    nsyns = edges.get_group(0).get_values('nsyns')
+    target_ids = edges.get_group(0).trg_node_ids
+    n_edges = 0
+    for i, edge in enumerate(edges):  # more edges than in a single block
+        assert(edge['nsyns'] == nsyns[i])
+        assert(edge.target_node_id == target_ids[i])
+        n_edges += 1
+    assert(n_edges == 48286)
+
+    edge = edges.get_row(100)
+    assert(not hasattr(edge, '__dict__'))
+    assert(edge.group_props == {'nsyns': nsyns[100]})
+    assert(edge['dynamics_params'] == edges.edge_types_table[edge.edge_type_id]['dynamics_params'])
+    assert('nsyns' in edge and 'template' in edge and 'not_a_column' not in edge)
+    with pytest.raises(KeyError):
+        edge['not_a_column']
+
+
+def test_sample(net):
+    edges = net.edges['v1_to_v1']
+    sample = edges.sample(n=600, stratify_by='edge_type_id', seed=1)
+    assert(len(sample) == 581 + 566 + 600*9)  # edge types 0 and 5 have fewer than 600 edges
+    type_ids, type_counts = np.unique(sample.edge_type_ids, return_counts=True)
+    assert(len(type_ids) == 11 and np.max(type_counts) == 600)
+
+    frac_sample = sample.sample(frac=0.1, seed=2)
+    assert(len(frac_sample) == 655 and set(frac_sample.row_indicies) <= set(sample.row_indicies))
+    assert(np.all(frac_sample.source_node_ids == edges.iproperties('source_node_id', frac_sample.row_indicies)))
+
+
+def test_partition(net):
+    edges = net.edges['v1_to_v1']
+    assert(len(edges.partition()) == 48286)
+
+    # by default edges are assigned to the rank of their target node
+    partitions = [edges.partition(rank=r, size=4) for r in range(4)]
+    assert(sum(len(p) for p in partitions) == 48286)
+    assert(len(np.unique(np.concatenate([p.row_indicies for p in partitions]))) == 48286)
+    for rank, edge_set in enumerate(partitions):
+        assert(np.all(edge_set.target_node_ids % 4 == rank))
+
+    node_set = net.nodes['v1'].partition(rank=1, size=2, strategy='contiguous')
+    edge_set = edges.partition(rank=1, size=2, target_node_ids=node_set.node_ids)
+    target_ids = edges.get_group(0).trg_node_ids
+    assert(len(edge_set) == np.count_nonzero(target_ids >= 224))
+    assert(np.all(edge_set.get_properties('nsyns') == edges.get_group(0).get_values('nsyns')[edge_set.row_indicies]))
+
+    edge_set = edges.partition(rank=2, size=4, strategy='contiguous')
+    assert(np.all(edge_set.row_indicies == np.arange(24143, 36214)))
+    assert(isinstance(next(iter(edge_set)), Edge))
+
+
+def test_population_iter_chunks(net):
+    edges = net.edges['v1_to_v1']
+    chunks = list(edges.iter_chunks(batch_size=10000, columns=['target_node_id', 'nsyns', 'dynamics_params']))
+    assert([len(c['nsyns']) for c in chunks] == [10000, 10000, 10000, 10000, 8286])
+    assert(np.all(np.concatenate([c['nsyns'] for c in chunks]) == edges.get_group(0).get_values('nsyns')))
+    assert(all(set(c.keys()) == {'target_node_id', 'nsyns', 'dynamics_params'} for c in chunks))
+
+    edge = edges.get_row(12345)
+    assert(chunks[1]['target_node_id'][2345] == edge.target_node_id)
+    assert(chunks[1]['dynamics_params'][2345] == edge['dynamics_params'])
+
+    grp_chunks = list(edges.get_group(0).iter_chunks(batch_size=20000, columns=['nsyns'], as_dataframe=True))
+    assert(sum(len(df) for df in grp_chunks) == 48286)
+    assert(list(grp_chunks[0].columns) == ['nsyns'])
+
+
 def test_group(net):
     edges = net.edges['v1_to_v1']
     grp0 = edges.get_group(0)
@@ -76,6 +271,45 @@ def test_group_itr(net):
     assert((i+1) == 48286)
 
 
+def test_group_filter(net, monkeypatch):
+    edges = net.edges['v1_to_v1']
+    grp0 = edges.get_group(0)
+    nsyns = grp0.get_values('nsyns')
+    type_ids = grp0.edge_type_ids
+    expected_rows = np.flatnonzero((nsyns > 5) & np.isin(type_ids, [3, 4]))
+
+    edge_set = grp0.filter(col('nsyns') > 5, edge_type_id=[3, 4])
+    assert(isinstance(edge_set, EdgeSet))
+    assert(np.all(edge_set.row_indicies == expected_rows))
+    assert(np.all(edge_set.source_node_ids == grp0.src_node_ids[expected_rows]))
+    assert(np.all(edge_set.target_node_ids == grp0.trg_node_ids[expected_rows]))
+    assert(len(grp0.filter()) == len(grp0))
+
+    edges_df = edge_set.to_dataframe(columns=['source_node_id', 'target_node_id', 'nsyns', 'edge_type_id'])
+    assert(len(edges_df) == len(expected_rows))
+    assert(np.all(edges_df['nsyns'] > 5) and set(edges_df['edge_type_id']) == {3, 4})
+    assert(len(grp0.filter(nsyns=-1).to_dataframe()) == 0)
+
+    with pytest.raises(KeyError):
+        grp0.filter(not_a_column=0)
+    with pytest.raises(KeyError):
+        grp0.filter(col('not_a_column') > 0, nsyns=1)
+
+    # the group ranges are read in blocks, any range larger than a block is split up
+    monkeypatch.setattr('sonata.circuit.group.FILTER_CHUNK_SIZE', 10000)
+    assert(list(grp0._range_blocks()) == [(b, min(b + 10000, len(edges))) for b in range(0, len(edges), 10000)])
+    assert(np.all(grp0.filter(col('nsyns') > 5, edge_type_id=[3, 4]).row_indicies == expected_rows))
+
+    # small ranges close together are merged into the same block
+    monkeypatch.setattr(grp0, '_parent_indicies', np.array([[0, 10], [20, 30], [95, 105], [300, 310]]))
+    assert(list(grp0._range_blocks(block_size=100)) == [(0, 30), (95, 105), (300, 310)])
+
+    # rows are returned in population order even if the group's ranges aren't sorted
+    monkeypatch.setattr(grp0, '_parent_indicies', np.array([[300, 310], [0, 10]]))
+    assert(list(grp0._range_blocks(block_size=100)) == [(300, 310), (0, 10)])
+    assert(np.all(grp0.filter().row_indicies == np.r_[0:10, 300:310]))
+
+
 if __name__ == '__main__':
     from conftest import net
 
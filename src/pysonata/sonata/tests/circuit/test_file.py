@@ -1,7 +1,15 @@
+import os
+import json
+import shutil
 import pytest
 import tempfile
+import h5py
+import numpy as np
 
-from conftest import load_circuit_files
+from sonata.circuit.file import File
+from sonata.circuit.index_cache import IndexCache, SharedIndexCache
+from sonata.circuit.utils import memmap_dataset
+from conftest import load_circuit_files, _append_fdir
 
 
 def test_load_files():
@@ -65,3 +73,202 @@ def test_no_node_types():
 def test_mixed_files():
     with pytest.raises(Exception):
         load_circuit_files(data_files='examples/v1_nodes.h5', data_type_files='examples/v1_v1_edge_types.csv')
+
+
+def test_column_cache():
+    # memory mapped datasets don't go through the cache
+    net = load_circuit_files(data_files=['examples/v1_nodes.h5', 'examples/v1_v1_edges.h5'],
+                             data_type_files=['examples/v1_node_types.csv', 'examples/v1_v1_edge_types.csv'],
+                             use_memmap=False)
+    cache = net.cache
+    assert(cache.enabled)
+    assert(net.nodes.cache is cache and net.edges.cache is cache)
+
+    v1 = net.nodes['v1']
+    node = v1.get_node_id(100)
+    rotation_angle = node['rotation_angle_yaxis']
+    assert(cache.stats['misses'] > 0)
+    assert(cache.stats['bytes_loaded'] > 0)
+    assert(cache.nbytes > 0)
+
+    # second read of the same node shouldn't go back to the file
+    cache.reset_stats()
+    node2 = v1.get_node_id(100)
+    assert(node2['rotation_angle_yaxis'] == rotation_angle)
+    assert(cache.stats['misses'] == 0)
+    assert(cache.stats['hits'] > 0)
+    assert(cache.stats['bytes_loaded'] == 0)
+    assert(node2.node_id == node.node_id)
+
+    # values read through the cache are the same as from the h5 file
+    edges = net.edges['v1_to_v1']
+    assert(edges.get_row(10)['nsyns'] == edges.get_group(0).get_dataset('nsyns')[10])
+
+
+def test_column_cache_eviction():
+    net = load_circuit_files(data_files='examples/v1_nodes.h5', data_type_files='examples/v1_node_types.csv',
+                             cache_size=1024, use_memmap=False)
+    net.cache._block_size = 256
+    v1 = net.nodes['v1']
+    expected = [v1.get_node_id(i)['rotation_angle_yaxis'] for i in range(len(v1))]
+    assert(net.cache.stats['evictions'] > 0)
+    assert(net.cache.nbytes <= 1024)
+    assert(expected == [v1.get_node_id(i)['rotation_angle_yaxis'] for i in range(len(v1))])
+
+
+def test_column_cache_disabled():
+    net = load_circuit_files(data_files='examples/v1_nodes.h5', data_type_files='examples/v1_node_types.csv',
+                             cache_size=0)
+    assert(not net.cache.enabled)
+    v1 = net.nodes['v1']
+    assert(v1.get_node_id(0).node_id == 0)
+    assert(net.cache.nbytes == 0)
+    assert(net.cache.stats['hits'] == 0 and net.cache.stats['misses'] == 0)
+
+
+def test_memmap():
+    files = dict(data_files=['examples/v1_nodes.h5', 'examples/v1_v1_edges.h5'],
+                 data_type_files=['examples/v1_node_types.csv', 'examples/v1_v1_edge_types.csv'])
+    net = load_circuit_files(**files)
+    net_h5 = load_circuit_files(use_memmap=False, **files)
+
+    v1 = net.nodes['v1']
+    assert(isinstance(v1.group_id_ds, np.memmap) and not v1.group_id_ds.flags.writeable)
+    assert(isinstance(v1.get_group(0).get_dataset('positions'), np.memmap))
+    assert(isinstance(net_h5.nodes['v1'].group_id_ds, h5py.Dataset))
+
+    rows = [448, 0, 12, 12, 300]
+    for col_name in ['node_id', 'node_type_id', 'positions', 'rotation_angle_yaxis']:
+        assert(np.array_equal(v1.iproperties(col_name, rows), net_h5.nodes['v1'].iproperties(col_name, rows),
+                              equal_nan=True))
+
+    edges, edges_h5 = net.edges['v1_to_v1'], net_h5.edges['v1_to_v1']
+    assert([e.source_node_id for e in edges.get_targets([1, 5])] ==
+           [e.source_node_id for e in edges_h5.get_targets([1, 5])])
+    assert(len(list(edges.filter(nsyns=1))) == len(list(edges_h5.filter(nsyns=1))))
+    assert(net.cache.nbytes == 0)
+
+    # in-memory (core driver) and chunked datasets fall back to h5py
+    with h5py.File('memmap_test.h5', 'w', driver='core', backing_store=False) as h5:
+        h5.create_dataset('contiguous', data=np.arange(10))
+        h5.create_dataset('chunked', data=np.arange(10), chunks=(5,))
+        assert(memmap_dataset(h5['contiguous']) is None)
+        assert(memmap_dataset(h5['chunked']) is None)
+
+
+def test_index_cache():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        v1_nodes_path = os.path.join(tmp_dir, 'v1_nodes.h5')
+        shutil.copy(_append_fdir('examples/v1_nodes.h5'), v1_nodes_path)
+        data_type_files = _append_fdir('examples/v1_node_types.csv')
+
+        # first time the indices are built and stored next to the hdf5 file
+        net = File(data_files=v1_nodes_path, data_type_files=data_type_files, index_cache=True)
+        assert(isinstance(net.index_cache, IndexCache))
+        v1 = net.nodes['v1']
+        grp_rows = v1.group_indicies(1)
+        assert(v1.get_node_id(100).node_id == 100)
+        index_dir = os.path.join(tmp_dir, '.v1_nodes.h5.index_cache')
+        assert(set(os.listdir(index_dir)) >= {'manifest.json', 'nodes.v1.group_indicies', 'nodes.v1.node_id_index'})
+
+        # after that they are memory mapped from disk
+        net = File(data_files=v1_nodes_path, data_type_files=data_type_files, index_cache=True)
+        v1 = net.nodes['v1']
+        assert(isinstance(v1.group_indicies(1), np.memmap))
+        assert(np.all(v1.group_indicies(1) == grp_rows))
+        assert(v1.get_node_id(100).node_id == 100)
+        assert(v1.node_id_index.is_implicit)
+
+        # index is thrown away if the hdf5 file changes
+        with open(os.path.join(index_dir, 'manifest.json')) as f:
+            manifest = json.load(f)
+        file_stat = os.stat(v1_nodes_path)
+        os.utime(v1_nodes_path, (file_stat.st_atime, file_stat.st_mtime + 10))
+        net = File(data_files=v1_nodes_path, data_type_files=data_type_files, index_cache=True)
+        assert(np.all(net.nodes['v1'].group_indicies(1) == grp_rows))
+        assert(set(os.listdir(index_dir)) >= {'manifest.json', 'nodes.v1.group_indicies'})
+        assert(not os.path.exists(os.path.join(index_dir, 'nodes.v1.node_id_index')))
+        with open(os.path.join(index_dir, 'manifest.json')) as f:
+            assert(json.load(f)['mtime'] != manifest['mtime'])
+
+        # store in a separate directory
+        cache_dir = os.path.join(tmp_dir, 'cache')
+        os.mkdir(cache_dir)
+        net = File(data_files=v1_nodes_path, data_type_files=data_type_files, index_cache=cache_dir)
+        net.nodes['v1'].group_indicies(0)
+        assert(len(os.listdir(cache_dir)) == 1)
+        net.index_cache.clear(v1_nodes_path)
+        assert(len(os.listdir(cache_dir)) == 0)
+
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_index_cache_invalidated():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        h5_path = os.path.join(tmp_dir, 'v1_nodes.h5')
+        shutil.copy(_append_fdir('examples/v1_nodes.h5'), h5_path)
+        index_cache = IndexCache()
+        other_cache = IndexCache()  # eg. another process
+
+        def build_fnc():
+            # the file changes while the index is being built, and another process resets the directory
+            file_stat = os.stat(h5_path)
+            os.utime(h5_path, (file_stat.st_atime, file_stat.st_mtime + 10))
+            assert(other_cache.load(h5_path, 'other_index') is None)
+            return {'values': np.arange(10)}
+
+        arrays = index_cache.load_or_build(h5_path, 'test_index', build_fnc)
+        assert(np.all(arrays['values'] == np.arange(10)))
+
+        # the stale index isn't saved into the new directory
+        index_dir = os.path.join(tmp_dir, '.v1_nodes.h5.index_cache')
+        assert(os.path.exists(os.path.join(index_dir, 'manifest.json')))
+        assert(not os.path.exists(os.path.join(index_dir, 'test_index')))
+        assert(not any('.stale.' in d for d in os.listdir(tmp_dir)))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_shared_index_cache():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        index_cache = SharedIndexCache(cache_dir=os.path.join(tmp_dir, 'shm'))
+        files = dict(data_files=_append_fdir('examples/v1_nodes.h5'),
+                     data_type_files=_append_fdir('examples/v1_node_types.csv'), index_cache=index_cache)
+
+        # only the first process/File to use an index builds it, others attach to the stored copy
+        build_counts = {'n': 0}
+
+        def build_fnc():
+            build_counts['n'] += 1
+            return {'values': np.arange(10)}
+
+        h5_path = _append_fdir('examples/v1_nodes.h5')
+        arrays1 = index_cache.load_or_build(h5_path, 'test_index', build_fnc)
+        arrays2 = index_cache.load_or_build(h5_path, 'test_index', build_fnc)
+        assert(build_counts['n'] == 1)
+        assert(isinstance(arrays1['values'], np.memmap) and not arrays2['values'].flags.writeable)
+        assert(np.all(arrays2['values'] == np.arange(10)))
+
+        nodes1 = File(**files).nodes['v1']
+        nodes2 = File(**files).nodes['v1']
+        assert(np.all(nodes1.group_indicies(0) == nodes2.group_indicies(0)))
+        assert(isinstance(nodes2.group_indicies(0), np.memmap))
+        assert(nodes2.get_node_id(10).node_id == 10)
+
+        # indices of files that no longer exist are removed, others are kept until everything is cleared
+        other_path = os.path.join(tmp_dir, 'v1_nodes_copy.h5')
+        shutil.copy(h5_path, other_path)
+        index_cache.load_or_build(other_path, 'test_index', build_fnc)
+        assert(len(os.listdir(index_cache.cache_dir)) == 2)
+        os.remove(other_path)
+        index_cache.clear_all(stale_only=True)
+        assert(len(os.listdir(index_cache.cache_dir)) == 1)
+        assert(index_cache.load(h5_path, 'test_index') is not None)
+        index_cache.clear_all()
+        assert(os.listdir(index_cache.cache_dir) == [])
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,81 @@
+import os
+import json
+import tempfile
+import pytest
+import numpy as np
+
+from sonata.circuit import NodeSets, NodeSet
+
+
+node_sets_json = {
+    'biophys_cells': {'model_type': 'biophysical'},
+    'lgn': {'population': 'lgn'},
+    'layer4_e': {'population': ['v1', 'lgn'], 'location': ['VisL4', 'not_a_location'], 'ei': 'e'},
+    'recorded_cells': {'population': 'v1', 'node_id': [0, 1, 2, 100000]},
+    'recorded_lgn': {'population': 'lgn', 'model_type': 'virtual', 'node_id': [0, 10, 20]},
+    'combined': ['biophys_cells', 'lgn', 'recorded_cells'],
+    'nested': ['combined', 'recorded_lgn'],
+    'cycle_a': ['cycle_b'],
+    'cycle_b': ['cycle_a']
+}
+
+
+def test_basic_node_sets(net):
+    node_sets = NodeSets(node_sets_json, net.nodes)
+    assert(len(node_sets) == 9 and 'lgn' in node_sets)
+
+    v1_nodes = net.nodes['v1']
+    biophys = node_sets['biophys_cells']
+    assert(set(biophys.keys()) == {'v1'})
+    assert(isinstance(biophys['v1'], NodeSet))
+    assert(np.all(biophys['v1'].row_indicies == v1_nodes.filter(model_type='biophysical').row_indicies))
+
+    lgn = node_sets['lgn']
+    assert(set(lgn.keys()) == {'lgn'} and len(lgn['lgn']) == 9000)
+
+    layer4_e = node_sets.get('layer4_e', population='v1')
+    assert(len(layer4_e) > 0)
+    assert(np.all(layer4_e.get_properties('location') == 'VisL4'))
+    assert(np.all(layer4_e.get_properties('ei') == 'e'))
+
+    assert(np.all(node_sets.get('recorded_cells', 'v1').node_ids == [0, 1, 2]))
+    assert(np.all(node_sets.rows('recorded_lgn', 'lgn') == [0, 10, 20]))
+    assert(len(node_sets.rows('recorded_lgn', 'v1')) == 0)
+
+
+def test_compound_node_sets(net):
+    node_sets = NodeSets(node_sets_json, net)
+    combined = node_sets.rows('combined')
+    expected_v1 = np.union1d(node_sets.rows('biophys_cells', 'v1'), node_sets.rows('recorded_cells', 'v1'))
+    assert(np.all(combined['v1'] == expected_v1))
+    assert(len(combined['lgn']) == 9000)
+    assert(np.all(node_sets.rows('nested', 'lgn') == np.arange(9000)))
+
+    mask = node_sets.mask('combined', 'v1')
+    assert(mask.dtype == bool and np.count_nonzero(mask) == len(expected_v1))
+
+    # resolved node sets are memoized
+    assert(node_sets.rows('combined') is combined)
+    node_sets.clear()
+    assert(node_sets.rows('combined') is not combined)
+
+    with pytest.raises(ValueError):
+        node_sets.rows('cycle_a')
+    with pytest.raises(KeyError):
+        node_sets.rows('not_a_node_set')
+
+
+def test_node_sets_file(net):
+    tmp_dir = tempfile.mkdtemp()
+    node_sets_path = os.path.join(tmp_dir, 'node_sets.json')
+    try:
+        with open(node_sets_path, 'w') as f:
+            json.dump(node_sets_json, f)
+
+        node_sets = NodeSets(node_sets_path, net.nodes)
+        assert(set(node_sets.names) == set(node_sets_json.keys()))
+        assert(node_sets.definition('recorded_cells') == node_sets_json['recorded_cells'])
+        assert(len(node_sets.get('recorded_cells', 'v1')) == 3)
+    finally:
+        os.remove(node_sets_path)
+        os.rmdir(tmp_dir)
@@ -1,7 +1,12 @@
+import os
+import tempfile
 import pytest
+import numpy as np
 from collections import Counter
 
-from sonata.circuit import File
+from sonata.circuit import File, NodeSet
+from sonata.circuit.query import col
+from sonata.circuit.index import IdIndex
 
 
 def test_population_lookup(net):
@@ -50,6 +55,78 @@ def test_population_itr(net):
     assert(node_count == 9449)
 
 
+def test_node_records(net):
+    nodes = net.nodes['v1']
+    node = nodes.get_node_id(441)
+    assert(not hasattr(node, '__dict__'))  # __slots__ only
+    assert(node.group_id == 1)
+    assert(node.node_type_id == 100000102)
+    assert(node.gid is None)
+    assert(set(node.group_props.keys()) == {'positions', 'rotation_angle_yaxis'})
+    assert(node['rotation_angle_yaxis'] == nodes.get_group(1)[node['node_group_index']]['rotation_angle_yaxis'])
+    assert(node['model_type'] == node.node_type_properties['model_type'] == 'point_process')
+    assert('positions' in node and 'ei' in node and 'tuning_angle' not in node)
+    with pytest.raises(KeyError):
+        node['tuning_angle']
+
+    # nodes from the same block share their column values
+    grp0 = nodes.get_group(0)
+    for node, tuning_angle in zip(grp0, grp0.get_values('tuning_angle')):
+        assert(node['tuning_angle'] == tuning_angle)
+
+
+def test_node_id_index(net):
+    v1_nodes = net.nodes['v1']
+    assert(v1_nodes._index_nid2row is None)  # index isn't built until needed
+    assert(v1_nodes.get_node_id(432).node_id == 432)
+    assert(v1_nodes.node_id_index.is_implicit)
+    assert(v1_nodes.node_id_index.nbytes == 0)
+
+    node_set = v1_nodes.get_node_id([5, 3, 3, 100])
+    assert(isinstance(node_set, NodeSet))
+    assert([n.node_id for n in node_set] == [5, 3, 3, 100])
+
+    with pytest.raises(KeyError):
+        v1_nodes.get_node_id(449)
+
+
+def test_id_index():
+    index = IdIndex(ids=np.array([10, 5, 7, 100]))
+    assert(not index.is_implicit)
+    assert(all(index.rows([100, 5, 7, 5]) == [3, 1, 2, 1]))
+    assert(index.row(10) == 0)
+    assert(7 in index and 8 not in index)
+    assert(all(index.contains([5, 6, 100, 101]) == [True, False, True, False]))
+    with pytest.raises(KeyError):
+        index.rows([5, 6])
+
+    index = IdIndex.from_dataset(np.arange(100), chunk_size=7)
+    assert(index.is_implicit)
+    assert(len(index) == 100)
+    assert(all(index.rows([99, 0]) == [99, 0]))
+
+    index = IdIndex(ids=np.arange(1000, 1100))  # consecutive ids don't need to be stored
+    assert(index.is_implicit and index.offset == 1000 and index.nbytes == 0)
+    assert(all(index.rows([1099, 1000]) == [99, 0]))
+    assert(all(index.contains([999, 1000, 1099, 1100]) == [False, True, True, False]))
+    with pytest.raises(KeyError):
+        index.rows([999])
+
+
+def test_get_node_ids(net):
+    v1_nodes = net.nodes['v1']
+    node_ids = [300, 5, 448, 5, 0, 120]
+    node_set = v1_nodes.get_node_ids(node_ids)
+    assert(isinstance(node_set, NodeSet) and len(node_set) == 6)
+    assert(np.all(node_set.node_ids == node_ids))
+    expected_types = [v1_nodes.get_node_id(nid).node_type_id for nid in node_ids]
+    assert(np.all(node_set.node_type_ids == expected_types))
+    assert(np.all(node_set.to_dataframe(columns=['node_id'])['node_id'] == node_ids))
+    assert(len(v1_nodes.get_node_ids(np.array([], dtype=np.uint64))) == 0)
+    with pytest.raises(KeyError):
+        v1_nodes.get_node_ids([1, 100000])
+
+
 def test_node_set(net):
     # Test with normal list
     v1_nodes = net.nodes['v1']
@@ -63,6 +140,190 @@ def test_node_set(net):
         assert(node['location'] == 'VisL4')
 
 
+def test_node_set_columnar(net):
+    v1_nodes = net.nodes['v1']
+    # unordered with duplicates, and from both groups
+    selected_rows = [396, 3, 3, 0, 420, 85]
+    node_set = v1_nodes.get_rows(selected_rows)
+    assert(all(node_set.node_ids == selected_rows))
+    assert(all(node_set.group_ids == [0, 0, 0, 0, 1, 1]))
+    assert(list(node_set.get_properties('pop_name')) == [v1_nodes.get_row(r)['pop_name'] for r in selected_rows])
+    assert(node_set.get_properties('positions').shape == (6, 3))
+
+    tuning_angles = node_set.get_properties('tuning_angle')
+    assert(tuning_angles[0] == v1_nodes.get_row(396)['tuning_angle'])
+    assert(np.isnan(tuning_angles[4]) and np.isnan(tuning_angles[5]))
+
+    nodes_df = node_set.to_dataframe()
+    assert(nodes_df.shape == (6, 15))
+    assert(list(nodes_df['node_id']) == selected_rows)
+    nodes_df = node_set.to_dataframe(columns=['node_id', 'ei'])
+    assert(list(nodes_df.columns) == ['node_id', 'ei'])
+
+    with pytest.raises(KeyError):
+        node_set.get_properties('not_a_property')
+
+
+def test_node_set_algebra(net):
+    v1_nodes = net.nodes['v1']
+    biophys = v1_nodes.filter(model_type='biophysical')
+    exc = v1_nodes.filter(ei='e')
+    biophys_ids = set(biophys.node_ids)
+    exc_ids = set(exc.node_ids)
+    assert(set((biophys | exc).node_ids) == biophys_ids | exc_ids)
+    assert(set((biophys & exc).node_ids) == biophys_ids & exc_ids)
+    assert(set(biophys.difference(exc).node_ids) == biophys_ids - exc_ids)
+
+    with pytest.raises(ValueError):
+        biophys.union(net.nodes['lgn'].filter(ei='e'))
+
+
+def test_iter_chunks(net):
+    nodes = net.nodes['v1']
+    chunks = list(nodes.iter_chunks(batch_size=100))
+    assert([len(c['node_id']) for c in chunks] == [100, 100, 100, 100, 49])
+    assert(np.all(np.concatenate([c['node_id'] for c in chunks]) == np.arange(449)))
+    assert(chunks[0]['positions'].shape == (100, 3))
+    assert({'node_type_id', 'node_group_id', 'tuning_angle', 'model_type'} <= set(chunks[0].keys()))
+
+    node = nodes.get_node_id(310)
+    assert(chunks[3]['tuning_angle'][10] == node['tuning_angle'])
+    assert(chunks[3]['model_type'][10] == node['model_type'])
+    assert(np.all(np.isnan(chunks[4]['tuning_angle'][-10:])))  # last nodes in group 1, doesn't have tuning_angle
+
+    chunks = list(nodes.iter_chunks(batch_size=200, columns=['node_id', 'positions', 'ei'], as_dataframe=True))
+    assert([len(df) for df in chunks] == [200, 200, 49])
+    assert(list(chunks[0].columns) == ['node_id', 'positions', 'ei'])
+    assert(len(chunks[0]['positions'][0]) == 3)
+
+    # groups and selections
+    grp1 = nodes.get_group(1)
+    grp_chunks = list(grp1.iter_chunks(batch_size=50))
+    assert([len(c['node_id']) for c in grp_chunks] == [50, 17])
+    assert('tuning_angle' not in grp_chunks[0])
+    assert(np.all(np.concatenate([c['node_id'] for c in grp_chunks]) == grp1.node_ids))
+
+    node_set = nodes.get_node_id([400, 3, 200])
+    chunks = list(node_set.iter_chunks(batch_size=2, columns=['node_id', 'model_type']))
+    assert(list(np.concatenate([c['node_id'] for c in chunks])) == [400, 3, 200])
+
+    with pytest.raises(KeyError):
+        next(nodes.iter_chunks(columns=['node_id', 'not_a_column']))
+
+
+def test_partition(net):
+    nodes = net.nodes['v1']
+    assert(len(nodes.partition()) == 449)  # not running with MPI, rank 0 of 1
+
+    partitions = [nodes.partition(rank=r, size=3, strategy='round_robin') for r in range(3)]
+    assert([len(p) for p in partitions] == [150, 150, 149])
+    assert(np.all(partitions[1].node_ids == np.arange(1, 449, 3)))
+
+    partitions = [nodes.partition(rank=r, size=3, strategy='contiguous') for r in range(3)]
+    assert([len(p) for p in partitions] == [149, 150, 150])
+    assert(np.all(np.concatenate([p.node_ids for p in partitions]) == np.arange(449)))
+    assert(not nodes._node_id_index_built)
+
+    with pytest.raises(ValueError):
+        nodes.partition(rank=3, size=3)
+    with pytest.raises(ValueError):
+        nodes.partition(rank=0, size=3, strategy='not_a_strategy')
+
+
+@pytest.mark.parametrize('pop_name', ['v1', 'lgn'])
+def test_spatial_queries(net, pop_name):
+    nodes = net.nodes[pop_name]
+    positions = np.concatenate([c['positions'] for c in nodes.iter_chunks(columns=['positions'])]).astype(float)
+    lower, upper = positions.min(axis=0), positions.max(axis=0)
+
+    box_lower, box_upper = lower + (upper - lower)*0.25, lower + (upper - lower)*0.75
+    in_box = nodes.query_box(box_lower, box_upper)
+    assert(isinstance(in_box, NodeSet))
+    expected = np.flatnonzero(np.all((positions >= box_lower) & (positions <= box_upper), axis=1))
+    assert(len(expected) > 0 and np.all(in_box.row_indicies == expected))
+    assert(len(nodes.query_box(upper + 1.0, upper + 2.0)) == 0)
+
+    center, radius = positions.mean(axis=0), np.max(upper - lower)*0.2
+    dists2 = np.sum((positions - center)**2, axis=1)
+    assert(np.all(nodes.query_radius(center, radius).row_indicies == np.flatnonzero(dists2 <= radius**2)))
+
+    nearest = nodes.k_nearest(center, 10)
+    assert(np.all(nearest.row_indicies == np.lexsort((np.arange(len(positions)), dists2))[:10]))
+    assert(len(nodes.k_nearest(center, len(positions) + 10)) == len(positions))
+
+    with pytest.raises(ValueError):
+        nodes.query_box([0.0], [1.0])
+
+
+def test_spatial_index_persisted(net):
+    nodes = net.nodes['v1']
+    tmp_dir = tempfile.mkdtemp()
+    index_path = os.path.join(tmp_dir, 'v1_spatial_index.npz')
+    try:
+        index = nodes.spatial_index(path=index_path, force=True)
+        assert(os.path.exists(index_path))
+
+        nodes._spatial_index = None
+        loaded_index = nodes.spatial_index(path=index_path)
+        assert(loaded_index is not index)
+        assert(loaded_index.shape == index.shape and loaded_index.cell_size == index.cell_size)
+        assert(np.all(loaded_index.query_radius([0.0, 0.0, 0.0], 100.0) == index.query_radius([0.0, 0.0, 0.0], 100.0)))
+    finally:
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        os.rmdir(tmp_dir)
+
+
+def test_sample(net):
+    v1_nodes = net.nodes['v1']
+    sample = v1_nodes.sample(n=20, seed=100)
+    assert(isinstance(sample, NodeSet) and len(sample) == 20)
+    assert(len(np.unique(sample.node_ids)) == 20 and np.all(np.diff(sample.row_indicies) > 0))
+    assert(np.all(v1_nodes.sample(n=20, seed=100).node_ids == sample.node_ids))
+    assert(len(v1_nodes.sample(frac=0.1)) == 45)
+    assert(len(v1_nodes.sample(n=1000)) == 449)
+
+    stratified = v1_nodes.sample(n=3, stratify_by='node_type_id', seed=1)
+    type_counts = Counter(stratified.node_type_ids)
+    assert(len(type_counts) == len(np.unique(v1_nodes.type_ids)) and set(type_counts.values()) == {3})
+
+    stratified = v1_nodes.sample(frac=0.5, stratify_by=['ei', 'location'], seed=1)
+    assert(0 < len(stratified) < 449)
+
+    lgn_sample = net.nodes['lgn'].sample(n=100, seed=1)
+    sub_sample = lgn_sample.sample(n=10, seed=1)
+    assert(len(sub_sample) == 10 and set(sub_sample.node_ids) <= set(lgn_sample.node_ids))
+
+    with pytest.raises(ValueError):
+        v1_nodes.sample()
+    with pytest.raises(ValueError):
+        v1_nodes.sample(n=10, frac=0.1)
+    with pytest.raises(ValueError):
+        v1_nodes.sample(frac=2.0)
+
+
+def test_group_indicies(net, monkeypatch):
+    v1_nodes = net.nodes['v1']
+    group_ids = np.array(v1_nodes.group_id_ds)
+
+    # use a small chunk so the runs of a group get split across chunks
+    monkeypatch.setattr('sonata.circuit.population.FILTER_CHUNK_SIZE', 50)
+    range_begs, range_ends = v1_nodes.group_ranges(0)
+    assert(np.all(range_begs == [0, 100]) and np.all(range_ends == [85, 397]))
+    assert(np.all(v1_nodes.group_indicies(1) == np.flatnonzero(group_ids == 1)))
+    assert(len(v1_nodes.group_indicies(5)) == 0)
+
+    v1_nodes.group_indicies(0, build_cache=True)
+    assert(v1_nodes._group_indicies_cache_built)
+    assert(np.all(v1_nodes.group_indicies(0) == np.flatnonzero(group_ids == 0)))
+    assert(np.all(v1_nodes.group_indicies(1) == np.flatnonzero(group_ids == 1)))
+
+    # a single group doesn't require reading the group_id column
+    lgn_nodes = net.nodes['lgn']
+    assert(np.all(lgn_nodes.group_indicies(0, build_cache=True) == np.arange(9000)))
+    assert(lgn_nodes.group_ranges(0)[1][0] == 9000)
+
+
 def test_group(net):
     v1_nodes = net.nodes['v1']
     grp_biophysical = v1_nodes.get_group(0)
@@ -118,6 +379,31 @@ def test_group_df(net):
     assert(df.shape == (67, 14))
 
 
+def test_population_df(net):
+    v1_nodes = net.nodes['v1']
+    df = v1_nodes.to_dataframe()
+    assert(df.shape == (449, 15))
+    assert(all(df['node_id'] == range(449)))
+    assert(df['pop_name'].dtype == 'category')
+    assert(df['tuning_angle'].isnull().sum() == 67)  # group 1 nodes don't have a tuning_angle
+
+    df = v1_nodes.to_dataframe(columns=['node_id', 'pop_name', 'tuning_angle'], row_indicies=[400, 2, 85])
+    assert(list(df.columns) == ['node_id', 'pop_name', 'tuning_angle'])
+    assert(list(df['node_id']) == [400, 2, 85])
+    assert(list(df['pop_name']) == [v1_nodes.get_row(r)['pop_name'] for r in [400, 2, 85]])
+    assert(df['tuning_angle'].isnull().sum() == 2)
+
+    df = net.nodes['lgn'].to_dataframe(columns=['node_id', 'positions'])
+    assert(df.shape == (9000, 2))
+    assert(len(df['positions'][0]) == 2)
+
+    with pytest.raises(KeyError):
+        v1_nodes.to_dataframe(columns=['node_id', 'bogus'])
+
+    with pytest.raises(KeyError):
+        v1_nodes.to_dataframe(columns=['gid'])  # no gid table
+
+
 def test_group_properties(net):
     v1_nodes = net.nodes['v1']
     grp_0 = v1_nodes.get_group(0)
@@ -139,12 +425,88 @@ def test_group_search(net):
         assert(node.node_type_id == 318808427)
 
     assert(sum(1 for _ in grp_0.filter(model_template='nrn:IntFire1', pop_name='Nr5a1')) == 0)
+    assert(grp_0.filter(model_template='nrn:IntFire1', pop_name='Nr5a1').row_indicies.dtype == np.int64)
+    assert(v1_nodes.filter(model_template='nrn:IntFire1', pop_name='Nr5a1').row_indicies.dtype == np.int64)
 
     for i, node in enumerate(grp_0.filter(tuning_angle=0.0)):
         assert(node['tuning_angle'] == 0.0)
     assert((i+1) == 4)
 
 
+def test_population_filter(net):
+    v1_nodes = net.nodes['v1']
+    node_set = v1_nodes.filter(model_type='biophysical', location='VisL4')
+    assert(isinstance(node_set, NodeSet))
+    assert(len(node_set) == 100)
+    assert(all(node_set.node_ids == [n.node_id for n in v1_nodes if n['model_type'] == 'biophysical']))
+    for node in node_set:
+        assert(node['model_type'] == 'biophysical')
+
+    # group 1 doesn't have a tuning_angle column so only group 0 nodes can match
+    assert(len(v1_nodes.filter(tuning_angle=0.0)) == 4)
+    assert(len(v1_nodes.filter(node_id=[1, 2, 400])) == 3)
+    assert(len(v1_nodes.filter(pop_name=['Scnn1a', 'Rorb'])) == len(v1_nodes.filter(pop_name='Scnn1a')) +
+           len(v1_nodes.filter(pop_name='Rorb')))
+    assert(len(v1_nodes.filter(pop_name='Scnn1a', model_template='nrn:IntFire1')) == 0)
+
+    # unknown properties raise the same error for the population and its groups
+    with pytest.raises(KeyError):
+        v1_nodes.filter(not_a_column=0)
+    with pytest.raises(KeyError):
+        v1_nodes.filter(col('not_a_column') > 0, model_type='biophysical')
+    with pytest.raises(KeyError):
+        v1_nodes.get_group(1).filter(tuning_angle=0.0)
+
+
+def test_population_filter_predicates(net):
+    v1_nodes = net.nodes['v1']
+    assert(len(v1_nodes.filter(col('pop_name').match('^PV'))) == len(v1_nodes.filter(pop_name=['PV1', 'PV2'])))
+
+    node_set = v1_nodes.filter(col('tuning_angle') < 100.0, model_type='biophysical')
+    assert(len(node_set) > 0)
+    for node in node_set:
+        assert(node['tuning_angle'] < 100.0 and node['model_type'] == 'biophysical')
+
+    node_set = v1_nodes.filter(col('model_template').startswith('nrn:') | col('pop_name').isin(['Rorb']))
+    for node in node_set:
+        assert(node['model_template'] == 'nrn:IntFire1' or node['pop_name'] == 'Rorb')
+
+    grp_1 = v1_nodes.get_group(1)
+    assert(len(grp_1.filter(col('rotation_angle_yaxis').between(None, None, inclusive='both'))) == len(grp_1))
+
+    # a key's predicate has to be on the same column
+    assert(len(v1_nodes.filter(tuning_angle=col('tuning_angle') < 100.0, model_type='biophysical')) ==
+           len(v1_nodes.filter(col('tuning_angle') < 100.0, model_type='biophysical')))
+    with pytest.raises(ValueError):
+        v1_nodes.filter(model_type=col('tuning_angle') < 100.0)
+
+    # nodes without the column don't match a predicate, so they do match its negation unless exists() is used
+    grp_0 = v1_nodes.get_group(0)
+    assert(len(v1_nodes.filter(~(col('tuning_angle') == 0.0))) == len(v1_nodes) - 4)
+    assert(len(v1_nodes.filter(~(col('tuning_angle') == 0.0) & col('tuning_angle').exists())) == len(grp_0) - 4)
+    assert(len(v1_nodes.filter(col('tuning_angle').exists())) == len(grp_0))
+
+
+def test_population_filter_multidim(net):
+    v1_nodes = net.nodes['v1']
+    positions = v1_nodes.get_group(0).get_values('positions')
+    assert(len(v1_nodes.filter(col('positions').between(-1.0e9, 1.0e9))) == len(v1_nodes))
+
+    # a row is in range only if every element is
+    lower, upper = np.array([-50.0, -500.0, -50.0]), np.array([50.0, 0.0, 50.0])
+    node_set = v1_nodes.filter(col('positions').between(lower, upper))
+    all_positions = np.array(list(v1_nodes.to_dataframe(columns=['positions'])['positions']))
+    expected = np.all((all_positions >= lower) & (all_positions < upper), axis=1)
+    assert(0 < len(node_set) < len(v1_nodes) and np.all(node_set.row_indicies == np.flatnonzero(expected)))
+
+    # isin compares whole rows
+    assert(len(v1_nodes.filter(positions=[list(positions[0]), list(positions[1])])) == 2)
+    assert(list(v1_nodes.filter(positions=list(positions[5])).row_indicies) == [5])
+    assert(len(v1_nodes.filter(positions=[])) == 0)
+    with pytest.raises(ValueError):
+        v1_nodes.filter(positions=[1.0, 2.0])
+
+
 if __name__ == '__main__':
     from conftest import net
 
@@ -1,4 +1,6 @@
 import os
+import shutil
+import tempfile
 import pytest
 import h5py
 import numpy as np
@@ -32,6 +34,76 @@ def test_save_gids(thalamocortical):
     assert(set(np.unique(gid_h5['population_names'][...])) == set(['v1', 'lgn']))
 
 
+def test_generate_gids(thalamocortical):
+    nodes = thalamocortical.nodes
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        gid_file = os.path.join(tmp_dir, 'gid_table.h5')
+        nodes.generate_gids(file_name=gid_file, gids={'v1': 100000, 'lgn': np.arange(9000)[::-1]*2})
+        assert(nodes.has_gids)
+
+        with h5py.File(gid_file, mode='r') as gid_h5:
+            assert(len(gid_h5['gid']) == 9449)
+            assert(set(np.unique(gid_h5['population'][()])) == {0, 1})
+
+        v1 = nodes['v1']
+        assert(np.all(v1.gids == np.arange(100000, 100449)))
+        assert(v1.get_row(10).gid == 100010)
+        assert(v1.get_gid(100010).node_id == 10)
+        assert(np.all(v1.get_gid([100448, 100000]).node_ids == [448, 0]))
+        with pytest.raises(KeyError):
+            v1.get_gid(0)
+
+        lgn = nodes['lgn']
+        assert(np.all(lgn.igids([0, 1, 8999]) == [17998, 17996, 0]))
+        assert(lgn.get_gid(0).node_id == 8999)
+        lgn_nodes = lgn.get_gids([2, 17998, 2, 100])
+        assert(np.all(lgn_nodes.node_ids == [8998, 0, 8998, 8949]))
+        assert(np.all(lgn_nodes.gids == [2, 17998, 2, 100]))
+        assert(len(lgn.get_gids(4)) == 1)
+
+        # gids are not unique
+        with pytest.raises(Exception):
+            nodes.generate_gids(file_name=gid_file, gids={'v1': 0, 'lgn': 0}, force=True)
+
+        nodes.generate_gids(file_name=gid_file, gids=lambda pop: pop.node_ids + (0 if pop.name == 'v1' else 1000),
+                            force=True)
+        assert(v1.get_row(10).gid == 10)
+        assert(lgn.get_row(10).gid == 1010)
+
+        # populations missing from a new table lose their old gids
+        v1_only_file = os.path.join(tmp_dir, 'v1_gid_table.h5')
+        with h5py.File(v1_only_file, 'w') as gid_h5:
+            gid_h5.create_dataset('gid', data=np.arange(449) + 5000)
+            gid_h5.create_dataset('node_id', data=np.arange(449))
+            gid_h5.create_dataset('population', data=np.zeros(449, dtype=np.uint16))
+            gid_h5.create_dataset('population_names', data=[b'v1'])
+        nodes.set_gid_table(v1_only_file, force=True)
+        assert(v1.has_gids and v1.get_row(10).gid == 5010)
+        assert(not lgn.has_gids and lgn.gids is None)
+        with pytest.raises(Exception):
+            lgn.get_gid(1010)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def test_partial_gids(thalamocortical):
+    v1 = thalamocortical.nodes['v1']
+    v1.add_gids(np.arange(200) + 1000, node_ids=np.arange(200)*2, force=True)
+    assert(len(v1.gids) == 200)
+    assert(np.all(v1.igids([0, 1, 2]) == [1000, -1, 1001]))
+    assert(v1.get_row(0).gid == 1000)
+    with pytest.raises(KeyError):
+        v1.get_row(1).gid
+
+    # iterating and reading the gid column shouldn't fail on nodes without a gid
+    assert(len([n.node_id for n in v1]) == 449)
+    nodes_df = v1.to_dataframe()
+    assert(len(nodes_df) == 449)
+    assert(np.all(nodes_df['gid'].values[:4] == [1000, -1, 1001, -1]))
+    assert(np.all(nodes_df['gid'].values[400:] == -1))
+
+
 def test_nodes(thalamocortical):
     nodes = thalamocortical.nodes
     assert(nodes.root_name == 'nodes')
@@ -30,6 +30,39 @@ def test_node_types(net):
     assert(node_type2['location'] == 'VisL4')
 
 
+def test_node_types_broadcast(net):
+    node_types = net.nodes.node_types_table
+    type_ids = [395830185, 1, 1, 100000101, 395830185]
+    assert(list(node_types.broadcast('location', type_ids)) == ['VisL4', 'LGN', 'LGN', 'VisL4', 'VisL4'])
+    assert(list(node_types.broadcast('pop_name', type_ids)) == [node_types[i]['pop_name'] for i in type_ids])
+
+    rot_angles = node_types.broadcast('rotation_angle_zaxis', type_ids)
+    assert(rot_angles.dtype == np.float64)
+    assert(rot_angles[0] == node_types[395830185]['rotation_angle_zaxis'])
+    assert(np.isnan(rot_angles[1]) and np.isnan(rot_angles[3]))
+
+    ei_cat = node_types.broadcast('ei', type_ids, categorical=True)
+    assert(list(ei_cat) == ['e', 'e', 'e', 'e', 'e'])
+    assert(set(ei_cat.categories) == {'e', 'i'})
+
+    with pytest.raises(KeyError):
+        node_types.broadcast('location', [2, 3])
+
+
+def test_node_types_find(net):
+    node_types = net.nodes.node_types_table
+    df = node_types.to_dataframe()
+    assert(node_types.find('ei', 'i') == sorted(df[df['ei'] == 'i'].index))
+    assert(node_types.find('location', ['LGN', 'not_a_location']) == sorted(df[df['location'] == 'LGN'].index))
+    assert(node_types.find('rotation_angle_zaxis', df['rotation_angle_zaxis'].dropna().iloc[0]) != [])
+    assert(node_types.find('ei', 'not_a_value') == [])
+    assert(node_types.find('not_a_column', 'e', silent=True) == [])
+    with pytest.raises(KeyError):
+        node_types.find('not_a_column', 'e')
+
+    assert(sorted(nt['node_type_id'] for nt in node_types) == sorted(node_types.node_type_ids))
+
+
 def test_edge_types(net):
     edge_types = net.edges.edge_types_table
     assert(edge_types is not None)
@@ -50,6 +83,12 @@ def test_edge_types(net):
     del edge_type1
     assert (mem_id == id(edge_types[1]))
 
+    # edge_type_ids are close together so lookups use a dense array
+    assert(edge_types._dense_index is not None)
+    assert(list(edge_types.broadcast('delay', [1, 1, 2])) == [2.0, 2.0, edge_types[2]['delay']])
+    with pytest.raises(KeyError):
+        edge_types.type_indicies([1, 100])
+
 
 if __name__ == '__main__':
     from conftest import net